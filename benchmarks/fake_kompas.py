@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+'''
+Имитация COM API КОМПАС-3D для запуска бенчмарков и проверок без КОМПАС и pywin32.
+Каждое обращение к методу или свойству объекта имитации считается
+межпроцессным вызовом COM и может выполняться с задержкой latency.
+'''
+
+import os, sys
+import time
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.KompasSession import KompasSession
+from src.KompasEventsHandler import NotifySource
+
+
+class ComStats:
+    '''
+    Счетчик вызовов имитации
+    '''
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self.connects = 0
+
+    def call(self):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeObject:
+    def __init__(self, stats):
+        self._stats = stats
+
+
+class FakeProperty(FakeObject):
+    def __init__(self, stats, ID):
+        super().__init__(stats)
+        self.Id = ID
+
+
+class FakePropertyMng(FakeObject):
+    def GetProperty(self, document, ID):
+        self._stats.call()
+        return FakeProperty(self._stats, ID)
+
+
+class FakePropertyKeeper(FakeObject):
+    def __init__(self, stats, owner):
+        super().__init__(stats)
+        self.owner = owner
+
+    def GetPropertyValue(self, prp, value, base_unit, from_source=True):
+        self._stats.call()
+        return True, self.owner.properties.get(prp.Id, ''), from_source
+
+    def SetPropertyValue(self, prp, value, base_unit):
+        self._stats.call()
+        self.owner.properties[prp.Id] = value
+        return True
+
+
+class FakeFeature(FakeObject):
+    def __init__(self, stats, name, create_spc=True):
+        super().__init__(stats)
+        self.Name = name
+        self.CreateSpcObjects = create_spc
+        self.properties = {}
+        self.bodies = ()
+
+    def SubFeatures(self, level, visible, reverse):
+        self._stats.call()
+        return ()
+
+    @property
+    def ResultBodies(self):
+        self._stats.call()
+        return self.bodies
+
+    def Update(self):
+        self._stats.call()
+        return True
+
+
+class FakeDocument(FakeObject):
+    def __init__(self, stats, documents, path_name, doc_type=4.0):
+        super().__init__(stats)
+        self.documents = documents
+        self.PathName = path_name
+        self.Name = os.path.basename(path_name)
+        self.ReadOnly = False
+        self.Changed = False
+        self.Type = doc_type
+        self.TopPart = FakeFeature(stats, 'Деталь')
+
+    def SaveAs(self, path_name):
+        self._stats.call()
+        self.documents.rename(self, path_name)
+        return True
+
+    def modify(self):
+        '''
+        Имитация редактирования документа пользователем
+        '''
+        self.Changed = True
+
+    def Save(self):
+        self._stats.call()
+        self.Changed = False
+        self.documents.application.notify('save', self)
+        return True
+
+    def Close(self, mode=0):
+        self._stats.call()
+        self.documents.close(self)
+        return True
+
+
+class FakeDocuments(FakeObject):
+    def __init__(self, stats, application):
+        super().__init__(stats)
+        self.application = application
+        self.items = []
+
+    @property
+    def Count(self):
+        self._stats.call()
+        return len(self.items)
+
+    def Item(self, key):
+        self._stats.call()
+        if isinstance(key, int):
+            return self.items[key] if 0 <= key < len(self.items) else None
+        for document in self.items:
+            if os.path.normcase(document.PathName) == os.path.normcase(key):
+                return document
+        return None
+
+    def Add(self, doc_type, visible=True):
+        self._stats.call()
+        document = FakeDocument(self._stats, self, 'Документ{}'.format(len(self.items) + 1), doc_type)
+        self.items.append(document)
+        self.application.activate(document)
+        return document
+
+    def Open(self, path_name, visible=True, read_only=False):
+        self._stats.call()
+        document = FakeDocument(self._stats, self, path_name)
+        document.ReadOnly = read_only
+        self.items.append(document)
+        self.application.notify('open', document)
+        self.application.activate(document)
+        return document
+
+    def rename(self, document, path_name):
+        document.PathName = path_name
+        document.Name = os.path.basename(path_name)
+        document.Changed = False
+        self.application.notify('save', document)
+
+    def close(self, document):
+        if document in self.items:
+            self.items.remove(document)
+        self.application.notify('close', document)
+        if self.application.active is document:
+            self.application.activate(self.items[-1] if self.items else None)
+
+
+class FakeApplication(FakeObject):
+    '''
+    Имитация IApplication. listeners - функции listener(kind, document),
+    вызываемые при открытии, активации, сохранении и закрытии документов
+    '''
+    def __init__(self, stats):
+        super().__init__(stats)
+        self._visible = True
+        self.active = None
+        self.running = True
+        self.listeners = []
+        self.Documents = FakeDocuments(stats, self)
+
+    def _check(self):
+        self._stats.call()
+        if not self.running:
+            raise RuntimeError('Сервер RPC недоступен')
+
+    @property
+    def Visible(self):
+        self._check()
+        return self._visible
+
+    @Visible.setter
+    def Visible(self, value):
+        self._check()
+        self._visible = value
+
+    @property
+    def ActiveDocument(self):
+        self._check()
+        return self.active
+
+    def MessageBoxEx(self, text, title, flags):
+        self._stats.call()
+        return 1
+
+    def notify(self, kind, document):
+        for listener in list(self.listeners):
+            listener(kind, document)
+
+    def activate(self, document):
+        self.active = document
+        if document is not None:
+            self.notify('activate', document)
+
+
+class FakeModule:
+    '''
+    Имитация модуля библиотеки типов API7: приведение интерфейсов
+    возвращает тот же объект
+    '''
+    def __init__(self, stats):
+        self.stats = stats
+
+    def IApplication(self, obj):
+        return obj
+
+    def IKompasDocument3D(self, obj):
+        return obj
+
+    def IFeature7(self, obj):
+        return obj
+
+    def IPart7(self, obj):
+        return obj
+
+    def IPropertyMng(self, app):
+        self.stats.call()
+        return FakePropertyMng(self.stats)
+
+    def IPropertyKeeper(self, obj):
+        self.stats.call()
+        return FakePropertyKeeper(self.stats, obj)
+
+
+class FakeConstants:
+    pass
+
+
+class FakeEventSource(NotifySource):
+    '''
+    Источник событий для монитора документов (KompasFrameHandler),
+    подписанный на события имитации приложения вместо событий COM
+    '''
+    def __init__(self, application):
+        super().__init__()
+        self.application = application
+        self.application.listeners.append(self.notify)
+
+    def close(self):
+        if self.notify in self.application.listeners:
+            self.application.listeners.remove(self.notify)
+
+
+class FakeKompas:
+    '''
+    Запущенный экземпляр имитации КОМПАС.
+    connect_cost - время подключения (загрузка библиотек типов и Dispatch)
+    '''
+    def __init__(self, latency=0.0, connect_cost=0.0):
+        self.stats = ComStats(latency)
+        self.connect_cost = connect_cost
+        self.module = FakeModule(self.stats)
+        self.app = FakeApplication(self.stats)
+
+    def restart(self):
+        '''
+        Имитация перезапуска КОМПАС: старый объект приложения перестает отвечать
+        '''
+        self.app.running = False
+        self.app = FakeApplication(self.stats)
+
+    def factory(self):
+        '''
+        Функция подключения для KompasSessionCache
+        '''
+        self.stats.connects += 1
+        if self.connect_cost:
+            time.sleep(self.connect_cost)
+        return KompasSession(self.module, self.app, FakeConstants(), FakeConstants())
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+'''
+Бенчмарк обращений к КОМПАС через имитацию COM API (fake_kompas).
+Сравнивает подключение к КОМПАС при каждом создании KompasAPI,
+как было раньше, с кэшем подключений kompas_sessions, и запись свойств
+по одному значению с пакетной записью через PropertyCache, а также
+монитор документов с постоянным опросом, адаптивным опросом и событиями.
+Запуск: python benchmarks/kompas_benchmark.py --latency 0.0005 --connect-cost 0.05
+'''
+
+import os, sys
+import argparse
+import queue
+import random
+import time
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from fake_kompas import FakeKompas, FakeFeature, FakeEventSource
+from src.KompasSession import kompas_sessions
+from src.KompasEventsHandler import KompasFrameHandler, PollingSource
+from src.KompasUtility import KompasAPI, KompasItem, PropertyCache, OpenDoc
+
+
+def run_open_documents(kompas, count, cached):
+    for i in range(count):
+        if not cached:
+            kompas_sessions.reset()
+        OpenDoc(open_state=True, file_path='C:/Project/part_{}.m3d'.format(i))
+
+
+def run_bodies(kompas, count, cached):
+    document = kompas.app.Documents.Add(5.0, True)
+    document.TopPart.bodies = tuple(FakeFeature(kompas.stats, 'Тело {}'.format(i)) for i in range(count))
+    if not cached:
+        # прежнее поведение: KompasItem подключался к КОМПАС для каждого тела
+        for body in document.TopPart.bodies:
+            kompas_sessions.reset()
+            KompasItem(body).is_patterned()
+    else:
+        KompasAPI().get_bodies_array()
+
+
+def run_properties(kompas, count, cached):
+    document = kompas.app.Documents.Add(5.0, True)
+    parts = [FakeFeature(kompas.stats, 'Деталь {}'.format(i)) for i in range(count)]
+    session = kompas_sessions.get()
+    if not cached:
+        # прежнее поведение: IPropertyMng, IPropertyKeeper и GetProperty при каждом обращении
+        for i, part in enumerate(parts):
+            for ID, value in ((4.0, 'ОБОЗН.{}'.format(i)), (5.0, 'Деталь {}'.format(i))):
+                iPropertyMng = kompas.module.IPropertyMng(kompas.app)
+                iPropertyKeeper = kompas.module.IPropertyKeeper(part)
+                iPropertyKeeper.SetPropertyValue(iPropertyMng.GetProperty(kompas.app.ActiveDocument, ID), value, True)
+    else:
+        PropertyCache(session, document).set_values(
+            parts, [{4.0: 'ОБОЗН.{}'.format(i), 5.0: 'Деталь {}'.format(i)} for i in range(count)])
+
+
+def measure(name, scenario, args, count):
+    for cached in (False, True):
+        kompas = FakeKompas(args.latency, args.connect_cost)
+        kompas_sessions.set_factory(kompas.factory)
+        start = time.time()
+        scenario(kompas, count, cached)
+        elapsed = time.time() - start
+        print('{:<22} {:<12} {:.3f} с, подключений: {}, вызовов COM: {}'.format(
+            name, 'кэш' if cached else 'без кэша', elapsed, kompas.stats.connects, kompas.stats.calls))
+
+
+def wait_event(event_queue, kind, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            event = event_queue.get(timeout=deadline - time.time())
+        except queue.Empty:
+            break
+        if not isinstance(event, str) and event.kind == kind:
+            return event
+    return None
+
+
+def run_monitor(kompas, mode, idle, switches):
+    '''
+    Возвращает (средняя задержка события активации, с; вызовов COM в секунду простоя)
+    '''
+    documents = [kompas.app.Documents.Open('C:/Project/part_{}.m3d'.format(i)) for i in range(5)]
+    if mode == 'события':
+        handler = KompasFrameHandler(queue.Queue(), lambda: FakeEventSource(kompas.app), com=False)
+    elif mode == 'адаптивный опрос':
+        handler = KompasFrameHandler(queue.Queue(), PollingSource, com=False)
+    else:
+        # прежнее поведение: опрос каждые 0.5 с
+        handler = KompasFrameHandler(queue.Queue(), PollingSource, min_interval=0.5, max_interval=0.5, com=False)
+    handler.start()
+    wait_event(handler.event_queue, 'activate')
+
+    calls = kompas.stats.calls
+    time.sleep(idle)
+    idle_calls = (kompas.stats.calls - calls) / idle
+
+    # паузы между переключениями случайные, чтобы задержка не зависела
+    # от совпадения момента переключения с расписанием опроса
+    pauses = random.Random(1)
+    delays = []
+    for i in range(switches):
+        start = time.time()
+        kompas.app.activate(documents[i % len(documents)])
+        if wait_event(handler.event_queue, 'activate') is not None:
+            delays.append(time.time() - start)
+        time.sleep(pauses.uniform(0.5, 1.5) * idle / switches)
+    handler.stop()
+    handler.join()
+    return sum(delays) / max(len(delays), 1), idle_calls
+
+
+def measure_monitor(args):
+    for mode in ('опрос 0.5 с', 'адаптивный опрос', 'события'):
+        kompas = FakeKompas(args.latency)
+        kompas_sessions.set_factory(kompas.factory)
+        delay, idle_calls = run_monitor(kompas, mode, args.idle, args.switches)
+        print('{:<22} {:<16} задержка {:.3f} с, вызовов COM в простое: {:.1f}/с'.format(
+            'Монитор документов', mode, delay, idle_calls))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк обращений к КОМПАС на имитации COM')
+    parser.add_argument('--latency', type=float, default=0.0005, help='задержка одного вызова COM, с')
+    parser.add_argument('--connect-cost', type=float, default=0.05, help='время подключения к КОМПАС, с')
+    parser.add_argument('--count', type=int, default=50)
+    parser.add_argument('--idle', type=float, default=4.0, help='время простоя КОМПАС для монитора, с')
+    parser.add_argument('--switches', type=int, default=5, help='количество переключений документов')
+    args = parser.parse_args()
+
+    measure('Открытие документов', run_open_documents, args, args.count)
+    measure('Тела сборки', run_bodies, args, args.count)
+    measure('Свойства деталей', run_properties, args, args.count)
+    measure_monitor(args)
+    kompas_sessions.set_factory(None)
+
+
+if __name__ == '__main__':
+    main()
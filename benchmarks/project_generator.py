@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+'''
+Генератор синтетических проектов КОМПАС для бенчмарков: дерево папок
+заданной глубины и ветвления с файлами .m3d, .a3d и .cdw в заданной пропорции.
+'''
+
+import os
+import random
+from collections import namedtuple
+
+
+# Итог генерации: количество папок, файлов и общий размер файлов, байт
+ProjectStats = namedtuple('ProjectStats', ['directories', 'files', 'bytes'])
+
+DEFAULT_MIX = {'.m3d': 5, '.a3d': 1, '.cdw': 3}
+
+
+def parse_mix(text):
+    '''
+    Разбор пропорции типов файлов вида "m3d=5,a3d=1,cdw=3"
+    '''
+    mix = {}
+    for part in text.split(','):
+        extension, weight = part.split('=')
+        extension = extension.strip()
+        if not extension.startswith('.'):
+            extension = '.' + extension
+        mix[extension] = float(weight)
+    return mix
+
+
+class ProjectGenerator:
+    '''
+    Входные параметры:
+    depth - количество уровней папок
+    fanout - количество подпапок в каждой папке
+    files_per_dir - количество файлов в каждой папке
+    mix - {расширение: вес} для выбора типа файла
+    min_size, max_size - диапазон размеров файлов, байт
+    seed - начальное значение генератора случайных чисел (одинаковый проект при повторных запусках)
+    '''
+    def __init__(self, depth=3, fanout=4, files_per_dir=20, mix=None,
+                 min_size=1024, max_size=64 * 1024, seed=0):
+        self.depth = depth
+        self.fanout = fanout
+        self.files_per_dir = files_per_dir
+        self.mix = mix or DEFAULT_MIX
+        self.min_size = min_size
+        self.max_size = max_size
+        self.random = random.Random(seed)
+
+    def choose_extension(self):
+        value = self.random.uniform(0, sum(self.mix.values()))
+        for extension in sorted(self.mix):
+            value -= self.mix[extension]
+            if value <= 0:
+                return extension
+        return extension
+
+    def write_file(self, file_path):
+        size = self.random.randint(self.min_size, self.max_size)
+        block = bytes(bytearray(self.random.getrandbits(8) for _ in range(256)))
+        with open(file_path, 'wb') as f:
+            f.write((block * (size // len(block) + 1))[:size])
+        return size
+
+    def generate(self, root):
+        '''
+        Создает дерево проекта в папке root и возвращает ProjectStats
+        '''
+        directories = files = total = 0
+        level = [root]
+        for depth in range(self.depth):
+            next_level = []
+            for dir_path in level:
+                for i in range(self.files_per_dir):
+                    file_path = os.path.join(dir_path, 'Деталь_{}_{}{}'.format(depth, i, self.choose_extension()))
+                    total += self.write_file(file_path)
+                    files += 1
+                for i in range(self.fanout):
+                    sub_path = os.path.join(dir_path, 'Узел_{}'.format(i))
+                    os.mkdir(sub_path)
+                    next_level.append(sub_path)
+                    directories += 1
+            level = next_level
+        return ProjectStats(directories, files, total)
+
+    def modify(self, root, count):
+        '''
+        Перезаписывает count случайных файлов проекта. Возвращает список путей
+        '''
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            paths.extend(os.path.join(dirpath, name) for name in sorted(filenames))
+        changed = self.random.sample(paths, min(count, len(paths)))
+        for file_path in changed:
+            os.chmod(file_path, 0o666)
+            self.write_file(file_path)
+        return changed
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+'''
+Сравнение скорости обхода папки проекта: последовательный os.walk,
+который раньше использовался в CADFolderDB.update_project,
+и параллельный ProjectScanner на основе os.scandir.
+Запуск: python benchmarks/scan_benchmark.py --depth 3 --fanout 6 --files 40
+'''
+
+import os, sys, stat
+import argparse
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from src.ScanModule import ProjectScanner, is_project_file, format_mtime_ns
+
+
+def make_tree(root, depth, fanout, files_per_dir):
+    '''
+    Создает синтетическое дерево проекта и возвращает количество объектов
+    '''
+    extensions = ['.m3d', '.a3d', '.cdw']
+    count = 0
+    level = [root]
+    for _ in range(depth):
+        next_level = []
+        for dir_path in level:
+            for i in range(files_per_dir):
+                file_path = os.path.join(dir_path, 'part_{}{}'.format(i, extensions[i % 3]))
+                with open(file_path, 'wb') as f:
+                    f.write(b'0' * 64)
+                count += 1
+            for i in range(fanout):
+                sub_path = os.path.join(dir_path, 'folder_{}'.format(i))
+                os.mkdir(sub_path)
+                next_level.append(sub_path)
+                count += 1
+        level = next_level
+    return count
+
+
+def legacy_walk(project_path, set_read_only):
+    '''
+    Повторяет прежний цикл update_project: os.walk, getmtime,
+    fromtimestamp и chmod для каждого объекта
+    '''
+    records = []
+    for dirpath, dirnames, filenames in os.walk(project_path):
+        for name, item_type in ([(d, 'directory') for d in dirnames] +
+                                [(f, 'file') for f in filenames if is_project_file(f)]):
+            full_path = os.path.join(dirpath, name).replace("\\", "/")
+            dt = datetime.fromtimestamp(os.path.getmtime(full_path))
+            records.append((name, full_path, item_type, dt.strftime('%Y-%m-%dT%H:%M:%S')))
+            if set_read_only:
+                os.chmod(full_path, stat.S_IREAD)
+    return records
+
+
+def restore_write_access(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            os.chmod(os.path.join(dirpath, name), stat.S_IREAD | stat.S_IWRITE | stat.S_IEXEC)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк обхода папки проекта')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=6)
+    parser.add_argument('--files', type=int, default=40)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--path', default=None,
+                        help='существующая папка (например, на сетевом диске) вместо синтетической')
+    args = parser.parse_args()
+
+    # На Windows "только для чтения" для папок - просто атрибут,
+    # в остальных ОС chmod лишает доступа к содержимому папки
+    set_read_only = os.name == 'nt'
+
+    temp_dir = None
+    if args.path:
+        project_path = args.path
+    else:
+        temp_dir = tempfile.mkdtemp(prefix='nerpasync_scan_')
+        project_path = temp_dir
+        count = make_tree(project_path, args.depth, args.fanout, args.files)
+        print('Создано объектов: {}'.format(count))
+
+    try:
+        start = time.time()
+        legacy = legacy_walk(project_path, set_read_only)
+        legacy_time = time.time() - start
+        if temp_dir:
+            restore_write_access(temp_dir)
+
+        scanner = ProjectScanner(project_path, max_workers=args.workers, set_read_only=set_read_only)
+        start = time.time()
+        records = scanner.scan()
+        scan_time = time.time() - start
+
+        same = sorted(legacy) == sorted((record.name, record.network_path, record.type,
+                                         format_mtime_ns(record.mtime_ns)) for record in records)
+        print('os.walk:        {:.3f} с ({} объектов)'.format(legacy_time, len(legacy)))
+        print('ProjectScanner: {:.3f} с ({} объектов, потоков: {})'.format(scan_time, len(records), args.workers))
+        print('Ускорение: x{:.2f}, результаты совпадают: {}'.format(legacy_time / max(scan_time, 1e-9), same))
+    finally:
+        if temp_dir:
+            restore_write_access(temp_dir)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
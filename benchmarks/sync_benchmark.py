@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+'''
+Бенчмарк движка синхронизации на синтетическом проекте без КОМПАС и сетевого диска.
+Измеряет CADFolderDB.update_project (первичное заполнение и повторный обход),
+get_common_network_root, sync_to_local (первая и инкрементальная синхронизация)
+и построение данных дерева проекта. getuser, диалог выбора папки и USERPROFILE
+подменяются, БД и локальное хранилище создаются во временной папке.
+Результаты записываются в JSON. С параметром --baseline результаты сравниваются
+с предыдущим запуском, и при замедлении больше допустимого скрипт завершается с кодом 1.
+Запуск: python benchmarks/sync_benchmark.py --depth 3 --fanout 4 --files 20 --output result.json
+'''
+
+import os, sys
+import argparse
+import functools
+import io
+import json
+import platform
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from project_generator import ProjectGenerator, DEFAULT_MIX, parse_mix
+from scan_benchmark import restore_write_access
+import src.ConnectionModule as ConnectionModule
+import src.DBMngModule as DBMngModule
+from src.ConnectionModule import connections
+from src.DBMngModule import CADFolderDB
+from src.ReplicaModule import replica
+from gui.NerpaSyncGui import NerpaSyncMain, DocumentIndex
+
+BENCHMARK_USER = 'benchmark'
+# Этапы короче этого времени не проверяются на замедление: их замер определяется шумом, с
+MIN_COMPARED_TIME = 0.01
+
+
+def stub_environment(work_dir, project_path):
+    '''
+    Подмена окружения пользователя: БД во временной папке, пользователь,
+    диалог выбора папки и локальное хранилище
+    '''
+    databases_dir = os.path.join(work_dir, 'databases')
+    os.makedirs(databases_dir)
+    ConnectionModule.databases_dir = databases_dir
+    ConnectionModule.getuser = lambda: BENCHMARK_USER
+    DBMngModule.getuser = lambda: BENCHMARK_USER
+    DBMngModule.filedialog.askdirectory = lambda *args, **kwargs: project_path
+    os.environ['USERPROFILE'] = os.path.join(work_dir, 'home')
+    if os.name != 'nt':
+        # вне Windows "только для чтения" у папок запрещает их обход
+        DBMngModule.ProjectScanner = functools.partial(DBMngModule.ProjectScanner, set_read_only=False)
+
+
+class Timings:
+    '''
+    Замер этапов. Вывод print во время замера перехватывается,
+    чтобы не измерять скорость терминала
+    '''
+    def __init__(self, verbose=False):
+        self.results = {}
+        self.verbose = verbose
+
+    def measure(self, name, func, *args):
+        stdout = sys.stdout
+        if not self.verbose:
+            sys.stdout = io.StringIO()
+        try:
+            start = time.time()
+            result = func(*args)
+            elapsed = time.time() - start
+        finally:
+            sys.stdout = stdout
+        self.results[name] = elapsed
+        print('{:<32} {:.3f} с'.format(name, elapsed))
+        return result
+
+
+def build_tree_data(lazy):
+    '''
+    Данные для дерева проекта без виджетов: корень, строки первого уровня
+    (или все строки) и индекс документов для событий КОМПАС.
+    Как и в окне программы, данные читаются из локальной копии главной БД
+    '''
+    main = NerpaSyncMain.__new__(NerpaSyncMain)
+    with connections.transaction(replica.read_path()) as cursor:
+        root_path = main.get_tree_root(cursor)
+        if lazy:
+            rows = main.get_tree_children(cursor, root_path)
+        doc_rows = main.get_document_rows(cursor)
+    if not lazy:
+        rows = main.get_data_to_tree()
+    DocumentIndex().load(doc_rows)
+    return len(rows)
+
+
+def compare(results, baseline_path, tolerance):
+    '''
+    Сравнение с предыдущими результатами. Возвращает список этапов, замедлившихся больше чем в tolerance раз
+    '''
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    regressions = []
+    for name, elapsed in sorted(results.items()):
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        ratio = elapsed / previous
+        print('{:<32} {:.3f} с -> {:.3f} с (x{:.2f})'.format(name, previous, elapsed, ratio))
+        if ratio > tolerance and elapsed >= MIN_COMPARED_TIME:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк синхронизации на синтетическом проекте')
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fanout', type=int, default=4)
+    parser.add_argument('--files', type=int, default=20, help='количество файлов в каждой папке')
+    parser.add_argument('--mix', default=','.join('{}={}'.format(e[1:], w) for e, w in sorted(DEFAULT_MIX.items())),
+                        help='пропорция типов файлов, например m3d=5,a3d=1,cdw=3')
+    parser.add_argument('--min-size', type=int, default=1024, help='минимальный размер файла, байт')
+    parser.add_argument('--max-size', type=int, default=64 * 1024, help='максимальный размер файла, байт')
+    parser.add_argument('--changes', type=int, default=20, help='количество измененных файлов для инкрементальной синхронизации')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='файл JSON для результатов')
+    parser.add_argument('--baseline', default=None, help='файл JSON с предыдущими результатами для сравнения')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='допустимое замедление относительно --baseline')
+    parser.add_argument('--verbose', action='store_true', help='показывать вывод NerpaSync')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='nerpasync_sync_')
+    project_path = os.path.join(work_dir, 'share', 'Проект').replace('\\', '/')
+    os.makedirs(project_path)
+    try:
+        generator = ProjectGenerator(args.depth, args.fanout, args.files, parse_mix(args.mix),
+                                     args.min_size, args.max_size, args.seed)
+        project = generator.generate(project_path)
+        print('Проект: папок {}, файлов {}, {:.1f} МБ'.format(
+            project.directories, project.files, project.bytes / 1024.0 / 1024.0))
+        stub_environment(work_dir, project_path)
+
+        timings = Timings(args.verbose)
+        cad_db = CADFolderDB()
+        timings.measure('update_project', cad_db.update_project)
+        timings.measure('update_project (без изменений)', cad_db.update_project, project_path)
+        cad_db.common_root = timings.measure('get_common_network_root', cad_db.get_common_network_root)
+        timings.measure('sync_to_local (первая)', cad_db.sync_to_local)
+        timings.measure('sync_to_local (без изменений)', cad_db.sync_to_local)
+
+        generator.modify(project_path, args.changes)
+        timings.measure('update_project (изменения)', cad_db.update_project, project_path)
+        timings.measure('sync_to_local (изменения)', cad_db.sync_to_local)
+
+        timings.measure('дерево (первый уровень)', build_tree_data, True)
+        timings.measure('дерево (все записи)', build_tree_data, False)
+
+        report = {
+            'date': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'parameters': vars(args),
+            'project': project._asdict(),
+            'results': timings.results,
+        }
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+            print('Результаты записаны в {}'.format(args.output))
+
+        regressions = []
+        if args.baseline:
+            regressions = compare(timings.results, args.baseline, args.tolerance)
+            if regressions:
+                print('Замедление больше x{}: {}'.format(args.tolerance, ', '.join(regressions)))
+    finally:
+        connections.close_all()
+        restore_write_access(work_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import logging
+from collections import deque
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+import tkinter as tk
+
+from src.ConnectionModule import get_vault_dir
+
+
+# Интервал вывода накопленных сообщений в виджет, мс
+LOG_INTERVAL = 100
+# Размер кольцевого буфера сообщений. При переполнении старые сообщения
+# отбрасываются, а в журнал выводится количество пропущенных
+LOG_BUFFER_SIZE = 10000
+# Количество строк, которое хранит виджет журнала
+MAX_WIDGET_LINES = 2000
+# Размер файла журнала и количество архивных файлов
+LOG_FILE_SIZE = 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
+
+def get_log_path():
+    '''
+    Путь к файлу журнала в локальном хранилище пользователя
+    '''
+    return os.path.join(get_vault_dir(), 'logs', 'NerpaSync.log')
+
+
+class LogBuffer:
+    '''
+    Потокобезопасный кольцевой буфер строк журнала
+    '''
+    def __init__(self, size=LOG_BUFFER_SIZE):
+        self.lines = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def append(self, line):
+        with self.lock:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped += 1
+            self.lines.append(line)
+
+    def drain(self):
+        '''
+        Возвращает накопленные строки и очищает буфер
+        '''
+        with self.lock:
+            lines = list(self.lines)
+            self.lines.clear()
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            lines.insert(0, '... пропущено сообщений: {}'.format(dropped))
+        return lines
+
+
+class LogFile:
+    '''
+    Файл журнала с ротацией по размеру. Строки записываются пакетами
+    '''
+    def __init__(self, path, max_bytes=LOG_FILE_SIZE, backup_count=LOG_BACKUP_COUNT):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count,
+                                           encoding='utf-8', delay=True)
+        self.handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger = logging.getLogger('NerpaSync.{}'.format(path))
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+
+    def write_lines(self, lines):
+        self.logger.info('\n'.join(lines))
+
+    def close(self):
+        self.logger.removeHandler(self.handler)
+        self.handler.close()
+
+
+class LogSink:
+    '''
+    Замена sys.stdout для вывода print в журнал. print вызывается и из рабочих
+    потоков, а Tk допускает обращения к виджетам только из главного потока,
+    поэтому write() только добавляет строку в кольцевой буфер. Раз в interval мс
+    накопленные строки одним пакетом записываются в файл журнала и в виджет,
+    в котором остается не больше max_lines последних строк.
+    Входные параметры:
+    text_widget - текстовый виджет журнала
+    log_path - файл журнала (None - без записи в файл)
+    '''
+    def __init__(self, text_widget, log_path=None, interval=LOG_INTERVAL, max_lines=MAX_WIDGET_LINES):
+        self.text_widget = text_widget
+        self.interval = interval
+        self.max_lines = max_lines
+        self.buffer = LogBuffer()
+        self.widget_lines = 0
+        self.log_file = None
+        if log_path:
+            try:
+                self.log_file = LogFile(log_path)
+            except OSError as e:
+                self.buffer.append(self.format_line('Ошибка открытия файла журнала: {}'.format(e)))
+        self.text_widget.after(self.interval, self.flush_messages)
+
+    def format_line(self, message):
+        current_time = datetime.now().strftime("%H:%M:%S")
+        return "{}: {}".format(current_time, message)
+
+    def write(self, message):
+        message = message.strip()
+        if message:
+            self.buffer.append(self.format_line(message))
+
+    def flush_messages(self):
+        if self.text_widget is None:
+            return
+        lines = self.buffer.drain()
+        if lines:
+            self.write_file(lines)
+            self.write_widget(lines)
+        self.text_widget.after(self.interval, self.flush_messages)
+
+    def write_file(self, lines):
+        if self.log_file is None:
+            return
+        try:
+            self.log_file.write_lines(lines)
+        except Exception:
+            pass
+
+    def write_widget(self, lines):
+        lines = lines[-self.max_lines:]
+        # Добавляем текст в виджет, удаляем лишние строки сверху и прокручиваем вниз
+        self.text_widget.insert(tk.END, '\n'.join(lines) + '\n')
+        # сообщение может состоять из нескольких строк текста
+        self.widget_lines += sum(line.count('\n') + 1 for line in lines)
+        if self.widget_lines > self.max_lines:
+            self.text_widget.delete('1.0', '{}.0'.format(self.widget_lines - self.max_lines + 1))
+            self.widget_lines = self.max_lines
+        self.text_widget.yview(tk.END)
+
+    def flush(self):
+        # Необходимо для совместимости с файловым интерфейсом
+        pass
+
+    def close(self):
+        '''
+        Запись оставшихся сообщений в файл при закрытии окна
+        '''
+        self.text_widget = None
+        lines = self.buffer.drain()
+        if lines:
+            self.write_file(lines)
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
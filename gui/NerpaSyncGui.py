@@ -2,39 +2,103 @@
 
 import os
 import sys
+import bisect
 import sqlite3
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
+from tkinter import ttk, messagebox, scrolledtext, filedialog
 import queue
-from datetime import datetime
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
 # Добавляем корневую директорию проекта в sys.path
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
+from .LogModule import LogSink, get_log_path
 from .WindowModule import (Window, k3DMakerWindow,
                             FolderMakerWindow, CreateCopyWindow)
-from src.DBMngModule import CADFolderDB
-from src.KompasEventsHandler import KompasFrameHandler
-from src.KompasUtility import OpenDoc, k2DMaker
+from src.DBMngModule import CADFolderDB, SQL_VARIABLES_LIMIT, get_project_meta
+from src.SyncModule import SyncPlanner, SyncScope
+from src.KompasEventsHandler import KompasFrameHandler, DocumentEvent
+from src.KompasUtility import OpenDoc, k2DMaker, init_com_thread, release_com_thread
+from src.JobModule import JobRunner
+from src.DeltaModule import remove_signature
+from src.ReplicaModule import replica
+from src.ConnectionModule import connections, get_main_db_path, get_user_db_path
 from getpass import getuser
 
-class RedirectText:
-    def __init__(self, text_widget):
-        self.text_widget = text_widget
-
-    def write(self, message):
-        if message.strip():
-            current_time = datetime.now().strftime("%H:%M:%S")
-            input_message = "{}: {}".format(current_time, message.strip())
-            # Добавляем текст в виджет и прокручиваем вниз
-            self.text_widget.insert(tk.END, input_message+ '\n')
-            self.text_widget.yview(tk.END)
-            
-    def flush(self):
-        # Необходимо для совместимости с файловым интерфейсом
-        pass
+class DocumentIndex:
+    '''
+    Индекс документов проекта для обработки событий КОМПАС без обращения к дереву.
+    Сопоставляет имя файла и полный локальный путь с сетевым путем и статусом.
+    Входные параметры:
+    to_local_path - функция, возвращающая локальный путь по сетевому (или None)
+    '''
+    def __init__(self, to_local_path=None):
+        self.to_local_path = to_local_path
+        # {сетевой путь: (имя, статус)}
+        self.documents = {}
+        # {имя: множество сетевых путей}
+        self.names = {}
+        # {локальный путь: сетевой путь}
+        self.local_paths = {}
+
+    def _local_key(self, local_path):
+        return os.path.normcase(os.path.normpath(local_path))
+
+    def set(self, network_path, name, status):
+        self.remove(network_path)
+        self.documents[network_path] = (name, status)
+        self.names.setdefault(name, set()).add(network_path)
+        local_path = self.to_local_path(network_path) if self.to_local_path else None
+        if local_path:
+            self.local_paths[self._local_key(local_path)] = network_path
+
+    def remove(self, network_path):
+        document = self.documents.pop(network_path, None)
+        if document is None:
+            return
+        paths = self.names.get(document[0])
+        if paths is not None:
+            paths.discard(network_path)
+            if not paths:
+                del self.names[document[0]]
+        local_path = self.to_local_path(network_path) if self.to_local_path else None
+        if local_path:
+            self.local_paths.pop(self._local_key(local_path), None)
+
+    def load(self, rows):
+        '''
+        Заполняет индекс строками (name, network_path, status, type, last_modified)
+        '''
+        self.documents = {}
+        self.names = {}
+        self.local_paths = {}
+        self.update([row[1] for row in rows], dict((row[1], row) for row in rows))
+
+    def update(self, paths, rows):
+        '''
+        Обновляет индекс для путей paths: пути, отсутствующие в rows, удаляются
+        '''
+        for path in paths:
+            row = rows.get(path)
+            if row is None or row[3] != 'file':
+                self.remove(path)
+            else:
+                self.set(path, row[0], row[2])
+
+    def find(self, document):
+        '''
+        Поиск документа по полному локальному пути или по имени файла.
+        Возвращает (сетевой путь, имя, статус) или None
+        '''
+        network_path = self.local_paths.get(self._local_key(document))
+        if network_path is None:
+            paths = self.names.get(os.path.basename(document))
+            if not paths:
+                return None
+            network_path = min(paths)
+        name, status = self.documents[network_path]
+        return network_path, name, status
 
 class InitProject:
     def __init__(self) -> None:
@@ -44,12 +108,14 @@ class InitProject:
         CADFolderDB().update_project()
 
 class NerpaSyncMain(Window):
+    # Ленивое дерево проекта: при запуске загружаются только папки верхнего уровня,
+    # содержимое папки загружается из БД при ее раскрытии
+    lazy_tree = True
+
     def __init__(self) -> None:
         super().__init__()
-        self.db_path = project_root+'\\databases\\CADFolder.db'
-        try:
-            self.last_modified_time = os.path.getmtime(self.db_path)
-        except:
+        self.db_path = get_main_db_path()
+        if not os.path.exists(self.db_path):
             print('Отсутсвует база данных проекта. Выберите папку с проектом')
             InitProject()
 
@@ -57,11 +123,16 @@ class NerpaSyncMain(Window):
         self.main_root.title('NerpaSync')
         self.main_root.resizable(False, False)
 
-        self.last_modified_time = os.path.getmtime(self.db_path)
+        # Номер изменения локальной копии БД, уже обработанного проверкой изменений
+        self.db_revision = replica.revision
         self.kompas_handler_running = True  # Флаг для управления потоком
 
         self.user_name = getuser()  # Получаем имя текущего пользователя
-        self.user_db_path = project_root+'\\databases\\CADFolder_{}.db'.format(self.user_name)
+        self.user_db_path = get_user_db_path(self.user_name)
+
+        # Фоновое выполнение синхронизации, обновления проекта и регистрации файлов
+        self.jobs = JobRunner(thread_init=init_com_thread, thread_exit=release_com_thread,
+                              on_change=self.update_buttons_state)
         
         self.detail_ico = tk.PhotoImage(file=project_root+'\\pic\\detail_ico.gif')
         self.assy_ico = tk.PhotoImage(file=project_root+'\\pic\\assy_ico.gif')
@@ -91,6 +162,8 @@ class NerpaSyncMain(Window):
 
         # Запуск проверки очереди событий
         self.main_root.after(10, self.check_event_queue)
+        # Запуск обработки результатов фоновых операций
+        self.main_root.after(50, self.check_job_events)
         # Запуск периодической проверки изменений в БД
         self.main_root.after(1000, self.check_db_changes)
         
@@ -98,66 +171,107 @@ class NerpaSyncMain(Window):
         self.update_buttons_state()
         self.main_root.mainloop()
 
-    def check_db_changes(self):
-        try:
-            current_modified_time = os.path.getmtime(self.db_path)
-            last_user = self.cad_db.get_last_user()
-            if current_modified_time != self.last_modified_time and last_user != getuser():
-                print("База данных была изменена {}. Выполняется синхронизация".format(last_user))
-                self.last_modified_time = current_modified_time
-                self.on_database_change()
+    def check_job_events(self):
+        self.jobs.process_events()
+        self.main_root.after(50, self.check_job_events)
+
+    def run_job(self, name, func, args=(), resources=('project',), on_done=None, cancellable=False):
+        '''
+        Запуск операции в фоновом потоке. Операции с общим ресурсом
+        не выполняются одновременно. После операции изменения главной БД
+        переносятся в локальную копию в том же фоновом потоке
+        '''
+        def task(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                replica.try_refresh()
+                replica.watcher.poke()
+
+        job = self.jobs.submit(name, task, args, resources=resources,
+                               on_done=on_done, cancellable=cancellable)
+        if job is None:
+            print('Операция "{}" не запущена: выполняется другая операция'.format(name))
+        return job
+
+    def refresh_treeview(self):
+        '''
+        Обновление дерева после записи в главную БД из главного потока (диалоги создания
+        и удаления документов). Изменения переносятся в локальную копию в фоновом потоке,
+        после чего дерево обновляется. Если идет проверка изменений БД, дерево обновит она
+        '''
+        replica.watcher.poke()
+        self.jobs.submit('Обновление дерева', replica.try_refresh, resources=('db_check',),
+                         on_done=self.on_job_done)
+
+    def cancel_jobs(self):
+        self.jobs.cancel()
+        print('Запрошена отмена операции')
 
-        except Exception as e:
-            print("Ошибка при проверке изменений в БД: {}".format(e))
+    def check_db_changes(self):
+        # Проверка выполняется в фоновом потоке: файл поколения БД находится на сетевом диске
+        self.jobs.submit('Проверка изменений БД', self.get_db_changes, resources=('db_check',),
+                         on_done=self.on_db_changes_checked, on_error=self.on_db_check_error)
+
+        # Интервал проверки растет при простое и сбрасывается после изменений и действий пользователя
+        self.main_root.after(int(replica.watcher.interval * 1000), self.check_db_changes)
+
+    def get_db_changes(self):
+        '''
+        Переносит изменения главной БД в локальную копию, если изменилось поколение БД.
+        Возвращает (номер изменения копии, последний пользователь), если БД изменилась
+        '''
+        replica.poll()
+        revision = replica.revision
+        if revision == self.db_revision:
+            return None
+        return revision, self.cad_db.get_last_user()
+
+    def on_db_changes_checked(self, result):
+        if result is None:
+            return
+        revision, last_user = result
+        if last_user == getuser():
+            # собственные изменения уже в локальной копии, дерево обновляется без синхронизации
+            self.db_revision = revision
+            self.update_treeview()
+        elif not self.jobs.is_busy('project'):
+            print("База данных была изменена {}. Выполняется синхронизация".format(last_user))
+            self.db_revision = revision
+            self.on_database_change()
 
-        # Повторяем проверку через 1 секунду
-        self.main_root.after(1000, self.check_db_changes)
+    def on_db_check_error(self, e):
+        print("Ошибка при проверке изменений в БД: {}".format(e))
 
     def on_database_change(self):
         # Здесь вызывается функция, которую нужно выполнить при изменении БД
-        self.cad_db.sync_to_local()
-        self.update_treeview()
+        self.sync_network_to_local()
 
     def check_event_queue(self):
         while not self.event_queue.empty():
             message = self.event_queue.get_nowait()
-            # Обрабатываем сообщения о документах
-            if isinstance(message, str):
-                doc_name = message
-                self.handle_document_status(doc_name)
+            # Обрабатываем события документов, строки - сообщения об ошибках монитора
+            if isinstance(message, DocumentEvent):
+                replica.watcher.poke()
+                if message.kind == 'activate':
+                    self.handle_document_status(message.path or message.name)
+            elif isinstance(message, str):
+                print(message)
 
         self.main_root.after(100, self.check_event_queue)
 
     def handle_document_status(self, doc_name):
-        # Проверка наличия документа в TreeView
-        for item in self.tree.get_children():
-            node = self._find_node_by_text(item, doc_name)
-            if node:
-                item_values = self.tree.item(node, "values")
-                status = item_values[0] if item_values else ""
-                if status == "Зарегистрирован":
-                    response = messagebox.askyesno(
-                        "Разрегистрация документа",
-                        "Документ '{}' зарегистрирован. Хотите разрегистрировать его?".format(doc_name)
-                    )
-                    if response:
-                        self.cad_db.update_file_status(doc_name, "unregister")
-                        self.update_treeview()
-                        self.cad_db.update_last_user()
-
-                break
-            
-    def _find_node_by_text(self, item, text):
-        """
-        Рекурсивно находит узел по тексту.
-        """
-        if self.tree.item(item, 'text') == text:
-            return item
-        for child in self.tree.get_children(item):
-            result = self._find_node_by_text(child, text)
-            if result:
-                return result
-        return None
+        # Поиск документа в индексе документов проекта
+        document = self.doc_index.find(doc_name)
+        if document:
+            network_path, file_name, status = document
+            if status == "Зарегистрирован":
+                response = messagebox.askyesno(
+                    "Разрегистрация документа",
+                    "Документ '{}' зарегистрирован. Хотите разрегистрировать его?".format(file_name)
+                )
+                if response:
+                    self.change_file_status(file_name, "unregister")
 
     def init_frames(self):
         self.frames = {
@@ -179,8 +293,9 @@ class NerpaSyncMain(Window):
         self.log_text.grid(row=0, column=0, sticky='nsew')
 
     def redirect_stdout(self):
-        # Перенаправляем вывод print в текстовый виджет
-        sys.stdout = RedirectText(self.log_text)
+        # Перенаправляем вывод print в текстовый виджет и файл журнала
+        self.log_sink = LogSink(self.log_text, get_log_path())
+        sys.stdout = self.log_sink
 
     def create_tree_view(self):
         self.tree = ttk.Treeview(self.frames['treeview'])
@@ -196,171 +311,399 @@ class NerpaSyncMain(Window):
 
         # Привязываем событие на изменение выделения в TreeView
         self.tree.bind("<<TreeviewSelect>>", self.on_treeview_select)
+        # Загрузка содержимого папки при ее раскрытии
+        self.tree.bind("<<TreeviewOpen>>", self.on_treeview_open)
+
+        self.init_tree_state()
+
+    def init_tree_state(self):
+        # Соответствие сетевого пути и элемента дерева
+        self.tree_index = {}
+        self.tree_paths = {}
+        # Строки БД, отображаемые в дереве: {сетевой путь: строка}
+        self.tree_rows = {}
+        # Папки, содержимое которых еще не загружено: {элемент папки: элемент-заглушка}
+        self.tree_dummies = {}
+        self.tree_root = ''
+        # Номер последнего изменения change_log, учтенного в дереве
+        self.tree_seq = None
+        # Индекс документов для событий КОМПАС
+        self.doc_index = DocumentIndex(self.get_document_local_path)
+
+    def get_document_local_path(self, network_path):
+        cad_db = getattr(self, 'cad_db', None)
+        if cad_db is None or not cad_db.common_root:
+            return None
+        return SyncPlanner(cad_db.common_root, cad_db.get_local_root()).to_local_path(network_path)
 
     def get_data_to_tree(self):
-        conn = sqlite3.connect(os.path.join(project_root, 'databases', 'CADFolder.db'))
-        cursor = conn.cursor()
+        with connections.transaction(replica.path()) as cursor:
+            cursor.execute('''SELECT name,
+                              network_path,
+                              status,
+                              type,
+                              last_modified
+                              FROM file_structure ORDER BY network_path''')
+            tree_data = cursor.fetchall()
+
+        return tree_data
 
+    def get_tree_root(self, cursor):
+        '''
+        Корень проекта на сетевом диске из таблицы project_meta
+        '''
+        return get_project_meta(cursor, 'root', '')
+
+    def get_tree_children(self, cursor, parent_path):
+        '''
+        Непосредственное содержимое папки parent_path.
+        Выборка идет по диапазону индекса network_path: все пути внутри папки
+        лежат между 'папка/' и 'папка0' ('0' - следующий символ после '/')
+        '''
         cursor.execute('''SELECT name,
                           network_path,
                           status,
-                          type, 
-                          last_modified 
-                          FROM file_structure ORDER BY network_path''')
-        
-        tree_data = cursor.fetchall()
-        conn.close()
-        
-        return tree_data
+                          type,
+                          last_modified
+                          FROM file_structure
+                          WHERE network_path > ? AND network_path < ?
+                          AND substr(network_path, ?) NOT LIKE '%/%'
+                          ORDER BY network_path''',
+                       (parent_path + '/', parent_path + '0', len(parent_path) + 2))
+        return cursor.fetchall()
+
+    def get_document_rows(self, cursor):
+        cursor.execute('''SELECT name, network_path, status, type, last_modified
+                       FROM file_structure WHERE type = "file"''')
+        return cursor.fetchall()
+
+    def get_tree_sequence(self, cursor):
+        '''
+        Возвращает (MIN(seq), MAX(seq)) журнала изменений главной БД
+        '''
+        try:
+            cursor.execute('SELECT MIN(seq), MAX(seq) FROM change_log')
+            return cursor.fetchone()
+        except sqlite3.Error:
+            # БД еще не обновлена до версии с журналом изменений
+            return None, None
+
+    def get_changed_tree_rows(self, cursor, last_seq):
+        '''
+        Строки file_structure для путей, измененных после изменения last_seq.
+        Возвращает (пути, {путь: строка}), удаленные пути в словарь не попадают
+        '''
+        cursor.execute('SELECT DISTINCT network_path FROM change_log WHERE seq > ?', (last_seq,))
+        changed_paths = [row[0] for row in cursor.fetchall()]
+        rows = {}
+        for i in range(0, len(changed_paths), SQL_VARIABLES_LIMIT):
+            chunk = changed_paths[i:i + SQL_VARIABLES_LIMIT]
+            cursor.execute('''SELECT name, network_path, status, type, last_modified
+                           FROM file_structure WHERE network_path IN ({})'''.format(
+                               ', '.join('?' * len(chunk))), chunk)
+            for row in cursor.fetchall():
+                rows[row[1]] = row
+        return changed_paths, rows
+
+    def get_tree_image(self, name, item_type):
+        if item_type == 'directory':
+            return self.folder_ico
+        return {'.m3d': self.detail_ico, '.a3d': self.assy_ico, '.cdw': self.draw_ico}.get(name[-4:])
+
+    def get_tree_parent(self, network_path):
+        '''
+        Элемент дерева, в который должна попасть запись network_path.
+        None, если родительская папка не отображается или ее содержимое еще не загружено
+        '''
+        parent_path = network_path.rsplit('/', 1)[0]
+        if parent_path == self.tree_root:
+            return ''
+        parent_id = self.tree_index.get(parent_path)
+        if parent_id is None or parent_id in self.tree_dummies:
+            return None
+        return parent_id
+
+    def insert_tree_item(self, parent_id, row, index='end'):
+        '''
+        Добавляет в дерево запись из БД. В ленивом режиме у папки создается
+        элемент-заглушка, чтобы была видна стрелка раскрытия
+        '''
+        name, network_path, status, item_type, last_modified = row
+        image = self.get_tree_image(name, item_type)
+        options = {'text': name}
+        if item_type != 'directory':
+            options['values'] = (status, last_modified)
+        if image is not None:
+            options['image'] = image
+        tree_id = self.tree.insert(parent_id, index, **options)
+        if item_type == 'directory' and self.lazy_tree:
+            self.tree_dummies[tree_id] = self.tree.insert(tree_id, 'end', text='')
+        self.tree_index[network_path] = tree_id
+        self.tree_paths[tree_id] = network_path
+        self.tree_rows[network_path] = row
+        return tree_id
+
+    def insert_tree_item_sorted(self, parent_id, row):
+        '''
+        Добавляет запись среди уже отображаемых элементов с сохранением порядка по пути
+        '''
+        sibling_paths = [self.tree_paths[tree_id] for tree_id in self.tree.get_children(parent_id)
+                         if tree_id in self.tree_paths]
+        return self.insert_tree_item(parent_id, row, bisect.bisect(sibling_paths, row[1]))
+
+    def remove_tree_item(self, network_path):
+        '''
+        Удаляет элемент и все вложенные элементы из дерева и из индекса
+        '''
+        tree_id = self.tree_index.get(network_path)
+        if tree_id is None:
+            return
+        self.tree.delete(tree_id)
+        prefix = network_path + '/'
+        for path in [path for path in self.tree_index if path == network_path or path.startswith(prefix)]:
+            removed_id = self.tree_index.pop(path)
+            self.tree_paths.pop(removed_id, None)
+            self.tree_dummies.pop(removed_id, None)
+            self.tree_rows.pop(path, None)
+
+    def apply_tree_rows(self, paths, rows):
+        '''
+        Применяет к дереву актуальные строки БД для путей paths:
+        добавляет новые, обновляет измененные и удаляет отсутствующие в rows.
+        Остальные элементы дерева, их раскрытие и выделение не затрагиваются
+        '''
+        # сортировка по пути: родительские папки обрабатываются раньше вложенных
+        for path in sorted(set(paths)):
+            row = rows.get(path)
+            old_row = self.tree_rows.get(path)
+            if row is None:
+                self.remove_tree_item(path)
+            elif old_row is None:
+                parent_id = self.get_tree_parent(path)
+                if parent_id is not None:
+                    self.insert_tree_item_sorted(parent_id, row)
+            elif old_row != row:
+                if old_row[3] != row[3]:
+                    # изменился тип записи: элемент создается заново
+                    parent_id = self.get_tree_parent(path)
+                    self.remove_tree_item(path)
+                    if parent_id is not None:
+                        self.insert_tree_item_sorted(parent_id, row)
+                else:
+                    if row[3] != 'directory':
+                        self.tree.item(self.tree_index[path], values=(row[2], row[4]))
+                    self.tree_rows[path] = row
+
+    def load_tree_children(self, tree_id):
+        '''
+        Загружает содержимое папки, если оно еще не загружено
+        '''
+        dummy_id = self.tree_dummies.pop(tree_id, None)
+        if dummy_id is None:
+            return
+        self.tree.delete(dummy_id)
+        with connections.transaction(replica.path()) as cursor:
+            rows = self.get_tree_children(cursor, self.tree_paths[tree_id])
+        for row in rows:
+            self.insert_tree_item(tree_id, row)
+
+    def on_treeview_open(self, event):
+        self.load_tree_children(self.tree.focus())
+
+    def clear_treeview(self):
+        self.tree.delete(*self.tree.get_children())
+        self.init_tree_state()
+
+    def load_treeview(self):
+        '''
+        Заполняет пустое дерево. В ленивом режиме загружаются только
+        папки и файлы верхнего уровня, иначе - все записи БД
+        '''
+        with connections.transaction(replica.path()) as cursor:
+            # номер изменения читается до данных: изменения, сделанные во время чтения,
+            # будут применены повторно при следующем обновлении
+            tree_seq = self.get_tree_sequence(cursor)[1] or 0
+            root_path = self.get_tree_root(cursor)
+            if self.lazy_tree:
+                rows = self.get_tree_children(cursor, root_path) if root_path else []
+            doc_rows = self.get_document_rows(cursor)
+        if not self.lazy_tree:
+            rows = self.get_data_to_tree() if root_path else []
+
+        self.tree_root = root_path
+        self.tree_seq = tree_seq
+        self.populate_treeview(rows)
+        self.doc_index.load(doc_rows)
 
     def populate_treeview(self, data):
         """
         Добавляет элементы в TreeView, начиная с общей конечной папки для всех элементов.
+        Строки должны быть отсортированы по network_path
         """
-        tree_items = {}
-
-        # Общая папку для всех путей
-        common_path = None
-        all_paths = [item[1].split('/') for item in data]
-
-        for path_parts in all_paths:
-            if common_path is None:
-                common_path = path_parts  # Первая итерация, берем первую строку как основу
-            else:
-                # Сравниваем поэлементно с предыдущей общей частью
-                common_path = [p1 for p1, p2 in zip(common_path, path_parts) if p1 == p2]
-
-        if not common_path:
-            return  # Если нет общей папки, выход
-
-        # Преобразуем общую часть в строку пути
-        common_path_str = '/'.join(common_path)
-
-        # проход по элементам данных и добавлять их после общей папки
-        for item in data:
-            name, network_path, status, item_type, last_modified = item
-            path_parts = network_path.split('/')
-
-            # Пропускаем элементы, не включающие общую папку
-            if not network_path.startswith(common_path_str):
-                continue
-
-            # Начинаем добавлять элементы после общей папки
-            parent = ''
-            start_index = len(common_path)
-            for i, part in enumerate(path_parts[start_index:], start=start_index):
-                current_path = '/'.join(path_parts[:i + 1])
-
-                if current_path not in tree_items:
-                    parent_id = tree_items.get(parent, '')
-                    if i == len(path_parts) - 1:
-                        # Добавляем файл или папку, которая идет после общей папки
-                        if item_type == "directory":
-                            tree_id = self.tree.insert(parent_id, 'end', text=part, 
-                                                    image=self.folder_ico)
-                        else:
-                            extension = part[-4:]
-                            if extension == '.m3d':
-                                tree_id = self.tree.insert(parent_id, 'end', text=part,
-                                                    values=(status, last_modified),
-                                                    image=self.detail_ico)
-                            elif extension == '.a3d':
-                                tree_id = self.tree.insert(parent_id, 'end', text=part,
-                                                    values=(status, last_modified),
-                                                    image=self.assy_ico)
-                            elif extension == '.cdw':
-                                tree_id = self.tree.insert(parent_id, 'end', text=part,
-                                                    values=(status, last_modified),
-                                                    image=self.draw_ico)
-                            else:
-                                tree_id = self.tree.insert(parent_id, 'end', text=part,
-                                                        values=(status, last_modified)
-                                                        )
-                    else:
-                        # Добавляем промежуточные директории
-                        tree_id = self.tree.insert(parent_id, 'end', text=part, 
-                                                image=self.folder_ico)
-                    tree_items[current_path] = tree_id
-                parent = current_path
+        for row in data:
+            # Пропускаем элементы вне общей папки и элементы, папка которых не отображается
+            parent_id = self.get_tree_parent(row[1])
+            if parent_id is not None:
+                self.insert_tree_item(parent_id, row)
+
+    def get_loaded_tree_rows(self, cursor):
+        '''
+        Актуальные строки БД для всех отображаемых в дереве папок
+        '''
+        if not self.lazy_tree:
+            cursor.execute('''SELECT name, network_path, status, type, last_modified
+                           FROM file_structure''')
+            return dict((row[1], row) for row in cursor.fetchall())
+        rows = {}
+        loaded_paths = [self.tree_root] + [path for path, tree_id in self.tree_index.items()
+                                           if self.tree_rows[path][3] == 'directory'
+                                           and tree_id not in self.tree_dummies]
+        for path in loaded_paths:
+            for row in self.get_tree_children(cursor, path):
+                rows[row[1]] = row
+        return rows
 
     def update_treeview(self):
         """
-        Обновляет содержимое Treeview, очищая его и заполняя заново.
-        """
-        # Сохранение состояния открытых узлов
-        open_nodes = {}
-
-        def save_state(node):
-            item = self.tree.item(node)
-            # Сохраняем состояние узла по тексту
-            if 'text' in item:
-                open_nodes[item['text']] = item['open']
-            for child in self.tree.get_children(node):
-                save_state(child)
-
-        # Сохраняем состояние корневых узлов
-        for node in self.tree.get_children():
-            save_state(node)
-
-        # Очистка Treeview
-        self.tree.delete(*self.tree.get_children())
-
-        # Получение данных и заполнение Treeview
-        tree_data = self.get_data_to_tree()
-        self.populate_treeview(tree_data)
-
-        # Восстановление состояния узлов
-        def restore_state():
-            for text, should_open in open_nodes.items():
-                node = self.find_node_by_text(text)
-                if node:
-                    self.tree.item(node, open=should_open)
-                
-        restore_state()
-
-    def find_node_by_text(self, text):
+        Обновляет содержимое Treeview. Из БД читаются только пути,
+        измененные с прошлого обновления (по журналу change_log), и в дереве
+        добавляются, изменяются и удаляются только соответствующие элементы.
+        Если журнал недоступен или обрезан, сравниваются все отображаемые папки.
+        Дерево строится заново, только если изменилась общая папка проекта.
+        Данные читаются из локальной копии главной БД без ее обновления:
+        изменения переносит фоновая проверка (check_db_changes)
         """
-        Находит узел по тексту в Treeview.
-        """
-        def search_nodes(node):
-            item = self.tree.item(node)
-            if 'text' in item and item['text'] == text:
-                return node
-            for child in self.tree.get_children(node):
-                result = search_nodes(child)
-                if result:
-                    return result
-            return None
-        # Проверяем корневые узлы
-        for node in self.tree.get_children():
-            result = search_nodes(node)
-            if result:
-                return result
-        return None
+        with connections.transaction(replica.path()) as cursor:
+            min_seq, max_seq = self.get_tree_sequence(cursor)
+            root_path = self.get_tree_root(cursor)
+            if self.tree_seq is None or root_path != self.tree_root:
+                rebuild = True
+            else:
+                rebuild = False
+                doc_rows = None
+                if max_seq is not None and min_seq <= self.tree_seq + 1:
+                    paths, rows = self.get_changed_tree_rows(cursor, self.tree_seq)
+                else:
+                    rows = self.get_loaded_tree_rows(cursor)
+                    paths = set(rows) | set(self.tree_rows)
+                    doc_rows = self.get_document_rows(cursor)
+
+        if rebuild:
+            self.rebuild_treeview()
+            return
+
+        self.apply_tree_rows(paths, rows)
+        if doc_rows is None:
+            self.doc_index.update(paths, rows)
+        else:
+            self.doc_index.load(doc_rows)
+        self.tree_seq = max_seq or 0
+
+    def rebuild_treeview(self):
+        '''
+        Строит дерево заново, восстанавливая раскрытые папки и выделение
+        '''
+        open_paths = [path for path, tree_id in self.tree_index.items()
+                      if self.tree.item(tree_id, 'open')]
+        selected_paths = [self.tree_paths[tree_id] for tree_id in self.tree.selection()
+                          if tree_id in self.tree_paths]
+
+        self.clear_treeview()
+        self.load_treeview()
+
+        # родительские папки раскрываются раньше вложенных
+        for path in sorted(open_paths):
+            tree_id = self.tree_index.get(path)
+            if tree_id is not None:
+                self.load_tree_children(tree_id)
+                self.tree.item(tree_id, open=True)
+        selection = [self.tree_index[path] for path in selected_paths if path in self.tree_index]
+        if selection:
+            self.tree.selection_set(selection)
+
+    def on_job_done(self, result):
+        self.update_treeview()
 
     def sync_network_to_local(self):
-        self.cad_db.sync_to_local()
-        self.update_treeview()
+        self.run_job('Синхронизация', self.cad_db.sync_to_local,
+                     on_done=self.on_job_done, cancellable=True)
         
     def update_cad_folder(self):
-        self.cad_db.update_project()
-        self.update_treeview()
+        # Диалог выбора папки открывается в главном потоке, обход проекта - в фоновом
+        project_path = filedialog.askdirectory()
+        if not project_path:
+            print('Путь к проекту не выбран')
+            return
+        self.run_job('Обновление проекта', self.cad_db.update_project, (project_path,),
+                     on_done=self.on_job_done, cancellable=True)
+
+    def set_file_status(self, file_name, action):
+        self.cad_db.update_file_status(file_name, action)
+        self.cad_db.update_last_user()
+
+    def change_file_status(self, file_name, action):
+        self.run_job('Изменение статуса {}'.format(file_name), self.set_file_status,
+                     (file_name, action), on_done=self.on_job_done)
 
     def unregister_file(self):
         selected_item = self.tree.selection()
         if selected_item:
             file_name = self.tree.item(selected_item)["text"]
-            self.cad_db.update_file_status(file_name, "unregister")
-            self.update_treeview()
-            self.cad_db.update_last_user()
+            self.change_file_status(file_name, "unregister")
 
     def register_file(self):
         selected_item = self.tree.selection()
         if selected_item:
             file_name = self.tree.item(selected_item)["text"]
-            self.cad_db.update_file_status(file_name, "register")
-            self.update_treeview()
-            self.cad_db.update_last_user()
+            self.change_file_status(file_name, "register")
+
+    def get_selected_path(self):
+        selected_item = self.tree.selection()
+        if selected_item:
+            return self.tree_paths.get(selected_item[0])
+        return None
+
+    def add_sync_rule(self):
+        '''
+        Добавляет выбранную папку или файл в выборочную синхронизацию и запускает синхронизацию
+        '''
+        network_path = self.get_selected_path()
+        if network_path is None:
+            return
+        rules = self.cad_db.load_sync_rules()
+        if SyncScope(rules).covers(network_path):
+            print('{} уже входит в выборочную синхронизацию'.format(network_path))
+            return
+        rules = rules + [network_path]
+        removed = self.cad_db.count_unselected(rules)
+        if not messagebox.askyesno(
+                "Выборочная синхронизация",
+                "В локальном хранилище останутся только выбранные папки и файлы.\n"
+                "Будет удалено локальных копий файлов: {}. Продолжить?".format(removed)):
+            return
+        self.cad_db.set_sync_rules(rules)
+        print('Добавлено в выборочную синхронизацию: {}'.format(network_path))
+        self.sync_network_to_local()
+
+    def remove_sync_rule(self):
+        '''
+        Убирает выбранную папку или файл из выборочной синхронизации. Локальные копии
+        удаляются при синхронизации, кроме разрегистрированных файлов
+        '''
+        network_path = self.get_selected_path()
+        if network_path is None:
+            return
+        rules = self.cad_db.load_sync_rules()
+        if network_path not in rules:
+            print('{} не выбран для синхронизации'.format(network_path))
+            return
+        rules.remove(network_path)
+        self.cad_db.set_sync_rules(rules)
+        if rules:
+            print('Убрано из выборочной синхронизации: {}'.format(network_path))
+        else:
+            print('Выбранных папок не осталось: синхронизируется весь проект')
+        self.sync_network_to_local()
 
     def on_treeview_select(self, event):
         self.update_buttons_state()
@@ -377,6 +720,8 @@ class NerpaSyncMain(Window):
         self.delete_file_button.state(['disabled'])
         self.create_folder_button.state(['disabled'])
         self.create_copy_button.state(['disabled'])
+        self.add_sync_rule_button.state(['disabled'])
+        self.remove_sync_rule_button.state(['disabled'])
 
         if selected_item:
             item_values = self.tree.item(selected_item, "values")
@@ -402,6 +747,22 @@ class NerpaSyncMain(Window):
                 self.create_detail_button.state(['!disabled'])
                 self.create_folder_button.state(['!disabled'])
 
+        if self.get_selected_path() is not None:
+            self.add_sync_rule_button.state(['!disabled'])
+            self.remove_sync_rule_button.state(['!disabled'])
+
+        # Кнопки операций, которые выполняются в фоне, недоступны до их завершения
+        if self.jobs.is_busy('project'):
+            for button in [self.update_project_button, self.sync_button, self.register_button,
+                           self.unregister_button, self.delete_file_button,
+                           self.add_sync_rule_button, self.remove_sync_rule_button]:
+                button.state(['disabled'])
+            self.cancel_button.state(['!disabled'])
+        else:
+            self.update_project_button.state(['!disabled'])
+            self.sync_button.state(['!disabled'])
+            self.cancel_button.state(['disabled'])
+
     def do_nothing(self):
         pass
 
@@ -411,9 +772,7 @@ class NerpaSyncMain(Window):
             try:
                 item_name = self.tree.item(selected_item)['text']
                 item_status = self.tree.item(selected_item)['values'][0]
-                user_db = project_root + '\\databases\\CADFolder_{}.db'.format(self.user_name)
-                with sqlite3.connect(user_db) as user_conn:
-                    user_cursor = user_conn.cursor()
+                with connections.transaction(self.user_db_path) as user_cursor:
                     user_cursor.execute('''SELECT local_path FROM file_structure
                                         WHERE name = ?''', (item_name,))
                     local_path = user_cursor.fetchone()[0]
@@ -429,9 +788,8 @@ class NerpaSyncMain(Window):
         selected_item = self.tree.selection()
         if selected_item:
             dir_name = self.tree.item(selected_item)['text']
-            with sqlite3.connect(self.db_path) as conn, sqlite3.connect(self.user_db_path) as user_conn:
-                user_cursor = user_conn.cursor()
-                cursor = conn.cursor()
+            with connections.transaction(replica.path()) as cursor, \
+                    connections.transaction(self.user_db_path) as user_cursor:
                 cursor.execute('''SELECT network_path FROM file_structure
                                WHERE name = ? AND type = "directory"''',(dir_name,))
                 network_dir_path = cursor.fetchone()[0]
@@ -447,9 +805,8 @@ class NerpaSyncMain(Window):
         selected_item = self.tree.selection()
         if selected_item:
             dir_name = self.tree.item(selected_item)['text']
-            with sqlite3.connect(self.db_path) as conn, sqlite3.connect(self.user_db_path) as user_conn:
-                user_cursor = user_conn.cursor()
-                cursor = conn.cursor()
+            with connections.transaction(replica.path()) as cursor, \
+                    connections.transaction(self.user_db_path) as user_cursor:
                 cursor.execute('''SELECT network_path FROM file_structure
                                WHERE name = ? AND type = "directory"''',(dir_name,))
                 network_dir_path = cursor.fetchone()[0]
@@ -465,9 +822,8 @@ class NerpaSyncMain(Window):
         selected_item = self.tree.selection()
         if selected_item:
             source_file_name = self.tree.item(selected_item)['text']
-            with sqlite3.connect(self.db_path) as conn, sqlite3.connect(self.user_db_path) as user_conn:
-                user_cursor = user_conn.cursor()
-                cursor = conn.cursor()
+            with connections.transaction(replica.path()) as cursor, \
+                    connections.transaction(self.user_db_path) as user_cursor:
                 cursor.execute('''SELECT network_path FROM file_structure
                                WHERE name = ? AND type = "file"''',(source_file_name,))
                 network_source_path = cursor.fetchone()[0]
@@ -483,16 +839,14 @@ class NerpaSyncMain(Window):
         selected_item = self.tree.selection()
         if selected_item:
             dir_name = self.tree.item(selected_item)['text']
-            FolderMakerWindow(self.main_root, dir_name)
-            self.update_treeview()
+            FolderMakerWindow(self.main_root, dir_name, self)
 
     def create_copy(self):
         selected_item = self.tree.selection()
         if selected_item:
             source_file_name = self.tree.item(selected_item)['text']
-            with sqlite3.connect(self.db_path) as conn, sqlite3.connect(self.user_db_path) as user_conn:
-                user_cursor = user_conn.cursor()
-                cursor = conn.cursor()
+            with connections.transaction(replica.path()) as cursor, \
+                    connections.transaction(self.user_db_path) as user_cursor:
                 cursor.execute('''SELECT network_path FROM file_structure
                                WHERE name = ? AND type = "file"''',(source_file_name,))
                 network_source_path = cursor.fetchone()[0]
@@ -509,39 +863,40 @@ class NerpaSyncMain(Window):
         selected_item = self.tree.selection()
         if selected_item:
             object_name = self.tree.item(selected_item)['text']
-            with sqlite3.connect(self.db_path) as conn, sqlite3.connect(self.user_db_path) as user_conn:
-                user_cursor = user_conn.cursor()
-                cursor = conn.cursor()
+            with connections.transaction(replica.path()) as cursor, \
+                    connections.transaction(self.user_db_path) as user_cursor:
                 cursor.execute('''SELECT network_path FROM file_structure 
                                                    WHERE name = ? AND type="file"''',(object_name,))
                 network_file_path = cursor.fetchone()[0]
                 user_cursor.execute('''SELECT local_path FROM file_structure 
                                                    WHERE name = ? AND type="file"''',(object_name,))
                 local_file_path = user_cursor.fetchone()[0]
-                db_flag = False
-
-                try:
-                    #снятие "Только для чтения"
-                    os.chmod(local_file_path, 0o666)
-                    os.remove(local_file_path)
-                    os.chmod(network_file_path, 0o666)
-                    os.remove(network_file_path)
-                    db_flag = True
-                except Exception as e:
-                    print('Ошибка с удалением файла: {}'.format(e))
-                    return
+            db_flag = False
+
+            try:
+                #снятие "Только для чтения"
+                os.chmod(local_file_path, 0o666)
+                os.remove(local_file_path)
+                os.chmod(network_file_path, 0o666)
+                os.remove(network_file_path)
+                remove_signature(local_file_path)
+                remove_signature(network_file_path)
+                db_flag = True
+            except Exception as e:
+                print('Ошибка с удалением файла: {}'.format(e))
+                return
                 
-                try:
-                    if db_flag:
+            try:
+                if db_flag:
+                    with connections.transaction(self.db_path) as cursor, \
+                            connections.transaction(self.user_db_path) as user_cursor:
                         cursor.execute('''DELETE FROM file_structure WHERE name = ?''',(object_name,))
                         user_cursor.execute('''DELETE FROM file_structure WHERE name = ?''',(object_name,))
-                        user_conn.commit()
-                        conn.commit()
-                        self.update_treeview()
-                        print('Документ {} удален'.format(object_name))
-                except Exception as e:
-                    print('Ошибка с доступом к БД: {}'.format(e))
-                    return
+                    self.refresh_treeview()
+                    print('Документ {} удален'.format(object_name))
+            except Exception as e:
+                print('Ошибка с доступом к БД: {}'.format(e))
+                return
             
     def init_buttons(self):
         button_config = [
@@ -559,6 +914,12 @@ class NerpaSyncMain(Window):
              'command': self.open_doc, 'state': 'normal', 'row': 4, 'col': 0},
              {'text': 'Удалить файл', 'frame': 'manager',
              'command': self.delete_doc, 'state': 'normal', 'row': 5, 'col': 0},
+             {'text': 'Отменить операцию', 'frame': 'manager',
+             'command': self.cancel_jobs, 'state': 'disabled', 'row': 6, 'col': 0},
+             {'text': 'Синхронизировать выбранное', 'frame': 'manager',
+             'command': self.add_sync_rule, 'state': 'disabled', 'row': 7, 'col': 0},
+             {'text': 'Не синхронизировать выбранное', 'frame': 'manager',
+             'command': self.remove_sync_rule, 'state': 'disabled', 'row': 8, 'col': 0},
              {'text': 'Создать сборку', 'frame': 'file_maker',
              'command': self.create_assy, 'state': 'normal', 'row': 0, 'col': 0},
              {'text': 'Создать деталь', 'frame': 'file_maker',
@@ -582,7 +943,13 @@ class NerpaSyncMain(Window):
                                         config['state'],
                                         row, col)
             buttons.append(button)
-            if config['text'] == 'Зарегистрировать файл':
+            if config['text'] == 'Обновить или создать проект':
+                self.update_project_button = button
+            elif config['text'] == 'Синхронизовать с сетевого диска':
+                self.sync_button = button
+            elif config['text'] == 'Отменить операцию':
+                self.cancel_button = button
+            elif config['text'] == 'Зарегистрировать файл':
                 self.register_button = button
             elif config['text'] == 'Разрегистрировать файл':
                 self.unregister_button = button
@@ -600,6 +967,10 @@ class NerpaSyncMain(Window):
                 self.create_folder_button = button
             elif config['text'] == 'Создать копию':
                 self.create_copy_button = button
+            elif config['text'] == 'Синхронизировать выбранное':
+                self.add_sync_rule_button = button
+            elif config['text'] == 'Не синхронизировать выбранное':
+                self.remove_sync_rule_button = button
 
         return buttons
 
@@ -609,7 +980,11 @@ class NerpaSyncMain(Window):
         """
         if messagebox.askokcancel("Выход", "Вы действительно хотите выйти?"):
             self.kompas_handler.stop()  # Завершаем цикл обработки сообщений
+            self.jobs.shutdown()
             self.main_root.destroy()
+            connections.close_all()
+            sys.stdout = sys.__stdout__
+            self.log_sink.close()
 
 if __name__ == '__main__':
     window = NerpaSyncMain()
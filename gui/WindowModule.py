@@ -3,9 +3,7 @@
 import tkinter as tk
 from tkinter import ttk
 import sys, os, stat
-import sqlite3
 import shutil
-from datetime import datetime
 from getpass import getuser
 
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -15,6 +13,9 @@ if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
 from src import k3DMaker, CADFolderDB
+from src.ConnectionModule import connections, get_main_db_path, get_user_db_path
+from src.DeltaModule import staged_copy
+from src.ScanModule import get_record_key
 
 class Window:
     '''
@@ -58,7 +59,7 @@ class k3DMakerWindow:
         self.local_dir_path = local_dir_path
         self.main_window_instance = main_window_instance
 
-        self.db_path = project_root+'\\databases\\CADFolder.db'
+        self.db_path = get_main_db_path()
 
         self.get_ask_window()
 
@@ -101,30 +102,27 @@ class k3DMakerWindow:
                 file_name = ''.join([marking, extension])
                 network_file_path = '/'.join([self.network_dir_path, 
                                             file_name])
-                local_file_path = '/'.join([self.local_dir_path, file_name])
+                local_file_path = os.path.normpath(os.path.join(self.local_dir_path, file_name))
                 
                 if k3DMaker(network_file_path,self.doc_type,marking,name):
                     try:
                         shutil.copy2(network_file_path, self.local_dir_path)
-                        last_modified = datetime.fromtimestamp(os.path.getmtime(network_file_path)).isoformat()
+                        last_modified, size, mtime_ns = get_record_key(network_file_path)
                         name = ''.join([marking, extension])
                         status = getuser()
-                        self.user_db_path = project_root+'\\databases\\CADFolder_{}.db'.format(status)
+                        self.user_db_path = get_user_db_path(status)
 
-                        with sqlite3.connect(self.db_path) as conn, sqlite3.connect(self.user_db_path) as user_conn:
-                            user_cursor = user_conn.cursor()
-                            cursor = conn.cursor()
+                        with connections.transaction(self.db_path) as cursor, \
+                                connections.transaction(self.user_db_path) as user_cursor:
                             cursor.execute('''INSERT INTO file_structure
-                                        (name, network_path, status, type, last_modified)
-                                        VALUES (?,?,?,?,?)''',
-                                        (name, network_file_path, status, 'file', last_modified))
+                                        (name, network_path, status, type, last_modified, size, mtime_ns)
+                                        VALUES (?,?,?,?,?,?,?)''',
+                                        (name, network_file_path, status, 'file', last_modified, size, mtime_ns))
                             user_cursor.execute('''INSERT INTO file_structure
-                                        (name, local_path, status, type, last_modified)
-                                        VALUES (?,?,?,?,?)''',
-                                        (name, local_file_path, status, 'file', last_modified))
-                            user_conn.commit()
-                            conn.commit()
-                            self.main_window_instance.update_treeview()
+                                        (name, local_path, status, type, last_modified, size, mtime_ns)
+                                        VALUES (?,?,?,?,?,?,?)''',
+                                        (name, local_file_path, status, 'file', last_modified, size, mtime_ns))
+                        self.main_window_instance.refresh_treeview()
 
                     except Exception as e:
                         print('Ошибка копирования файла: {}'.format(e))
@@ -137,12 +135,13 @@ class k3DMakerWindow:
             return
 
 class FolderMakerWindow:
-    def __init__(self, root, dir_name):
+    def __init__(self, root, dir_name, window_instance=None):
         self.root = root
         self.dir_name = dir_name
-        self.db_path = project_root+'\\databases\\CADFolder.db'
+        self.window_instance = window_instance
+        self.db_path = get_main_db_path()
         username = getuser()
-        self.user_db_path = project_root+'\\databases\\CADFolder_{}.db'.format(username)
+        self.user_db_path = get_user_db_path(username)
 
         self.create_ask_window()
 
@@ -173,10 +172,8 @@ class FolderMakerWindow:
                 print('Введите название папки')
                 return
             
-            with sqlite3.connect(self.db_path) as conn, sqlite3.connect(self.user_db_path) as user_conn:
-                user_cursor = user_conn.cursor()
-                cursor = conn.cursor()
-
+            with connections.transaction(self.db_path) as cursor, \
+                    connections.transaction(self.user_db_path) as user_cursor:
                 cursor.execute('''SELECT network_path FROM file_structure
                                WHERE name = ? AND type = "directory"''',(self.dir_name,))
                 network_source_path = cursor.fetchone()[0]
@@ -185,7 +182,7 @@ class FolderMakerWindow:
                                WHERE name = ? AND type = "directory"''',(self.dir_name,))
                 local_source_path = user_cursor.fetchone()[0]
 
-                local_dir_path = '\\'.join([local_source_path, folder_name])
+                local_dir_path = os.path.normpath(os.path.join(local_source_path, folder_name))
                 network_dir_path = '/'.join([network_source_path,folder_name])
                 try:
                     os.makedirs(local_dir_path, exist_ok=True)
@@ -195,21 +192,22 @@ class FolderMakerWindow:
                     return
 
                 try:
-                    last_modified = datetime.fromtimestamp(os.path.getmtime(network_dir_path)).isoformat()
+                    last_modified, size, mtime_ns = get_record_key(network_dir_path)
                     cursor.execute('''INSERT INTO file_structure
-                                   (name, network_path, status, type, last_modified)
-                                   VALUES (?,?,?,?,?)''',
-                                   (folder_name, network_dir_path,'Зарегистрирован', 'directory', last_modified))
+                                   (name, network_path, status, type, last_modified, size, mtime_ns)
+                                   VALUES (?,?,?,?,?,?,?)''',
+                                   (folder_name, network_dir_path,'Зарегистрирован', 'directory', last_modified, size, mtime_ns))
                     user_cursor.execute('''INSERT INTO file_structure
-                                   (name, local_path, status, type, last_modified)
-                                   VALUES (?,?,?,?,?)''',
-                                   (folder_name, local_dir_path,'Зарегистрирован', 'directory', last_modified))
-                    conn.commit()
-                    user_conn.commit()
+                                   (name, local_path, status, type, last_modified, size, mtime_ns)
+                                   VALUES (?,?,?,?,?,?,?)''',
+                                   (folder_name, local_dir_path,'Зарегистрирован', 'directory', last_modified, size, mtime_ns))
                     print('Папка {} успешно создана'.format(folder_name))
 
                 except Exception as e:
                     print(e)
+
+            if self.window_instance is not None:
+                self.window_instance.refresh_treeview()
                     
         except Exception as e:
             print(e)
@@ -223,9 +221,9 @@ class CreateCopyWindow:
 
         self.doc_name, self.extension, self.local_dir_path, self.network_dir_path = self.get_doc_name()
 
-        self.db_path = project_root+'\\databases\\CADFolder.db'
+        self.db_path = get_main_db_path()
         self.username = getuser()
-        self.user_db_path = project_root+'\\databases\\CADFolder_{}.db'.format(self.username)
+        self.user_db_path = get_user_db_path(self.username)
 
         self.get_create_copy_window()
 
@@ -266,13 +264,14 @@ class CreateCopyWindow:
             print('Название файла совпадает с именем оригинала. Измените название файла')
             return
         
-        copy_local_path = '\\'.join([self.local_dir_path, copy_file_name])+self.extension
+        copy_local_path = os.path.normpath('\\'.join([self.local_dir_path, copy_file_name])+self.extension)
         copy_network_path = '/'.join([self.network_dir_path, copy_file_name])+self.extension
         copy_file_name = copy_file_name+self.extension
         copy_flag = False
         try:
             shutil.copy2(self.source_local_file_path, copy_local_path)
-            shutil.copy2(self.source_local_file_path, copy_network_path)
+            # на сетевой диск через временный файл, чтобы при обрыве связи не остался обрезанный файл
+            staged_copy(self.source_local_file_path, copy_network_path)
             os.chmod(copy_local_path, 0o666)
             os.chmod(copy_network_path, stat.S_IREAD)
             copy_flag = True
@@ -281,30 +280,26 @@ class CreateCopyWindow:
 
         if copy_flag:
             db_flag = False
-            with sqlite3.connect(self.db_path) as conn, sqlite3.connect(self.user_db_path) as user_conn:
-                user_cursor = user_conn.cursor()
-                cursor = conn.cursor()
+            with connections.transaction(self.db_path) as cursor, \
+                    connections.transaction(self.user_db_path) as user_cursor:
                 try:
-                    last_modified = datetime.fromtimestamp(os.path.getmtime(copy_local_path)).isoformat()
+                    last_modified, size, mtime_ns = get_record_key(copy_network_path)
                     cursor.execute('''INSERT INTO file_structure
-                                   (name, network_path, status, type, last_modified)
-                                   VALUES (?,?,?,?,?)''',
-                                   (copy_file_name, copy_network_path,self.username, 'file', last_modified))
+                                   (name, network_path, status, type, last_modified, size, mtime_ns)
+                                   VALUES (?,?,?,?,?,?,?)''',
+                                   (copy_file_name, copy_network_path,self.username, 'file', last_modified, size, mtime_ns))
                     user_cursor.execute('''INSERT INTO file_structure
-                                   (name, local_path, status, type, last_modified)
-                                   VALUES (?,?,?,?,?)''',
-                                   (copy_file_name, copy_local_path,self.username, 'file', last_modified))
-                    conn.commit()
-                    user_conn.commit()
+                                   (name, local_path, status, type, last_modified, size, mtime_ns)
+                                   VALUES (?,?,?,?,?,?,?)''',
+                                   (copy_file_name, copy_local_path,self.username, 'file', last_modified, size, mtime_ns))
                     print('Копия {} успешно создана'.format(copy_file_name))
                     db_flag = True
-                    self.window_instance.update_treeview()
 
                 except Exception as e:
                     print(e)
 
             if db_flag:
-                pass
+                self.window_instance.refresh_treeview()
             else:
                 #TO DO: добавить удаление копий, потому что не занеслась запись в бд
                 pass
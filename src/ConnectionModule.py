@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+import threading
+import time
+from contextlib import contextmanager
+from getpass import getuser
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+# Добавляем корневую директорию проекта в sys.path
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import sqlite3
+
+
+# Папка с БД проекта на сетевом диске
+databases_dir = os.path.join(project_root, 'databases')
+
+# Переменная окружения с папкой для пользовательской БД (по умолчанию - локальное хранилище)
+USER_DB_DIR_ENV = 'NERPASYNC_USER_DB_DIR'
+
+# Размер кэша страниц SQLite в КБ (отрицательное значение cache_size)
+CACHE_SIZE_KB = 16384
+# Количество подготовленных запросов, которые хранит одно соединение
+CACHED_STATEMENTS = 256
+# Ожидание снятия блокировки другим клиентом, с
+BUSY_TIMEOUT = 30
+# Соединение, простаивавшее дольше этого времени, проверяется перед использованием, с
+IDLE_CHECK_INTERVAL = 30
+
+# Тексты ошибок SQLite, после которых соединение считается потерянным
+# (например, при обрыве связи с сетевым диском)
+CONNECTION_ERRORS = ('disk i/o error', 'unable to open database file',
+                     'database disk image is malformed', 'not a database')
+
+
+def get_vault_dir():
+    '''
+    Локальное хранилище пользователя: копия проекта, журнал, статистика
+    '''
+    home = os.getenv('USERPROFILE') or os.path.expanduser('~')
+    return os.path.join(home, 'AppData', 'NerpaSyncVault')
+
+
+def get_main_db_path():
+    return os.path.join(databases_dir, 'CADFolder.db')
+
+
+def get_replica_db_path():
+    '''
+    Локальная копия главной БД в хранилище пользователя
+    '''
+    return os.path.join(get_vault_dir(), 'CADFolder.db')
+
+
+def get_user_db_path(username=None):
+    '''
+    Пользовательская БД с локальными путями проекта. Хранится на локальном диске:
+    в папке из переменной окружения NERPASYNC_USER_DB_DIR или в локальном хранилище
+    '''
+    user_db_dir = os.getenv(USER_DB_DIR_ENV) or get_vault_dir()
+    return os.path.join(user_db_dir, 'CADFolder_{}.db'.format(username or getuser()))
+
+
+def get_legacy_user_db_path(username=None):
+    '''
+    Прежнее расположение пользовательской БД - рядом с главной БД на сетевом диске
+    '''
+    return os.path.join(databases_dir, 'CADFolder_{}.db'.format(username or getuser()))
+
+
+def is_connection_error(error):
+    message = str(error).lower()
+    return any(text in message for text in CONNECTION_ERRORS)
+
+
+class ConnectionManager:
+    '''
+    Класс, хранящий одно долгоживущее соединение на каждую БД.
+    Соединение открывается при первом обращении, настраивается
+    (кэш страниц, кэш подготовленных запросов, ожидание блокировки)
+    и используется всеми модулями через transaction().
+    Доступ к соединению из разных потоков последовательный.
+    trace_callback - функция, вызываемая для каждого выполненного запроса
+    (подсчет запросов в статистике), назначается до открытия соединений.
+    commit_callback - функция (путь к БД), вызываемая после фиксации
+    транзакции, которая изменила БД (обновление файла поколения).
+    После ошибки ввода-вывода соединение закрывается, и следующее
+    обращение открывает его заново
+    '''
+    def __init__(self):
+        self._connections = {}
+        self._locks = {}
+        self._last_used = {}
+        self._guard = threading.Lock()
+        self.trace_callback = None
+        self.commit_callback = None
+
+    def _key(self, db_path):
+        return os.path.normcase(os.path.abspath(db_path))
+
+    def lock(self, db_path):
+        key = self._key(db_path)
+        with self._guard:
+            if key not in self._locks:
+                self._locks[key] = threading.RLock()
+            return self._locks[key]
+
+    def _open(self, db_path):
+        conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT,
+                               cached_statements=CACHED_STATEMENTS,
+                               check_same_thread=False)
+        conn.execute('PRAGMA cache_size = -{}'.format(int(CACHE_SIZE_KB)))
+        conn.execute('PRAGMA temp_store = MEMORY')
+        # set_trace_callback появился в Python 3.3
+        if self.trace_callback is not None and hasattr(conn, 'set_trace_callback'):
+            conn.set_trace_callback(self.trace_callback)
+        return conn
+
+    def connection(self, db_path):
+        '''
+        Возвращает соединение с БД, открывая его при необходимости.
+        Вызывающий код должен держать lock(db_path)
+        '''
+        key = self._key(db_path)
+        conn = self._connections.get(key)
+        now = time.time()
+        if conn is not None and now - self._last_used.get(key, now) > IDLE_CHECK_INTERVAL:
+            # после долгого простоя проверка, что файл БД по-прежнему доступен
+            try:
+                conn.execute('PRAGMA user_version').fetchone()
+            except sqlite3.Error:
+                self.drop(db_path)
+                conn = None
+        if conn is None:
+            conn = self._open(db_path)
+            self._connections[key] = conn
+        self._last_used[key] = now
+        return conn
+
+    def drop(self, db_path):
+        '''
+        Закрывает соединение, следующее обращение откроет новое
+        '''
+        conn = self._connections.pop(self._key(db_path), None)
+        if conn is not None:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    @contextmanager
+    def transaction(self, db_path):
+        '''
+        Контекстный менеджер транзакции. Возвращает курсор,
+        при успешном выходе фиксирует изменения, при ошибке откатывает их.
+        Вложенные транзакции к одной БД не поддерживаются
+        '''
+        with self.lock(db_path):
+            conn = self.connection(db_path)
+            cursor = conn.cursor()
+            total_changes = conn.total_changes
+            try:
+                yield cursor
+                conn.commit()
+            except Exception as e:
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    pass
+                if isinstance(e, sqlite3.Error) and is_connection_error(e):
+                    self.drop(db_path)
+                raise
+            if self.commit_callback is not None and conn.total_changes != total_changes:
+                self.commit_callback(db_path)
+
+    def close_all(self):
+        with self._guard:
+            keys = list(self._connections)
+        for key in keys:
+            with self.lock(key):
+                self.drop(key)
+
+
+# Общий для всего приложения менеджер соединений
+connections = ConnectionManager()
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 # Определяем путь к корневой директории проекта
-import os, sys, stat
+import os, sys
 
 from datetime import datetime
 
@@ -14,17 +14,399 @@ import shutil
 from getpass import getuser
 import time
 from .KompasUtility import SetStatusDoc
+from .ScanModule import ProjectScanner, format_mtime_ns, get_change_key, is_inside
+from .DeltaModule import push_delta, replace_file, TEMP_SUFFIX
+from .SyncModule import SyncPlanner, SyncExecutor, SyncScope, normalize_sync_rules, set_read_only
+from .ConnectionModule import (connections, get_main_db_path, get_user_db_path,
+                               get_legacy_user_db_path, get_vault_dir)
+from .StatsModule import stats
+from .ReplicaModule import replica
 
 from tkinter import filedialog
 
 
+class BatchWriter:
+    '''
+    Класс для пакетной записи в таблицу file_structure.
+    Вставки, обновления времени изменения и удаления накапливаются
+    и записываются через executemany в одной транзакции при вызове flush().
+    Входные параметры:
+    db_path - путь к БД, запись идет через общий менеджер соединений
+    key_column - столбец с путем, по которому определяется запись:
+    network_path для главной БД, local_path для пользовательской
+    '''
+    def __init__(self, db_path, key_column):
+        self.db_path = db_path
+        self.key_column = key_column
+        self.inserts = []
+        self.updates = []
+        self.status_updates = []
+        self.deletes = []
+
+    def insert(self, name, path, status, item_type, last_modified, size=None, mtime_ns=None):
+        '''
+        Добавление записи. Если запись с таким путем уже есть,
+        у нее обновляются имя, тип и время изменения (upsert по пути)
+        '''
+        self.inserts.append((name, path, status, item_type, last_modified, size, mtime_ns))
+
+    def update(self, path, last_modified, status=None, size=None, mtime_ns=None):
+        '''
+        Обновление времени изменения записи, при необходимости и статуса
+        '''
+        if status is None:
+            self.updates.append((last_modified, size, mtime_ns, path))
+        else:
+            self.status_updates.append((last_modified, size, mtime_ns, status, path))
+
+    def delete(self, path):
+        self.deletes.append((path,))
+
+    def __len__(self):
+        return len(self.inserts) + len(self.updates) + len(self.status_updates) + len(self.deletes)
+
+    def flush(self):
+        '''
+        Запись накопленных операций в одной транзакции
+        '''
+        if not len(self):
+            return
+        key = self.key_column
+        with connections.transaction(self.db_path) as cursor:
+            if self.deletes:
+                cursor.executemany('DELETE FROM file_structure WHERE {} = ?'.format(key), self.deletes)
+            if self.updates:
+                cursor.executemany('''UPDATE file_structure SET last_modified = ?, size = ?, mtime_ns = ?
+                                   WHERE {} = ?'''.format(key), self.updates)
+            if self.status_updates:
+                cursor.executemany('''UPDATE file_structure SET last_modified = ?, size = ?, mtime_ns = ?, status = ?
+                                   WHERE {} = ?'''.format(key), self.status_updates)
+            if self.inserts:
+                # upsert без ON CONFLICT, который не поддерживается старыми версиями SQLite:
+                # существующие пути пакета читаются частями и обновляются, остальные вставляются
+                paths = sorted(set(row[1] for row in self.inserts))
+                exists_paths = set()
+                for i in range(0, len(paths), SQL_VARIABLES_LIMIT):
+                    chunk = paths[i:i + SQL_VARIABLES_LIMIT]
+                    cursor.execute('SELECT {0} FROM file_structure WHERE {0} IN ({1})'.format(
+                        key, ', '.join('?' * len(chunk))), chunk)
+                    exists_paths.update(row[0] for row in cursor.fetchall())
+                new_rows = []
+                existing_rows = []
+                for name, path, status, item_type, last_modified, size, mtime_ns in self.inserts:
+                    if path in exists_paths:
+                        existing_rows.append((name, item_type, last_modified, size, mtime_ns, path))
+                    else:
+                        exists_paths.add(path)
+                        new_rows.append((name, path, status, item_type, last_modified, size, mtime_ns))
+                if new_rows:
+                    cursor.executemany('''INSERT INTO file_structure
+                                       (name, {}, status, type, last_modified, size, mtime_ns)
+                                       VALUES (?, ?, ?, ?, ?, ?, ?)'''.format(key), new_rows)
+                if existing_rows:
+                    cursor.executemany('''UPDATE file_structure
+                                       SET name = ?, type = ?, last_modified = ?, size = ?, mtime_ns = ?
+                                       WHERE {} = ?'''.format(key), existing_rows)
+        self.inserts = []
+        self.updates = []
+        self.status_updates = []
+        self.deletes = []
+
+
+def add_change_key_columns(conn):
+    '''
+    Добавляет в file_structure столбцы size и mtime_ns.
+    Для существующих записей они остаются пустыми: при сравнении
+    такие записи проверяются по last_modified, а ключ заполняется
+    при следующем обновлении проекта или синхронизации
+    '''
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(file_structure)')]
+    if 'size' not in columns:
+        conn.execute('ALTER TABLE file_structure ADD COLUMN size INTEGER')
+    if 'mtime_ns' not in columns:
+        conn.execute('ALTER TABLE file_structure ADD COLUMN mtime_ns INTEGER')
+
+
+def normalize_local_paths(conn):
+    '''
+    Приводит local_path в пользовательской БД к разделителям os.sep. Диалоги создания
+    документов записывали пути с '/', и такие записи не находились по пути из плана
+    синхронизации. Если запись с тем же путем уже есть, остается более новая
+    '''
+    if os.sep == '/':
+        return
+    rows = conn.execute("SELECT id, local_path FROM file_structure WHERE local_path LIKE '%/%'").fetchall()
+    for row_id, local_path in rows:
+        normalized = os.path.normpath(local_path)
+        conn.execute('DELETE FROM file_structure WHERE local_path = ? AND id < ?', (normalized, row_id))
+        if conn.execute('SELECT 1 FROM file_structure WHERE local_path = ?', (normalized,)).fetchone():
+            conn.execute('DELETE FROM file_structure WHERE id = ?', (row_id,))
+        else:
+            conn.execute('UPDATE file_structure SET local_path = ? WHERE id = ?', (normalized, row_id))
+
+
+def compute_project_root(cursor):
+    '''
+    Общая папка для всех папок в file_structure - корень, который прежние версии
+    вычисляли по всем записям папок. От него зависят пути в локальном хранилище,
+    поэтому для существующих проектов он сохраняется. Определяется по первому
+    и последнему пути папки, без чтения всей таблицы.
+    Используется только для заполнения project_meta в БД, созданных до ее появления
+    '''
+    cursor.execute("SELECT MIN(network_path), MAX(network_path) FROM file_structure WHERE type = 'directory'")
+    first_path, last_path = cursor.fetchone()
+    if first_path is None:
+        return ''
+
+    common_parts = []
+    for a, b in zip(first_path.split('/'), last_path.split('/')):
+        if a != b:
+            break
+        common_parts.append(a)
+
+    # Между первым и последним путем могут быть пути, которые продолжают
+    # последнюю общую часть без '/', например 'Папка-1' после 'Папка'
+    while common_parts:
+        common_path = '/'.join(common_parts)
+        cursor.execute('''SELECT 1 FROM file_structure
+                       WHERE type = 'directory' AND network_path > ? AND network_path < ? LIMIT 1''',
+                       (common_path, common_path + '/'))
+        if cursor.fetchone() is None:
+            break
+        common_parts.pop()
+    return '/'.join(common_parts)
+
+
+def get_project_meta(cursor, key, default=None):
+    cursor.execute('SELECT value FROM project_meta WHERE key = ?', (key,))
+    row = cursor.fetchone()
+    return row[0] if row else default
+
+
+def set_project_meta(cursor, values):
+    cursor.executemany('INSERT OR REPLACE INTO project_meta (key, value) VALUES (?, ?)',
+                       list(values.items()))
+
+
+def create_project_meta(conn):
+    '''
+    Создает таблицу project_meta со сведениями о проекте: корень проекта
+    на сетевом диске (root), название (name) и параметры схемы.
+    Для существующего проекта корень один раз вычисляется по file_structure
+    '''
+    conn.execute('''CREATE TABLE IF NOT EXISTS project_meta (
+                 key TEXT PRIMARY KEY,
+                 value TEXT
+                 )''')
+    cursor = conn.cursor()
+    if get_project_meta(cursor, 'root') is None:
+        root = compute_project_root(cursor)
+        if root:
+            set_project_meta(cursor, {'root': root, 'name': root.rsplit('/', 1)[-1]})
+    set_project_meta(cursor, {'path_separator': '/', 'schema_version': str(PROJECT_META_VERSION)})
+
+
+# Версия схемы главной БД, в которой появилась таблица project_meta
+PROJECT_META_VERSION = 5
+
+# Миграции схемы БД. Каждая миграция - пара (версия, SQL-скрипт или функция от соединения).
+# Текущая версия хранится в PRAGMA user_version, скрипты написаны так,
+# чтобы их повторное выполнение другим клиентом не приводило к ошибке
+MAIN_DB_MIGRATIONS = [
+    (1, '''
+        CREATE TABLE IF NOT EXISTS file_structure (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        network_path TEXT,
+        status TEXT,
+        type TEXT,
+        last_modified TEXT
+        );
+        CREATE TABLE IF NOT EXISTS user_tracking (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        last_user TEXT
+        );
+    '''),
+    (2, '''
+        DELETE FROM file_structure WHERE id NOT IN
+        (SELECT MAX(id) FROM file_structure GROUP BY network_path);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_file_structure_network_path
+        ON file_structure (network_path);
+        CREATE INDEX IF NOT EXISTS idx_file_structure_name
+        ON file_structure (name, type);
+    '''),
+    (3, add_change_key_columns),
+    (4, '''
+        CREATE TABLE IF NOT EXISTS change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        network_path TEXT,
+        action TEXT,
+        changed_at TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TRIGGER IF NOT EXISTS trg_file_structure_insert
+        AFTER INSERT ON file_structure
+        BEGIN
+            INSERT INTO change_log (network_path, action) VALUES (NEW.network_path, 'insert');
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_file_structure_update
+        AFTER UPDATE ON file_structure
+        BEGIN
+            INSERT INTO change_log (network_path, action)
+            SELECT OLD.network_path, 'delete' WHERE OLD.network_path IS NOT NEW.network_path;
+            INSERT INTO change_log (network_path, action)
+            VALUES (NEW.network_path,
+                    CASE WHEN OLD.status IS NOT NEW.status THEN 'status' ELSE 'update' END);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_file_structure_delete
+        AFTER DELETE ON file_structure
+        BEGIN
+            INSERT INTO change_log (network_path, action) VALUES (OLD.network_path, 'delete');
+        END;
+    '''),
+    (PROJECT_META_VERSION, create_project_meta),
+]
+
+USER_DB_MIGRATIONS = [
+    (1, '''
+        CREATE TABLE IF NOT EXISTS file_structure (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        local_path TEXT,
+        status TEXT,
+        type TEXT,
+        last_modified TEXT
+        );
+    '''),
+    (2, '''
+        DELETE FROM file_structure WHERE id NOT IN
+        (SELECT MAX(id) FROM file_structure GROUP BY local_path);
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_file_structure_local_path
+        ON file_structure (local_path);
+        CREATE INDEX IF NOT EXISTS idx_file_structure_name
+        ON file_structure (name, type);
+    '''),
+    (3, add_change_key_columns),
+    (4, '''
+        CREATE TABLE IF NOT EXISTS sync_state (
+        key TEXT PRIMARY KEY,
+        value TEXT
+        );
+    '''),
+    (5, '''
+        CREATE TABLE IF NOT EXISTS sync_rules (
+        network_path TEXT PRIMARY KEY
+        );
+    '''),
+    (6, normalize_local_paths),
+]
+
+# Количество последних записей change_log, которые хранятся в главной БД.
+# Клиент, отставший больше чем на это количество изменений, выполняет полную синхронизацию
+CHANGE_LOG_KEEP = 100000
+# Ограничение SQLite на количество параметров в одном запросе
+SQL_VARIABLES_LIMIT = 500
+
+
+def migrate_db(db_path, migrations):
+    '''
+    Обновляет схему БД до последней версии из списка migrations.
+    Каждая миграция выполняется в отдельной транзакции вместе
+    с записью нового номера версии
+    '''
+    with connections.lock(db_path):
+        conn = connections.connection(db_path)
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for target_version, migration in migrations:
+            if target_version <= version:
+                continue
+            if callable(migration):
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    migration(conn)
+                    conn.execute('PRAGMA user_version = {}'.format(int(target_version)))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            else:
+                # executescript не участвует в неявных транзакциях модуля sqlite3,
+                # поэтому транзакция открывается и закрывается в самом скрипте.
+                # При ошибке в середине скрипта транзакция остается открытой и откатывается,
+                # иначе следующая фиксация на этом соединении сохранила бы часть миграции
+                try:
+                    conn.executescript('BEGIN IMMEDIATE;\n{}\nPRAGMA user_version = {};\nCOMMIT;'.format(
+                        migration, int(target_version)))
+                except Exception:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    raise
+            version = target_version
+        return version
+
+
+def move_user_db(username=None):
+    '''
+    Однократный перенос пользовательской БД с сетевого диска в новое расположение
+    (get_user_db_path). Выполняется, если в новом месте БД еще нет.
+    БД копируется в согласованном состоянии, а старый файл переименовывается
+    в .migrated, чтобы перенос не повторялся и старая копия не использовалась.
+    Возвращает путь к пользовательской БД
+    '''
+    user_db = get_user_db_path(username)
+    legacy_db = get_legacy_user_db_path(username)
+    # локальная папка для БД может еще не существовать (первый запуск)
+    os.makedirs(os.path.dirname(user_db), exist_ok=True)
+    if (os.path.exists(user_db) or not os.path.exists(legacy_db)
+            or os.path.normcase(os.path.abspath(user_db)) == os.path.normcase(os.path.abspath(legacy_db))):
+        return user_db
+
+    temp_path = user_db + TEMP_SUFFIX
+    with connections.lock(legacy_db):
+        conn = connections.connection(legacy_db)
+        if hasattr(conn, 'backup'):
+            # sqlite3 backup появился в Python 3.7
+            target = sqlite3.connect(temp_path)
+            try:
+                conn.backup(target)
+            finally:
+                target.close()
+        else:
+            conn.execute('BEGIN')
+            try:
+                conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+                shutil.copyfile(legacy_db, temp_path)
+            finally:
+                conn.rollback()
+        connections.drop(legacy_db)
+    replace_file(temp_path, user_db)
+    replace_file(legacy_db, legacy_db + '.migrated')
+    print('Пользовательская БД перенесена в {}'.format(user_db))
+    return user_db
+
+
 class CADFolderDB():
     def __init__(self):
-        self.db_path = project_root+'\\databases\\CADFolder.db'
+        self.db_path = get_main_db_path()
         self.username = getuser()
-        self.user_db = project_root + '\\databases\\CADFolder_{}.db'.format(self.username)
+        self.user_db = get_user_db_path(self.username)
+        self.migrate()
         self.common_root = self.get_common_network_root()
 
+    def migrate(self):
+        '''
+        Обновление схемы главной и пользовательской БД до текущей версии.
+        Пользовательская БД предварительно переносится с сетевого диска на локальный
+        '''
+        try:
+            move_user_db(self.username)
+        except (sqlite3.Error, OSError) as e:
+            print("Ошибка переноса пользовательской БД: {}".format(e))
+        try:
+            migrate_db(self.db_path, MAIN_DB_MIGRATIONS)
+            migrate_db(self.user_db, USER_DB_MIGRATIONS)
+        except sqlite3.Error as e:
+            print("Ошибка обновления структуры БД: {}".format(e))
+
 
     def get_last_modified_time(self, file_path):
         '''
@@ -40,121 +422,117 @@ class CADFolderDB():
         в которую записывается имя пользователя,
         который последний внес изменения в БД
         '''
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        with connections.transaction(self.db_path) as cursor:
             cursor.execute('''CREATE TABLE IF NOT EXISTS
                            user_tracking(
                            id INTEGER PRIMARY KEY AUTOINCREMENT,
                            last_user TEXT)''')
             cursor.execute('''INSERT INTO user_tracking (last_user)
                            VALUES (?)''', (self.username,))
-            conn.commit()
 
     def update_last_user(self):
         '''
         Метод по обновлению последнего пользователя,
         вносившего изменения в БД
         '''
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        with connections.transaction(self.db_path) as cursor:
             cursor.execute('''
                 UPDATE user_tracking
                 SET last_user = ?
                 WHERE id = 1
             ''', (self.username,))
-            conn.commit()
 
     def get_last_user(self):
         '''
         Метод получения имени последнего пользователя,
-        вносившего изменения в БД
+        вносившего изменения в БД (из локальной копии)
         '''
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        with connections.transaction(replica.read_path()) as cursor:
             cursor.execute('''SELECT last_user FROM user_tracking''')
             return cursor.fetchone()[0]
 
-    def update_project(self):
+    @stats.operation('update_project')
+    def update_project(self, project_path=None, cancel_event=None):
         '''
         Метод по ручному принудительному обновлению или созданию
-        проекта. Вызывает файловый диалог с выбором директории.
+        проекта. Если путь не передан, вызывает файловый диалог с выбором директории
+        (только из главного потока).
         После этого создается таблица(если надо) и заносятся или
-        обновляются записи в таблице
+        обновляются записи в таблице.
+        При отмене через cancel_event БД не изменяется
         '''
 
-        project_path = filedialog.askdirectory()
+        if project_path is None:
+            project_path = filedialog.askdirectory()
         if not project_path:
             print('Путь к проекту не выбран')
             return
         
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            print('Подключение к главной БД')
-            cursor.execute('''
-            CREATE TABLE IF NOT EXISTS file_structure (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT,
-            network_path TEXT,
-            status TEXT,
-            type TEXT,
-            last_modified TEXT
-            )
-            ''')
-            # Получение существующих путей
-            cursor.execute('SELECT network_path, last_modified FROM file_structure')
-            exists_paths = {row[0]: row[1] for row in cursor.fetchall()}
-
-            #последовательной обход директорий и файлов в главной папке проекта
-            for dirpath, dirnames, filenames in os.walk(project_path):
-                for dirname in dirnames:
-                    full_path = os.path.join(dirpath, dirname).replace("\\", "/")
-                    last_modified = self.get_last_modified_time(full_path)
-                    #если пути папки нет в БД
-                    if full_path not in exists_paths:
-                        cursor.execute('''
-                            INSERT INTO file_structure 
-                            (name, network_path, status, type, last_modified)
-                            VALUES (?, ?, ?, ?, ?)
-                        ''', (dirname, full_path, 'Зарегистрирован', 'directory', last_modified))
-                    #если запись есть, но она старая
-                    elif exists_paths[full_path] != last_modified:
-                        cursor.execute('''
-                            UPDATE file_structure 
-                            SET last_modified = ?
-                            WHERE network_path = ?
-                        ''', (last_modified, full_path))
-                    #Случай, в котором папка существует и она корректно обновлена
-                    exists_paths.pop(full_path, None)
-                    self.set_read_only(full_path)
-
-                for filename in filenames:
-                    #исключения из перебора TEMP файлов(начинаются с ~) и BACKUP файлов КОМПАС
-                    if not filename.startswith('~') and filename[-3:] not in ['bak']:
-                        full_path = os.path.join(dirpath, filename).replace("\\", "/")
-                        last_modified = self.get_last_modified_time(full_path)
-                        #если пути нет в БД
-                        if full_path not in exists_paths:
-                            cursor.execute('''
-                                INSERT INTO file_structure 
-                                (name, network_path, status, type, last_modified)
-                                VALUES (?, ?, ?, ?, ?)
-                            ''', (filename, full_path, 'Зарегистрирован', 'file', last_modified))
-                        #если путь есть, но дата изменения не актуальна
-                        elif exists_paths[full_path] != last_modified:
-                            cursor.execute('''
-                                UPDATE file_structure 
-                                SET last_modified = ?
-                                WHERE network_path = ?
-                            ''', (last_modified, full_path))
-                        #Случай, в котором папка существует и она корректно обновлена
-                        exists_paths.pop(full_path, None)
-                        self.set_read_only(full_path)
-            # Удаление несуществующих путей
-            if exists_paths:
-                cursor.executemany("DELETE FROM file_structure WHERE network_path = ?", 
-                                   [(path,) for path in exists_paths])
-            conn.commit()
-            print('База данных обновлена')
+        run = stats.current()
+        print('Подключение к главной БД')
+        # Получение существующих путей
+        with run.span('чтение БД'), connections.transaction(self.db_path) as cursor:
+            cursor.execute('SELECT network_path, size, mtime_ns FROM file_structure')
+            exists_paths = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+
+        #параллельный обход директорий и файлов в главной папке проекта.
+        #Обход идет без открытой транзакции, чтобы не блокировать другие обращения к БД
+        scanner = ProjectScanner(project_path)
+        with run.span('обход'):
+            records = scanner.scan(cancel_event)
+        run.count('объектов найдено', len(records))
+        for error in scanner.errors:
+            print(error)
+        if cancel_event is not None and cancel_event.is_set():
+            run.set_status('cancelled')
+            print('Обновление проекта отменено')
+            return
+
+        writer = BatchWriter(self.db_path, 'network_path')
+        for name, full_path, item_type, size, mtime_ns in records:
+            #если пути нет в БД
+            if full_path not in exists_paths:
+                writer.insert(name, full_path, 'Зарегистрирован', item_type,
+                              format_mtime_ns(mtime_ns), size, mtime_ns)
+            #если путь есть, но размер или время изменения не актуальны
+            elif exists_paths[full_path] != (size, mtime_ns):
+                writer.update(full_path, format_mtime_ns(mtime_ns), size=size, mtime_ns=mtime_ns)
+            #Случай, в котором путь существует и он корректно обновлен
+            exists_paths.pop(full_path, None)
+
+        # Удаление несуществующих путей. Записи для папок и файлов, которые не удалось
+        # прочитать при обходе, не удаляются: иначе удаление разошлось бы по всем клиентам
+        failed_paths = set(scanner.failed_paths)
+        kept = 0
+        for path in exists_paths:
+            if failed_paths and is_inside(path, failed_paths):
+                kept += 1
+                continue
+            writer.delete(path)
+        if kept:
+            print('Записи, которые не удалось проверить из-за ошибок чтения, сохранены: {}'.format(kept))
+        run.count('записей добавлено', len(writer.inserts))
+        run.count('записей обновлено', len(writer.updates))
+        run.count('записей удалено', len(writer.deletes))
+        with run.span('запись БД'):
+            writer.flush()
+
+        # Сведения о проекте и обрезка журнала изменений
+        project_root = project_path.replace("\\", "/").rstrip('/')
+        with run.span('запись БД'), connections.transaction(self.db_path) as cursor:
+            # прежний корень сохраняется, пока в нем лежат все объекты проекта:
+            # от него зависят пути в локальных хранилищах пользователей
+            stored_root = get_project_meta(cursor, 'root')
+            if (stored_root and is_inside(stored_root, set([project_root]))
+                    and all(is_inside(record[1], set([stored_root])) for record in records)):
+                project_root = stored_root
+            set_project_meta(cursor, {'root': project_root, 'name': project_root.rsplit('/', 1)[-1],
+                                      'updated_at': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                                      'updated_by': self.username})
+            cursor.execute('''DELETE FROM change_log
+                           WHERE seq <= (SELECT MAX(seq) FROM change_log) - ?''', (CHANGE_LOG_KEEP,))
+        self.common_root = project_root
+        print('База данных обновлена')
         #создание и обновление таблицы с информацией о последнем пользователе
         self.init_user_track()
         self.update_last_user()
@@ -163,249 +541,193 @@ class CADFolderDB():
         '''
         Метод для установки режима "Только для чтения"
         '''
-        try:
-            os.chmod(file_path, stat.S_IREAD)
-        except Exception as e:
-            print("Ошибка при установке атрибута 'только для чтения' для {}: {}".format(file_path,e))
+        set_read_only(file_path)
 
     def get_common_network_root(self):
         '''
-        Получает самую общую папку из всех путей в базе данных.
+        Корень проекта на сетевом диске. Хранится в таблице project_meta
+        и записывается при обновлении проекта
         '''
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-
-                # Получение всех путей из базы данных
-                cursor.execute("SELECT network_path FROM file_structure WHERE type = 'directory'")
-                all_paths = [row[0] for row in cursor.fetchall()]
-
-                if not all_paths:
-                    return ''
-
-            # Разделяем пути на части
-            path_parts = [path.split('/') for path in all_paths]
-
-            # Находим общий префикс
-            common_parts = path_parts[0]
-            for parts in path_parts[1:]:
-                common_length = 0
-                for i, (a, b) in enumerate(zip(common_parts, parts)):
-                    if a == b:
-                        common_length += 1
-                    else:
-                        break
-                common_parts = common_parts[:common_length]
-
-            # Собираем общий путь
-            common_root = '/'.join(common_parts)
-            return common_root
-
+            with connections.transaction(replica.read_path()) as cursor:
+                return get_project_meta(cursor, 'root', '')
         except sqlite3.Error as e:
             print("Ошибка получения общей папки: {}".format(e))
             return ''
 
-    def sync_to_local(self):
+    def get_local_root(self):
         '''
-        Метод для синхронизации данных с сетевого диска на локальный.
-        Работает как на полный перенос, так и на обновление в соответствии с данными в главной БД
+        Путь к проекту в локальном хранилище пользователя
         '''
-        try:
-            synced_local_paths = self.sync_directories()
-            self.sync_files(synced_local_paths)
+        return os.path.join(get_vault_dir(), 'YKProject')
 
-            # Удаление файлов и папок, которых нет на сетевом диске
-            user_name = getuser()
-            user_db = project_root + '\\databases\\CADFolder_{}.db'.format(user_name)
+    def get_sync_state(self, user_cursor, key):
+        user_cursor.execute('SELECT value FROM sync_state WHERE key = ?', (key,))
+        row = user_cursor.fetchone()
+        return row[0] if row else None
 
-            try:
-                with sqlite3.connect(user_db) as user_conn:
-                    user_cursor = user_conn.cursor()
-
-                    user_cursor.execute("SELECT local_path FROM file_structure")
-                    local_paths = set(row[0] for row in user_cursor.fetchall())
-
-                    paths_to_delete = local_paths - synced_local_paths
-
-                    for path in paths_to_delete:
-                        if os.path.exists(path):
-                            try:
-                                if os.path.isfile(path):
-                                    os.chmod(path, 0o666)
-                                    os.remove(path)
-                                    print('Удален файл {}'.format(path))
-                                elif os.path.isdir(path):
-                                    os.chmod(path, 0o666)
-                                    shutil.rmtree(path, ignore_errors=True)
-                                    print('Удалена папка {}'.format(path))
-                                user_cursor.execute("DELETE FROM file_structure WHERE local_path = ?", (path,))
-                            except Exception as e:
-                                print("Ошибка при удалении {}: {}".format(path, e))
-
-                    user_conn.commit()
-                    print('Локальная синхронизация завершена.')
-
-            except sqlite3.Error as e:
-                print("Ошибка синхронизации с локальным хранилищем: {}".format(e))
+    def set_sync_state(self, user_cursor, key, value):
+        user_cursor.execute('INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)', (key, value))
 
-        except (sqlite3.Error, OSError) as e:
-            print("Ошибка синхронизации: {}".format(e))
-        
-    def sync_files(self, synced_local_paths):
+    def get_sync_rules(self, user_cursor):
+        user_cursor.execute('SELECT network_path FROM sync_rules ORDER BY network_path')
+        return [row[0] for row in user_cursor.fetchall()]
+
+    def load_sync_rules(self):
         '''
-        Метод для синхронизации файлов с сетевого диска на локальный.
+        Правила выборочной синхронизации: сетевые пути выбранных папок и файлов
         '''
-        user_name = getuser()
-        user_db = project_root + '\\databases\\CADFolder_{}.db'.format(user_name)
-        local_root = os.path.join(os.getenv('USERPROFILE'), 'AppData', 'NerpaSyncVault', 'YKProject')
-    
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                # Получение файлов
-                cursor.execute("SELECT network_path, last_modified FROM file_structure WHERE type='file'")
-                network_files = cursor.fetchall()
-
-
-            with sqlite3.connect(user_db) as user_conn:
-                user_cursor = user_conn.cursor()
-                for network_path, last_modified in network_files:
-                    local_file_path = (local_root+network_path.replace(self.common_root, '')).replace('/', '\\')
-                    local_file_name = os.path.basename(local_file_path)
-
-                    user_cursor.execute('''
-                        SELECT last_modified FROM file_structure WHERE name = ? AND local_path = ? AND type = 'file'
-                    ''', (local_file_name, local_file_path))
-                    exists = user_cursor.fetchone()
-
-                    synced_local_paths.add(local_file_path)
-
-                    if not exists:
-                        local_file_dir = os.path.dirname(local_file_path)
-                        os.makedirs(local_file_dir, exist_ok=True)
-                        user_cursor.execute('''
-                            INSERT INTO file_structure 
-                            (name, local_path, status, type, last_modified)
-                            VALUES (?, ?, ?, ?, ?)
-                        ''', (local_file_name, local_file_path, 'Зарегистрирован', 'file', last_modified))
-                        shutil.copy2(network_path, local_file_path)
-                        print('Копирование файла {} в {}'.format(local_file_name, local_file_path))
-                        self.set_read_only(local_file_path)
-                    elif exists[0] != last_modified:
-                        try:
-                            # Снятие режима "Только для чтения" перед обновлением
-                            os.chmod(local_file_path, 0o666)
-                            shutil.copy2(network_path, local_file_path)
-                            user_cursor.execute('''
-                                UPDATE file_structure
-                                SET last_modified = ?, status = 'Обновлено'
-                                WHERE local_path = ? AND type = 'file'
-                            ''', (last_modified, local_file_path))
-                            print('Обновлен файл {} в {}'.format(local_file_name, local_file_path))
-                            self.set_read_only(local_file_path)
-                        except Exception as e:
-                            print('Неудачная попытка обновить файл по пути {}. Возможно, этот документ открыт в Компас. Код ошибки: {}'.format(local_file_path, e))
+        with connections.transaction(self.user_db) as user_cursor:
+            return self.get_sync_rules(user_cursor)
 
-        except sqlite3.Error as e:
-            print("Ошибка синхронизации файлов: {}".format(e))
-
-    def sync_directories(self):
+    def set_sync_rules(self, paths):
         '''
-        Метод для синхронизации директорий с сетевого диска на локальный.
+        Сохраняет правила выборочной синхронизации (пустой список - весь проект).
+        Сохраненный номер изменения сбрасывается: новые папки не попадают
+        в журнал изменений, поэтому следующая синхронизация строит полный план
         '''
-        user_name = getuser()
-        user_db = project_root + '\\databases\\CADFolder_{}.db'.format(user_name)
-        local_root = os.path.join(os.getenv('USERPROFILE'), 'AppData', 'NerpaSyncVault', 'YKProject')
+        with connections.transaction(self.user_db) as user_cursor:
+            user_cursor.execute('DELETE FROM sync_rules')
+            user_cursor.executemany('INSERT INTO sync_rules (network_path) VALUES (?)',
+                                    [(path,) for path in normalize_sync_rules(paths)])
+            user_cursor.execute("DELETE FROM sync_state WHERE key = 'last_seq'")
 
+    def count_unselected(self, rules):
+        '''
+        Количество локальных копий файлов, которые синхронизация удалит
+        из локального хранилища при правилах выборочной синхронизации rules
+        '''
+        planner = SyncPlanner(self.common_root, self.get_local_root())
+        with connections.transaction(replica.path()) as cursor, \
+                connections.transaction(self.user_db) as user_cursor:
+            local_paths = set(planner.relative_local_path(row[0]) for row in user_cursor.execute(
+                "SELECT local_path FROM file_structure WHERE type = 'file'"))
+            keep = [row[0] for row in cursor.execute(
+                'SELECT network_path FROM file_structure WHERE status = ?', (self.username,))]
+            scope = SyncScope(rules, keep)
+            return sum(1 for (network_path,) in cursor.execute(
+                "SELECT network_path FROM file_structure WHERE type = 'file'")
+                if not scope.includes(network_path) and planner.relative_network_path(network_path) in local_paths)
+
+    def plan_sync(self):
+        '''
+        Строит план синхронизации.
+        Если в пользовательской БД сохранен номер последнего примененного изменения
+        и журнал change_log не обрезан дальше него, загружаются только пути,
+        измененные с тех пор. Иначе обе БД загружаются целиком.
+        Номер последнего изменения, учтенного в плане, сохраняется в plan.sequence.
+        Главная БД читается из локальной копии, обновленной перед построением плана.
+        При выборочной синхронизации в план попадают только выбранные папки,
+        а разрегистрированные пользователем файлы не удаляются
+        '''
+        planner = SyncPlanner(self.common_root, self.get_local_root())
+        network_query = "SELECT network_path, type, last_modified, size, mtime_ns FROM file_structure"
+        local_query = "SELECT local_path, type, last_modified, size, mtime_ns FROM file_structure"
+
+        with connections.transaction(replica.read_path()) as cursor, \
+                connections.transaction(self.user_db) as user_cursor:
+            conn = cursor.connection
+            user_conn = user_cursor.connection
+            last_seq = self.get_sync_state(user_cursor, 'last_seq')
+            rules = self.get_sync_rules(user_cursor)
+            # чтение журнала и таблицы в одной транзакции, чтобы номер и данные были согласованы
+            conn.execute('BEGIN')
+            min_seq, max_seq = conn.execute('SELECT MIN(seq), MAX(seq) FROM change_log').fetchone()
+            max_seq = max_seq or 0
+
+            if last_seq is not None and (min_seq is None or min_seq <= int(last_seq) + 1):
+                changed_paths = [row[0] for row in conn.execute(
+                    'SELECT DISTINCT network_path FROM change_log WHERE seq > ?', (int(last_seq),))]
+                network_rows = []
+                local_rows = []
+                for i in range(0, len(changed_paths), SQL_VARIABLES_LIMIT):
+                    chunk = changed_paths[i:i + SQL_VARIABLES_LIMIT]
+                    placeholders = ', '.join('?' * len(chunk))
+                    network_rows.extend(conn.execute(
+                        network_query + ' WHERE network_path IN ({})'.format(placeholders), chunk))
+                    local_rows.extend(user_conn.execute(
+                        local_query + ' WHERE local_path IN ({})'.format(placeholders),
+                        [planner.to_local_path(path) for path in chunk]))
+            else:
+                network_rows = conn.execute(network_query).fetchall()
+                local_rows = user_conn.execute(local_query).fetchall()
+            if rules:
+                keep = [row[0] for row in conn.execute(
+                    'SELECT network_path FROM file_structure WHERE status = ?', (self.username,))]
+                planner.scope = SyncScope(rules, keep)
+            conn.rollback()
+
+        plan = planner.plan(network_rows, local_rows)
+        plan.sequence = max_seq
+        if plan.delete:
+            # после смены корня проекта локальные пути меняются, и прежние копии
+            # разрегистрированных файлов не удаляются
+            with connections.transaction(replica.path()) as cursor:
+                cursor.execute("SELECT name FROM file_structure WHERE status = ? AND type = 'file'",
+                               (self.username,))
+                kept = plan.keep_files(set(row[0] for row in cursor.fetchall()))
+            if kept:
+                print('Локальные копии разрегистрированных файлов не удаляются: {}'.format(kept))
+        return plan
+
+    @stats.operation('sync_to_local')
+    def sync_to_local(self, cancel_event=None):
+        '''
+        Метод для синхронизации данных с сетевого диска на локальный.
+        Работает как на полный перенос, так и на обновление в соответствии с данными в главной БД.
+        cancel_event - событие для прерывания синхронизации из другого потока
+        '''
         if not self.common_root:
             print("Не удалось определить общую папку.")
-            return set()
+            return
 
+        run = stats.current()
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                # Получение директорий
-                cursor.execute("SELECT network_path, last_modified FROM file_structure WHERE type='directory'")
-                network_directories = cursor.fetchall()
-            
-            with sqlite3.connect(user_db) as user_conn:
-                user_cursor = user_conn.cursor()
-                user_cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS file_structure (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT,
-                    local_path TEXT,
-                    status TEXT,
-                    type TEXT,
-                    last_modified TEXT
-                    )
-                ''')
-                synced_local_paths = set()
-
-                for network_path, last_modified in network_directories:
-                    local_directory_path = (local_root+network_path.replace(self.common_root, '')).replace('/', '\\')
-                    local_directory_name = os.path.basename(local_directory_path)
-
-                    # Проверка существования записи в пользовательской БД
-                    user_cursor.execute('''
-                        SELECT last_modified FROM file_structure WHERE name = ? AND local_path = ? AND type = 'directory'
-                    ''', (local_directory_name, local_directory_path))
-                    exists = user_cursor.fetchone()
-
-                    synced_local_paths.add(local_directory_path)
-
-                    if not exists:
-                        user_cursor.execute('''
-                            INSERT INTO file_structure 
-                            (name, local_path, status, type, last_modified)
-                            VALUES (?, ?, ?, ?, ?)
-                        ''', (local_directory_name, local_directory_path, 'Зарегистрирован', 'directory', last_modified))
-                        os.makedirs(local_directory_path, exist_ok=True)
-                        print('Создана папка по пути {}'.format(local_directory_path))
-                    elif exists[0] != last_modified:
-                        user_cursor.execute('''
-                            UPDATE file_structure
-                            SET last_modified = ?, status = 'Обновлено'
-                            WHERE local_path = ? AND type = 'directory'
-                        ''', (last_modified, local_directory_path))
-                        print('Обновлена папка по пути {}'.format(local_directory_path))
-
-                return synced_local_paths
+            with run.span('план'):
+                plan = self.plan_sync()
+            print('План синхронизации: {}'.format(plan.summary()))
+
+            # копирование идет без открытой транзакции, изменения БД записываются в конце
+            executor = SyncExecutor(BatchWriter(self.user_db, 'local_path'), cancel_event=cancel_event)
+            executor.execute(plan)
+            # при ошибках и отмене номер не сохраняется, и следующая синхронизация повторит те же изменения
+            if not executor.failed and not executor.cancelled:
+                with connections.transaction(self.user_db) as user_cursor:
+                    self.set_sync_state(user_cursor, 'last_seq', plan.sequence)
+            if executor.cancelled:
+                run.set_status('cancelled')
+                print('Локальная синхронизация отменена.')
+            else:
+                print('Локальная синхронизация завершена.')
 
-        except sqlite3.Error as e:
-            print("Ошибка синхронизации директорий: {}".format(e))
-            return set()
+        except (sqlite3.Error, OSError) as e:
+            run.set_status('error')
+            print("Ошибка синхронизации: {}".format(e))
 
+    @stats.operation('update_file_status')
     def update_file_status(self, file_name, action):
         '''
         Метод по установки статусов "Зарегистрировано" и "Разрегистрировано"
         '''
         # Подключение к главной базе данных
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
             print('Подключение к главной БД')
             # Поиск файла по имени
-            cursor.execute("SELECT network_path FROM file_structure WHERE name = ?", (file_name,))
-            result = cursor.fetchone()
-            conn.close()
+            with connections.transaction(self.db_path) as cursor:
+                cursor.execute("SELECT network_path FROM file_structure WHERE name = ?", (file_name,))
+                result = cursor.fetchone()
 
             if result:
                 network_file_path = result[0]
                 if action == "unregister":
                     # Обновление статуса в главной базе данных
-                    conn = sqlite3.connect(self.db_path)
-                    cursor = conn.cursor()
-                    cursor.execute("UPDATE file_structure SET status = ? WHERE name = ?", (getuser(), file_name))
-                    conn.commit()
-                    conn.close()
+                    with connections.transaction(self.db_path) as cursor:
+                        cursor.execute("UPDATE file_structure SET status = ? WHERE name = ?", (getuser(), file_name))
 
                     # Получение пути к файлу на локальном диске
-                    user_conn = sqlite3.connect(self.user_db)
-                    user_cursor = user_conn.cursor()
-                    user_cursor.execute("SELECT local_path FROM file_structure WHERE name = ?", (file_name,))
-                    local_file_path = user_cursor.fetchone()[0]
-                    user_conn.close()
+                    with connections.transaction(self.user_db) as user_cursor:
+                        user_cursor.execute("SELECT local_path FROM file_structure WHERE name = ?", (file_name,))
+                        local_file_path = user_cursor.fetchone()[0]
                     local_file_path = os.path.normpath(local_file_path)
 
                     # Снятие атрибута "только для чтения" на локальном диске
@@ -415,11 +737,9 @@ class CADFolderDB():
 
                 elif action == "register":
                     # Создание локального пути к файлу
-                    user_conn = sqlite3.connect(self.user_db)
-                    user_cursor = user_conn.cursor()
-                    user_cursor.execute("SELECT local_path FROM file_structure WHERE name = ?", (file_name,))
-                    local_file_path = user_cursor.fetchone()[0]
-                    user_conn.close()
+                    with connections.transaction(self.user_db) as user_cursor:
+                        user_cursor.execute("SELECT local_path FROM file_structure WHERE name = ?", (file_name,))
+                        local_file_path = user_cursor.fetchone()[0]
                     local_file_path = os.path.normpath(local_file_path)
 
                     # Отладочная информация
@@ -429,34 +749,41 @@ class CADFolderDB():
                         print("Ошибка: Локальный файл {} не найден".format(local_file_path))
                         return
 
-                    # Снятие атрибута с локального файла "только для чтения"
-                    os.chmod(network_file_path, 0o666)
-
-                    # Копирование файла с локального хранилища на сетевой диск с заменой
-                    shutil.copy2(local_file_path, network_file_path)
+                    # Файл не копируется, если его размер и время изменения совпадают с сетевой копией
+                    if get_change_key(local_file_path) != get_change_key(network_file_path):
+                        # Снятие атрибута с локального файла "только для чтения"
+                        os.chmod(network_file_path, 0o666)
+
+                        # Копирование файла с локального хранилища на сетевой диск с заменой.
+                        # У больших файлов перезаписываются только измененные блоки
+                        with stats.current().span('копирование'):
+                            transferred, size = push_delta(local_file_path, network_file_path)
+                        stats.current().count('байт скопировано', transferred)
+                        if transferred < size:
+                            print("Передано {:.1f} из {:.1f} МБ".format(transferred / 1048576.0, size / 1048576.0))
+                    else:
+                        print("Файл {} не изменялся, копирование не требуется".format(file_name))
 
                     # Установка атрибута "только для чтения" для сетевого и локального файлов
-                    self.set_read_only(network_file_path)
-                    self.set_read_only(local_file_path)
+                    with stats.current().span('chmod'):
+                        self.set_read_only(network_file_path)
+                        self.set_read_only(local_file_path)
 
                     SetStatusDoc(read_only=True, file_path=local_file_path)
 
                     # Обновление статуса в базе данных
-                    conn = sqlite3.connect(self.db_path)
-                    cursor = conn.cursor()
-                    last_modified = self.get_last_modified_time(network_file_path)
-                    cursor.execute("UPDATE file_structure SET status = 'Зарегистрирован' WHERE name = ?", (file_name,))
-                    cursor.execute("UPDATE file_structure SET last_modified = ? WHERE name = ?", (last_modified, file_name))
+                    size, mtime_ns = get_change_key(network_file_path)
+                    last_modified = format_mtime_ns(mtime_ns)
+                    with connections.transaction(self.db_path) as cursor:
+                        cursor.execute("UPDATE file_structure SET status = 'Зарегистрирован' WHERE name = ?", (file_name,))
+                        cursor.execute("UPDATE file_structure SET last_modified = ?, size = ?, mtime_ns = ? WHERE name = ?",
+                                       (last_modified, size, mtime_ns, file_name))
                     print("Файл {} зарегистрирован и скопирован на сетевой диск".format(file_name))
-                    conn.commit()
-                    conn.close()
-
-                    user_conn = sqlite3.connect(self.user_db)
-                    user_cursor = user_conn.cursor()
-                    user_cursor.execute("UPDATE file_structure SET status = 'Зарегистрирован' WHERE name = ?", (file_name,))
-                    user_cursor.execute("UPDATE file_structure SET last_modified = ? WHERE name = ?", (last_modified, file_name))
-                    user_conn.commit()
-                    user_conn.close()
+
+                    with connections.transaction(self.user_db) as user_cursor:
+                        user_cursor.execute("UPDATE file_structure SET status = 'Зарегистрирован' WHERE name = ?", (file_name,))
+                        user_cursor.execute("UPDATE file_structure SET last_modified = ?, size = ?, mtime_ns = ? WHERE name = ?",
+                                            (last_modified, size, mtime_ns, file_name))
 
         except (sqlite3.Error, OSError) as e:
             print("Ошибка синхронизации с локальным хранилищем: {}".format(e))
@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import zlib
+import hashlib
+from collections import namedtuple
+
+from .ScanModule import get_change_key, SIGNATURE_SUFFIX, TEMP_SUFFIX, CHECKPOINT_SUFFIX
+
+
+# Размер блока сигнатуры. Документы КОМПАС хранятся в составном формате
+# с выравниванием по секторам, поэтому изменения в основном попадают в целые блоки
+BLOCK_SIZE = 64 * 1024
+# Файлы меньше этого размера всегда копируются целиком
+DELTA_MIN_SIZE = 1024 * 1024
+# Если передать нужно больше этой доли файла, выполняется обычное копирование
+FULL_COPY_RATIO = 0.6
+# Поиск блоков со смещением (скользящая контрольная сумма) идет побайтно в Python
+# и занимает GIL, поэтому выполняется только для небольших файлов, только если
+# после сравнения блоков на своих местах не найдено немного блоков, и только рядом
+# с их местом. Иначе недостающие блоки передаются, а при большой доле - файл копируется целиком
+MAX_ROLLING_SIZE = 2 * 1024 * 1024
+MAX_ROLLING_MISSING = 4
+# Размер фрагмента при копировании через временный файл
+COPY_CHUNK_SIZE = 1024 * 1024
+# Файлы не меньше этого размера копируются с контрольными точками,
+# и прерванное копирование продолжается с последнего проверенного фрагмента
+RESUME_MIN_SIZE = 8 * 1024 * 1024
+# Контрольная точка записывается через каждые столько фрагментов
+CHECKPOINT_CHUNKS = 8
+
+ADLER_MOD = 65521
+
+# Сигнатура файла: ключ изменения файла, для которого она построена,
+# размер блока и список (слабая контрольная сумма, md5) для каждого блока
+Signature = namedtuple('Signature', ['size', 'mtime_ns', 'block_size', 'blocks'])
+
+
+def replace_file(source, target):
+    '''
+    Замена target файлом source. os.replace отсутствует в Python 3.2
+    '''
+    if hasattr(os, 'replace'):
+        os.replace(source, target)
+    else:
+        if os.path.exists(target):
+            os.remove(target)
+        os.rename(source, target)
+
+
+def weak_checksum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+def strong_checksum(data):
+    return hashlib.md5(data).hexdigest()
+
+
+class RollingChecksum:
+    '''
+    Скользящая контрольная сумма Adler-32 по окну фиксированной длины.
+    Значение совпадает с zlib.adler32 для того же окна
+    '''
+    def __init__(self, window):
+        self.length = len(window)
+        self.a = 1
+        self.b = 0
+        for byte in window:
+            self.a = (self.a + byte) % ADLER_MOD
+            self.b = (self.b + self.a) % ADLER_MOD
+
+    def digest(self):
+        return (self.b << 16) | self.a
+
+    def roll(self, byte_out, byte_in):
+        self.a = (self.a - byte_out + byte_in) % ADLER_MOD
+        self.b = (self.b - self.length * byte_out + self.a - 1) % ADLER_MOD
+
+
+def signature_path(file_path):
+    return file_path + SIGNATURE_SUFFIX
+
+
+def compute_signature(file_path, block_size=BLOCK_SIZE):
+    size, mtime_ns = get_change_key(file_path)
+    blocks = []
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            blocks.append((weak_checksum(data), strong_checksum(data)))
+    return Signature(size, mtime_ns, block_size, blocks)
+
+
+def load_signature(file_path, change_key=None):
+    '''
+    Загружает сигнатуру из файла рядом с file_path.
+    Возвращает None, если ее нет или она построена для другой версии файла
+    '''
+    try:
+        with open(signature_path(file_path), 'r') as f:
+            data = json.load(f)
+        if change_key is None:
+            change_key = get_change_key(file_path)
+        if (data['size'], data['mtime_ns']) != tuple(change_key):
+            return None
+        return Signature(data['size'], data['mtime_ns'], data['block_size'],
+                         [tuple(block) for block in data['blocks']])
+    except (OSError, IOError, ValueError, KeyError):
+        return None
+
+
+def save_signature(file_path, signature):
+    '''
+    Сохраняет сигнатуру рядом с файлом, привязывая ее к текущему ключу изменения файла.
+    Сигнатура - только кэш, поэтому ошибка записи не считается ошибкой передачи
+    '''
+    try:
+        size, mtime_ns = get_change_key(file_path)
+        with open(signature_path(file_path), 'w') as f:
+            json.dump({'size': size, 'mtime_ns': mtime_ns,
+                       'block_size': signature.block_size,
+                       'blocks': signature.blocks}, f)
+        return True
+    except (OSError, IOError):
+        return False
+
+
+def remove_signature(file_path):
+    try:
+        os.remove(signature_path(file_path))
+    except OSError:
+        pass
+
+
+def get_signature(file_path, block_size=BLOCK_SIZE):
+    '''
+    Сигнатура локального файла: из кэша, если он актуален, иначе вычисляется и сохраняется
+    '''
+    signature = load_signature(file_path)
+    if signature is None or signature.block_size != block_size:
+        signature = compute_signature(file_path, block_size)
+        save_signature(file_path, signature)
+    return signature
+
+
+def _block_length(index, signature):
+    return min(signature.block_size, signature.size - index * signature.block_size)
+
+
+def checkpoint_path(temp_path):
+    return temp_path + CHECKPOINT_SUFFIX
+
+
+def load_checkpoint(temp_path, change_key, chunk_size):
+    '''
+    Список md5 фрагментов, уже записанных во временный файл.
+    Пустой, если контрольной точки нет или она сделана для другой версии источника
+    '''
+    try:
+        with open(checkpoint_path(temp_path), 'r') as f:
+            data = json.load(f)
+        if (data['size'], data['mtime_ns']) != tuple(change_key) or data['chunk_size'] != chunk_size:
+            return []
+        return list(data['chunks'])
+    except (OSError, IOError, ValueError, KeyError):
+        return []
+
+
+def save_checkpoint(temp_path, change_key, chunk_size, chunks):
+    '''
+    Запись контрольной точки через временный файл, чтобы обрыв связи
+    не оставил ее обрезанной
+    '''
+    path = checkpoint_path(temp_path)
+    with open(path + TEMP_SUFFIX, 'w') as f:
+        json.dump({'size': change_key[0], 'mtime_ns': change_key[1],
+                   'chunk_size': chunk_size, 'chunks': chunks}, f)
+    replace_file(path + TEMP_SUFFIX, path)
+
+
+def remove_checkpoint(temp_path):
+    try:
+        os.remove(checkpoint_path(temp_path))
+    except OSError:
+        pass
+
+
+def verified_chunks(temp_path, chunks, chunk_size):
+    '''
+    Количество фрагментов из контрольной точки, которые можно не передавать повторно.
+    Данные до контрольной точки записаны на диск до нее, поэтому проверяется
+    только последний фрагмент: при несовпадении он передается заново
+    '''
+    try:
+        if not chunks or os.path.getsize(temp_path) < len(chunks) * chunk_size:
+            return 0
+        with open(temp_path, 'rb') as f:
+            f.seek((len(chunks) - 1) * chunk_size)
+            if strong_checksum(f.read(chunk_size)) == chunks[-1]:
+                return len(chunks)
+        return len(chunks) - 1
+    except (OSError, IOError):
+        return 0
+
+
+def staged_copy(source, target, chunk_size=COPY_CHUNK_SIZE):
+    '''
+    Копирование source в target через временный файл рядом с target,
+    который после записи переименовывается в target. При обрыве связи
+    target остается в прежнем состоянии, а не обрезанным.
+    Для больших файлов рядом с временным файлом хранится контрольная точка
+    (ключ изменения source и md5 записанных фрагментов), и повторное копирование
+    того же файла продолжается с последнего проверенного фрагмента.
+    Возвращает количество переданных байт
+    '''
+    temp_path = target + TEMP_SUFFIX
+    change_key = get_change_key(source)
+    resumable = change_key[0] >= RESUME_MIN_SIZE
+    chunks = []
+    if resumable:
+        chunks = load_checkpoint(temp_path, change_key, chunk_size)
+        chunks = chunks[:verified_chunks(temp_path, chunks, chunk_size)]
+
+    transferred = 0
+    try:
+        with open(source, 'rb') as src, open(temp_path, 'r+b' if chunks else 'wb') as out:
+            src.seek(len(chunks) * chunk_size)
+            out.seek(len(chunks) * chunk_size)
+            out.truncate()
+            while True:
+                data = src.read(chunk_size)
+                if not data:
+                    break
+                out.write(data)
+                transferred += len(data)
+                if resumable:
+                    chunks.append(strong_checksum(data))
+                    if len(chunks) % CHECKPOINT_CHUNKS == 0:
+                        out.flush()
+                        os.fsync(out.fileno())
+                        save_checkpoint(temp_path, change_key, chunk_size, chunks)
+        shutil.copystat(source, temp_path)
+        if os.path.exists(target):
+            # снятие режима "Только для чтения", иначе замена файла недоступна
+            os.chmod(target, 0o666)
+        replace_file(temp_path, target)
+    except Exception:
+        # временный файл большого файла остается для продолжения копирования
+        try:
+            os.chmod(temp_path, 0o666)
+            if not resumable:
+                os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    remove_checkpoint(temp_path)
+    return transferred
+
+
+def _full_copy(source, target):
+    return staged_copy(source, target)
+
+
+def server_copy_available():
+    '''
+    Доступно ли копирование в пределах сетевого диска на сервере (pywin32)
+    '''
+    try:
+        import win32file
+    except ImportError:
+        return False
+    return True
+
+
+def _remote_copy(source, target):
+    '''
+    Копирование файла в пределах сетевого диска. CopyFile Windows выполняет его
+    на сервере без передачи данных через клиент
+    '''
+    import win32file
+    win32file.CopyFile(source, target, False)
+
+
+def _patch_copy(source, target, changed, size, block_size):
+    '''
+    Запись блоков changed из source в копию target рядом с ним, которая затем
+    заменяет target. При обрыве связи target остается прежним.
+    Возвращает количество переданных байт
+    '''
+    temp_path = target + TEMP_SUFFIX
+    transferred = 0
+    # временный файл прерванного полного копирования больше не нужен
+    remove_checkpoint(temp_path)
+    try:
+        _remote_copy(target, temp_path)
+        os.chmod(temp_path, 0o666)
+        with open(source, 'rb') as src, open(temp_path, 'r+b') as dst:
+            for i in changed:
+                src.seek(i * block_size)
+                data = src.read(block_size)
+                dst.seek(i * block_size)
+                dst.write(data)
+                transferred += len(data)
+            dst.truncate(size)
+        shutil.copystat(source, temp_path)
+        # снятие режима "Только для чтения", иначе замена файла недоступна
+        os.chmod(target, 0o666)
+        replace_file(temp_path, target)
+    except Exception:
+        try:
+            os.chmod(temp_path, 0o666)
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return transferred
+
+
+def push_delta(source, target, block_size=BLOCK_SIZE):
+    '''
+    Обновление удаленного файла target по локальному файлу source.
+    Сравнивает блоки source с сигнатурой, сохраненной рядом с target,
+    и записывает только отличающиеся блоки в копию target, которая заменяет target.
+    Копия target создается на сервере, без pywin32 файл копируется целиком.
+    Возвращает (переданные байты, размер файла)
+    '''
+    source_signature = get_signature(source, block_size)
+    size = source_signature.size
+    target_signature = load_signature(target) if os.path.exists(target) else None
+
+    changed = None
+    if (size >= DELTA_MIN_SIZE and target_signature is not None
+            and target_signature.block_size == block_size):
+        target_blocks = target_signature.blocks
+        changed = [i for i, block in enumerate(source_signature.blocks)
+                   if i >= len(target_blocks) or target_blocks[i] != block]
+        transfer = sum(_block_length(i, source_signature) for i in changed)
+        if transfer > FULL_COPY_RATIO * size:
+            changed = None
+
+    # без копирования на сервере копия target прошла бы через клиент дважды,
+    # и передача блоков выйдет дороже полного копирования
+    if changed is None or not server_copy_available():
+        transferred = _full_copy(source, target)
+    else:
+        transferred = _patch_copy(source, target, changed, size, block_size)
+    save_signature(target, source_signature)
+    return transferred, size
+
+
+def _scan_window(data, start, block_size, wanted, matches):
+    '''
+    Поиск блоков в фрагменте data старой версии (start - смещение фрагмента)
+    скользящей контрольной суммой. Найденные блоки добавляются в matches
+    '''
+    rolling = RollingChecksum(data[:block_size])
+    offset = 0
+    end = len(data) - block_size
+    while True:
+        candidates = wanted.get(rolling.digest())
+        if candidates:
+            strong = None
+            for i, wanted_strong in candidates:
+                if i in matches:
+                    continue
+                if strong is None:
+                    strong = strong_checksum(data[offset:offset + block_size])
+                if strong == wanted_strong:
+                    matches[i] = start + offset
+        if offset >= end:
+            break
+        rolling.roll(data[offset], data[offset + block_size])
+        offset += 1
+
+
+def _find_local_blocks(basis, basis_signature, wanted):
+    '''
+    Поиск блоков новой версии файла в старой локальной версии basis.
+    wanted - словарь {слабая сумма: [(индекс блока, md5), ...]}.
+    Возвращает {индекс блока: смещение в basis}
+    '''
+    matches = {}
+    block_size = basis_signature.block_size
+    # блоки старой версии на своих местах - по сохраненной сигнатуре, без чтения файла
+    for j, (weak, strong) in enumerate(basis_signature.blocks):
+        for i, wanted_strong in wanted.get(weak, ()):
+            if i not in matches and wanted_strong == strong:
+                matches[i] = j * block_size
+
+    missing = sorted(i for candidates in wanted.values() for i, strong in candidates if i not in matches)
+    if (not missing or len(missing) > MAX_ROLLING_MISSING or basis_signature.size > MAX_ROLLING_SIZE
+            or basis_signature.size < block_size):
+        return matches
+
+    # блоки, сдвинутые относительно границ небольшой вставкой или удалением, -
+    # скользящей контрольной суммой в окрестности своего места (соседние блоки)
+    with open(basis, 'rb') as f:
+        for i in missing:
+            if i in matches:
+                continue
+            start = max(0, (i - 1) * block_size)
+            f.seek(start)
+            data = f.read(3 * block_size)
+            if len(data) >= block_size:
+                _scan_window(data, start, block_size, wanted, matches)
+    return matches
+
+
+def pull_delta(source, target, block_size=BLOCK_SIZE):
+    '''
+    Обновление локального файла target по удаленному файлу source.
+    По сигнатуре рядом с source определяет, какие блоки уже есть в target,
+    читает из source только недостающие и собирает новую версию во временном
+    файле рядом с target. Возвращает (переданные байты, размер файла)
+    '''
+    signature = load_signature(source)
+    if (signature is None or signature.size < DELTA_MIN_SIZE
+            or signature.block_size != block_size or not os.path.exists(target)):
+        transferred = _full_copy(source, target)
+        if transferred >= DELTA_MIN_SIZE:
+            get_signature(target, block_size)
+        return transferred, transferred
+
+    wanted = {}
+    for i, (weak, strong) in enumerate(signature.blocks):
+        wanted.setdefault(weak, []).append((i, strong))
+    matches = _find_local_blocks(target, get_signature(target, block_size), wanted)
+
+    transfer = sum(_block_length(i, signature) for i in range(len(signature.blocks)) if i not in matches)
+    if transfer > FULL_COPY_RATIO * signature.size:
+        transferred = _full_copy(source, target)
+        get_signature(target, block_size)
+        return transferred, transferred
+
+    temp_path = target + TEMP_SUFFIX
+    # временный файл собирается заново, контрольная точка прерванного копирования больше не нужна
+    remove_checkpoint(temp_path)
+    transferred = 0
+    try:
+        with open(target, 'rb') as basis, open(source, 'rb') as src, open(temp_path, 'wb') as out:
+            for i, (weak, strong) in enumerate(signature.blocks):
+                if i in matches:
+                    basis.seek(matches[i])
+                    data = basis.read(_block_length(i, signature))
+                else:
+                    src.seek(i * block_size)
+                    data = src.read(_block_length(i, signature))
+                    transferred += len(data)
+                if strong_checksum(data) != strong:
+                    raise ValueError('контрольная сумма блока {} не совпадает'.format(i))
+                out.write(data)
+        shutil.copystat(source, temp_path)
+        os.chmod(target, 0o666)
+        replace_file(temp_path, target)
+    except (OSError, IOError, ValueError):
+        # при любой ошибке сборки файл копируется целиком.
+        # copystat мог установить "Только для чтения", без его снятия файл в Windows не удалить
+        if os.path.exists(temp_path):
+            os.chmod(temp_path, 0o666)
+            os.remove(temp_path)
+        transferred = _full_copy(source, target)
+        get_signature(target, block_size)
+        return transferred, signature.size
+
+    save_signature(target, signature)
+    return transferred, signature.size
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import uuid
+from getpass import getuser
+
+from .ConnectionModule import connections, get_main_db_path
+
+
+# Файл поколения лежит рядом с главной БД: CADFolder.db -> CADFolder.generation
+GENERATION_SUFFIX = '.generation'
+# Границы интервала проверки файла поколения, с. После изменений и действий
+# пользователя проверка идет часто, при простое интервал удваивается до максимума
+MIN_CHECK_INTERVAL = 0.5
+MAX_CHECK_INTERVAL = 8.0
+# Интервал проверки самой БД независимо от файла поколения, с. Нужен для изменений,
+# записанных без обновления поколения (клиенты прежних версий, миграции схемы)
+FULL_CHECK_INTERVAL = 30.0
+
+
+def get_generation_path(db_path):
+    return os.path.splitext(db_path)[0] + GENERATION_SUFFIX
+
+
+class GenerationFile:
+    '''
+    Маленький файл рядом с главной БД, содержимое которого меняется
+    после каждой зафиксированной транзакции, изменившей БД.
+    Клиенты читают его вместо обращения к самой БД на сетевом диске
+    Входные параметры:
+    db_path - функция, возвращающая путь к главной БД
+    '''
+    def __init__(self, db_path=get_main_db_path):
+        self.db_path = db_path
+
+    def path(self):
+        return get_generation_path(self.db_path())
+
+    def read(self):
+        '''
+        Текущее поколение или None, если файла нет или он недоступен
+        '''
+        try:
+            with open(self.path(), encoding='utf-8') as f:
+                return f.read().strip()
+        except (IOError, OSError, ValueError):
+            return None
+
+    def bump(self):
+        # Файл перезаписывается на месте: клиент, прочитавший его во время записи,
+        # увидит другое значение и лишний раз проверит БД
+        with open(self.path(), 'w', encoding='utf-8') as f:
+            f.write('{} {}\n'.format(uuid.uuid4().hex, getuser()))
+
+    def on_commit(self, db_path):
+        '''
+        Обработчик ConnectionManager.commit_callback
+        '''
+        if os.path.normcase(os.path.abspath(db_path)) != os.path.normcase(os.path.abspath(self.db_path())):
+            return
+        try:
+            self.bump()
+        except (IOError, OSError) as e:
+            print('Ошибка записи файла поколения БД: {}'.format(e))
+
+
+class GenerationWatcher:
+    '''
+    Адаптивная проверка файла поколения. should_check() читает файл и сообщает,
+    нужно ли проверять БД: поколение изменилось, файла нет или прошло
+    FULL_CHECK_INTERVAL. moved - поколение изменилось при последней проверке.
+    update() по итогу проверки задает следующий интервал,
+    poke() сбрасывает его до минимума после действий пользователя.
+    При недоступном файле интервал тоже увеличивается, а БД проверяется по времени изменения
+    Входные параметры:
+    generation - GenerationFile главной БД
+    min_interval, max_interval - границы интервала проверки, с
+    full_interval - интервал обязательной проверки БД, с
+    '''
+    def __init__(self, generation, min_interval=MIN_CHECK_INTERVAL, max_interval=MAX_CHECK_INTERVAL,
+                 full_interval=FULL_CHECK_INTERVAL):
+        self.generation = generation
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.full_interval = full_interval
+        self.interval = min_interval
+        self.seen = None
+        self.moved = False
+        self.checked_at = 0
+
+    def poke(self):
+        self.interval = self.min_interval
+
+    def should_check(self):
+        value = self.generation.read()
+        now = time.time()
+        if value is None or value != self.seen or now - self.checked_at >= self.full_interval:
+            self.moved = value is not None and value != self.seen
+            self.seen = value
+            self.checked_at = now
+            return True
+        return False
+
+    def reset(self):
+        '''
+        Следующая проверка обратится к БД (например, после ошибки)
+        '''
+        self.seen = None
+
+    def update(self, changed):
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+
+
+# Поколение главной БД, обновляется после каждой записи в нее
+generation = GenerationFile()
+connections.commit_callback = generation.on_commit
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import queue
+import traceback
+
+
+class JobCancelled(Exception):
+    '''
+    Исключение для прерывания задачи после запроса отмены
+    '''
+    pass
+
+
+class Job:
+    '''
+    Задача фонового выполнения.
+    name - название задачи для сообщений
+    resources - ресурсы, которые задача занимает (например, 'project'):
+    две задачи с общим ресурсом одновременно не выполняются
+    cancel_event - событие отмены, которое задача проверяет сама
+    '''
+    def __init__(self, name, func, args, kwargs, resources, on_done, on_error, on_progress):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.resources = frozenset(resources)
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+
+class JobRunner:
+    '''
+    Класс для выполнения долгих операций (синхронизация, обход проекта,
+    регистрация файлов) в рабочих потоках, чтобы не блокировать главный цикл Tk.
+    Результаты, ошибки и сообщения о ходе выполнения складываются в очередь
+    и обрабатываются в главном потоке вызовом process_events(),
+    который окно вызывает периодически через after.
+    Входные параметры:
+    max_workers - количество рабочих потоков
+    thread_init, thread_exit - функции, вызываемые в начале и в конце
+    каждого рабочего потока (например, инициализация COM)
+    on_change - функция, вызываемая в главном потоке при запуске и завершении задач
+    '''
+    def __init__(self, max_workers=2, thread_init=None, thread_exit=None, on_change=None):
+        self.thread_init = thread_init
+        self.thread_exit = thread_exit
+        self.on_change = on_change
+        self.jobs = queue.Queue()
+        self.events = queue.Queue()
+        self.running = []
+        self.lock = threading.Lock()
+        self.threads = []
+        for i in range(max(1, max_workers)):
+            thread = threading.Thread(target=self._worker, name='NerpaSyncJob-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def busy_resources(self):
+        with self.lock:
+            resources = set()
+            for job in self.running:
+                resources |= job.resources
+            return resources
+
+    def is_busy(self, resource):
+        return resource in self.busy_resources()
+
+    def submit(self, name, func, args=(), resources=(), on_done=None, on_error=None,
+               on_progress=None, cancellable=False):
+        '''
+        Ставит задачу в очередь. Если один из ресурсов занят другой задачей,
+        задача не ставится и возвращается None.
+        cancellable - передать в func аргумент cancel_event,
+        on_progress - передать в func аргумент progress для сообщений о ходе выполнения
+        '''
+        kwargs = {}
+        job = Job(name, func, args, kwargs, resources, on_done, on_error, on_progress)
+        with self.lock:
+            for running_job in self.running:
+                if running_job.resources & job.resources:
+                    return None
+            self.running.append(job)
+        if cancellable:
+            kwargs['cancel_event'] = job.cancel_event
+        if on_progress is not None:
+            kwargs['progress'] = lambda value: self.events.put((on_progress, (value,)))
+        self.jobs.put(job)
+        self._changed()
+        return job
+
+    def cancel(self, resource=None):
+        '''
+        Запрос отмены задач, занимающих resource, или всех задач
+        '''
+        with self.lock:
+            for job in self.running:
+                if resource is None or resource in job.resources:
+                    job.cancel()
+
+    def process_events(self):
+        '''
+        Обработка результатов задач. Вызывается только в главном потоке
+        '''
+        while True:
+            try:
+                callback, args = self.events.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                callback(*args)
+            except Exception as e:
+                print('Ошибка обработки результата задачи: {}'.format(e))
+
+    def shutdown(self):
+        '''
+        Отмена задач и остановка рабочих потоков
+        '''
+        self.cancel()
+        for _ in self.threads:
+            self.jobs.put(None)
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.events.put((self.on_change, ()))
+
+    def _finish(self, job):
+        with self.lock:
+            self.running.remove(job)
+        self._changed()
+
+    def _worker(self):
+        if self.thread_init is not None:
+            self.thread_init()
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                self._run(job)
+        finally:
+            if self.thread_exit is not None:
+                self.thread_exit()
+
+    def _run(self, job):
+        try:
+            if job.cancelled:
+                raise JobCancelled()
+            result = job.func(*job.args, **job.kwargs)
+        except JobCancelled:
+            self.events.put((print, ('Операция "{}" отменена'.format(job.name),)))
+        except Exception as e:
+            if job.on_error is not None:
+                self.events.put((job.on_error, (e,)))
+            else:
+                self.events.put((print, ('Ошибка при выполнении операции "{}": {}\n{}'.format(
+                    job.name, e, traceback.format_exc()),)))
+        else:
+            if job.on_done is not None:
+                self.events.put((job.on_done, (result,)))
+        finally:
+            # задача освобождает ресурсы только после того, как ее результат поставлен в очередь
+            self._finish(job)
@@ -1,45 +1,294 @@
 # -*- coding: utf-8 -*-
 
 import threading
-import pythoncom
-import win32com.client
 import time
+from collections import namedtuple
+
+from .KompasSession import kompas_sessions
+
+
+# Событие документа КОМПАС. kind - 'open', 'activate', 'save' или 'close',
+# name - имя файла документа, path - полный путь (пустой у несохраненного документа)
+DocumentEvent = namedtuple('DocumentEvent', ['kind', 'name', 'path'])
+
+# Интервалы опроса КОМПАС, с. После изменений опрос идет с минимальным
+# интервалом, при отсутствии изменений интервал удваивается до максимального.
+# Максимум не больше прежнего постоянного интервала опроса
+MIN_POLL_INTERVAL = 0.1
+MAX_POLL_INTERVAL = 0.5
+# Интервал страховочного опроса при подписке на события КОМПАС
+# и повторного подключения после закрытия КОМПАС, с
+EVENT_POLL_INTERVAL = 2.0
+# Интервал перечитывания ключей всех документов при неизменном количестве, с
+VERIFY_INTERVAL = 2.0
+
+
+def get_document_key(document):
+    '''
+    Ключ документа - полный путь, у несохраненного документа - имя
+    '''
+    return document.PathName or document.Name
+
+
+def get_documents_state(app, state=None, verify=False):
+    '''
+    Снимок состояния КОМПАС: (ключ активного документа, {ключ: (имя, путь, есть несохраненные изменения)}).
+    Ключи всех документов перечитываются, только если изменилось их количество,
+    активен неизвестный документ или задан verify (периодическая проверка, чтобы
+    обнаружить закрытие одного документа и открытие другого без смены активного).
+    Иначе по предыдущему снимку state обновляется только активный документ.
+    Имя, путь и признак изменений читаются только у новых документов
+    '''
+    active = app.ActiveDocument
+    iDocuments = app.Documents
+    count = iDocuments.Count
+    active_key = get_document_key(active) if active else None
+    old_documents = state[1] if state is not None else {}
+
+    if state is not None and not verify:
+        if len(old_documents) == count and (active_key is None or active_key in old_documents):
+            documents = old_documents
+            if active_key is not None:
+                documents = dict(documents)
+                name, path, changed = documents[active_key]
+                documents[active_key] = (name, path, bool(getattr(active, 'Changed', False)))
+            return active_key, documents
+
+    documents = {}
+    for i in range(count):
+        document = iDocuments.Item(i)
+        if not document:
+            continue
+        key = get_document_key(document)
+        if key in old_documents:
+            documents[key] = old_documents[key]
+        else:
+            documents[key] = (document.Name, document.PathName, bool(getattr(document, 'Changed', False)))
+    if active_key in old_documents and active_key in documents:
+        name, path, changed = documents[active_key]
+        documents[active_key] = (name, path, bool(getattr(active, 'Changed', False)))
+    return active_key, documents
+
+
+def diff_documents_state(old_state, new_state):
+    '''
+    Список DocumentEvent по двум снимкам состояния
+    '''
+    old_active, old_documents = old_state
+    new_active, new_documents = new_state
+    events = []
+    for key, (name, path, changed) in new_documents.items():
+        old = old_documents.get(key)
+        if old is None:
+            events.append(DocumentEvent('open', name, path))
+        elif old[2] and not changed:
+            # несохраненные изменения пропали - документ сохранен
+            events.append(DocumentEvent('save', name, path))
+    for key, (name, path, changed) in old_documents.items():
+        if key not in new_documents:
+            events.append(DocumentEvent('close', name, path))
+    if new_active is not None and new_active != old_active:
+        name, path, changed = new_documents.get(new_active, (new_active, '', False))
+        events.append(DocumentEvent('activate', name, path))
+    return events
+
+
+class PollingSource:
+    '''
+    Источник изменений для опроса: просто ожидает заданный интервал
+    '''
+    adaptive = True
+
+    def wait(self, timeout, stop_event):
+        stop_event.wait(timeout)
+
+    def close(self):
+        pass
+
+
+class NotifySource:
+    '''
+    Источник изменений на основе событий. notify() вызывается обработчиком
+    событий и прерывает ожидание, после чего монитор снимает состояние КОМПАС.
+    Опрос с максимальным интервалом остается как страховка от пропущенных событий
+    '''
+    adaptive = False
+
+    def __init__(self):
+        self.signal = threading.Event()
+
+    def notify(self, *args):
+        self.signal.set()
+
+    def wait(self, timeout, stop_event):
+        self.signal.wait(timeout)
+        self.signal.clear()
+
+    def close(self):
+        pass
+
+
+class KompasObjectEvents:
+    '''
+    Обработчик событий приложения КОМПАС (ksKompasObjectNotify) для DispatchWithEvents.
+    Обработчики возвращают True, чтобы не запрещать действие в КОМПАС
+    '''
+    source = None
+
+    def _notify(self, *args):
+        if self.source is not None:
+            self.source.notify()
+        return True
+
+    OnCreateDocument = _notify
+    OnOpenDocument = _notify
+    OnChangeActiveDocument = _notify
+    OnBeginCloseAllDocument = _notify
+    OnApplicationDestroy = _notify
+
+
+class ComEventSource(NotifySource):
+    '''
+    Подписка на события приложения КОМПАС через COM.
+    События доставляются в поток подписки только при обработке сообщений COM,
+    поэтому ожидание идет короткими шагами с вызовом PumpWaitingMessages
+    '''
+    PUMP_INTERVAL = 0.05
+
+    def __init__(self):
+        super().__init__()
+        import pythoncom
+        import win32com.client
+        self.pythoncom = pythoncom
+        handler = type('NerpaSyncKompasEvents', (KompasObjectEvents,), {'source': self})
+        self.events = win32com.client.DispatchWithEvents("Kompas.Application.5", handler)
+
+    def wait(self, timeout, stop_event):
+        deadline = time.time() + timeout
+        while not self.signal.is_set() and not stop_event.is_set() and time.time() < deadline:
+            self.pythoncom.PumpWaitingMessages()
+            self.signal.wait(self.PUMP_INTERVAL)
+        self.signal.clear()
+
+    def close(self):
+        try:
+            self.events.close()
+        except Exception:
+            pass
+        self.events = None
+
+
+def create_event_source():
+    '''
+    Источник изменений по умолчанию: события КОМПАС, а если подписка
+    недоступна - адаптивный опрос
+    '''
+    try:
+        return ComEventSource()
+    except Exception:
+        return PollingSource()
+
 
 class KompasFrameHandler(threading.Thread):
     '''
-    Класс для получения имени файла и отправки сообщений о том, что документ изменился
+    Класс для отслеживания документов КОМПАС и отправки в очередь событий
+    DocumentEvent об открытии, активации, сохранении и закрытии документов.
+    Сообщения об ошибках отправляются в очередь строками.
+    Входные параметры:
+    event_queue - очередь событий
+    source_factory - функция, создающая источник изменений (по умолчанию события
+    КОМПАС с переходом на опрос), вызывается в потоке монитора
+    min_interval, max_interval - границы интервала опроса, с
+    event_interval - интервал страховочного опроса при подписке на события
+    и повторного подключения, с
+    verify_interval - интервал перечитывания ключей всех документов, с
+    com - инициализация COM в потоке монитора (False для имитации КОМПАС)
     '''
-    def __init__(self, event_queue):
+    def __init__(self, event_queue, source_factory=None,
+                 min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL,
+                 event_interval=EVENT_POLL_INTERVAL, verify_interval=VERIFY_INTERVAL, com=True):
         super().__init__()
         self.event_queue = event_queue
         self.daemon = True  # Поток завершается при завершении основного приложения
+        self.source_factory = source_factory or create_event_source
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.event_interval = event_interval
+        self.verify_interval = verify_interval
+        self.com = com
         self.app = None
         self.stop_event = threading.Event()
-        self.last_doc_name = None
+        self.polls = 0
 
     def run(self):
-        pythoncom.CoInitialize()
+        if self.com:
+            # COM импортируется в потоке обработчика, чтобы модуль загружался без pywin32
+            import pythoncom
+            pythoncom.CoInitialize()
         try:
-            self.app = win32com.client.Dispatch("Kompas.Application.7")
             self.check_document_status()
-        except Exception as e:
-            self.event_queue.put("Ошибка при подключении к Kompas: {}".format(e))
         finally:
-            pythoncom.CoUninitialize()
+            if self.com:
+                kompas_sessions.reset()
+                pythoncom.CoUninitialize()
+
+    def connect(self):
+        if self.com and self.app is not None and not self.kompas_running():
+            # повторное подключение только к запущенному КОМПАС, чтобы не запускать его заново
+            raise RuntimeError('КОМПАС не запущен')
+        self.app = kompas_sessions.get().app
+        return self.source_factory()
+
+    def kompas_running(self):
+        import win32com.client
+        try:
+            win32com.client.GetActiveObject("Kompas.Application.7")
+            return True
+        except Exception:
+            return False
 
     def check_document_status(self):
+        source = None
+        state = None
+        interval = self.min_interval
+        verified_at = 0
+        error = None
         while not self.stop_event.is_set():
             try:
-                iKompasDocument = self.app.ActiveDocument
-                if iKompasDocument:
-                    doc_name = iKompasDocument.Name
-                    if doc_name != self.last_doc_name:
-                        self.event_queue.put(doc_name) #возвращение имени документа
-                        self.last_doc_name = doc_name
-                        
+                if source is None:
+                    source = self.connect()
+                    state = None
+                now = time.time()
+                verify = now - verified_at >= self.verify_interval
+                new_state = get_documents_state(self.app, state, verify)
+                if verify:
+                    verified_at = now
+                self.polls += 1
+                events = diff_documents_state(state or (None, {}), new_state)
+                state = new_state
+                for event in events:
+                    self.event_queue.put(event)
+                error = None
+                if not source.adaptive:
+                    interval = self.event_interval
+                elif events:
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * 2, self.max_interval)
+                source.wait(interval, self.stop_event)
             except Exception as e:
-                self.event_queue.put("Ошибка при доступе к документу: {}".format(e))
-            time.sleep(0.5)  # Периодическая проверка каждые 0,5 секунд
+                # КОМПАС закрыт или перезапущен: повторное подключение с интервалом event_interval
+                message = "Ошибка при доступе к документу: {}".format(e)
+                if message != error:
+                    self.event_queue.put(message)
+                    error = message
+                if source is not None:
+                    source.close()
+                    source = None
+                kompas_sessions.reset()
+                self.stop_event.wait(self.event_interval)
+        if source is not None:
+            source.close()
 
     def stop(self):
-        self.stop_event.set()
\ No newline at end of file
+        self.stop_event.set()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+
+# Библиотеки типов API КОМПАС: (CLSID, LCID, major, minor)
+API7_TYPELIB = ("{69AC2981-37C0-4379-84FD-5DD2F3C0A520}", 0, 1, 0)
+CONSTANTS_TYPELIB = ("{2CAF168C-7961-4B90-9DA2-701419BEEFE3}", 0, 1, 0)
+CONSTANTS2D_TYPELIB = ("{75C9F5D0-B5B8-4526-8681-9903C567D2ED}", 0, 1, 0)
+
+# Модули библиотек типов, сгенерированные gencache. Загружаются один раз на процесс
+_type_libraries = {}
+_type_libraries_lock = threading.Lock()
+
+
+def load_type_libraries():
+    '''
+    Возвращает (module, const, const2D). gencache.EnsureModule
+    выполняется только при первом вызове
+    '''
+    with _type_libraries_lock:
+        if not _type_libraries:
+            from win32com.client import gencache
+            _type_libraries['module'] = gencache.EnsureModule(*API7_TYPELIB)
+            _type_libraries['const'] = gencache.EnsureModule(*CONSTANTS_TYPELIB).constants
+            _type_libraries['const2D'] = gencache.EnsureModule(*CONSTANTS2D_TYPELIB).constants
+        return _type_libraries['module'], _type_libraries['const'], _type_libraries['const2D']
+
+
+class KompasSession:
+    '''
+    Подключение к КОМПАС-3D: module - API компаса, app - экземпляр Application,
+    const, const2D - константы Компаса
+    '''
+    def __init__(self, module, app, const, const2D):
+        self.module = module
+        self.app = app
+        self.const = const
+        self.const2D = const2D
+
+    def is_alive(self):
+        '''
+        Проверка, что КОМПАС, к которому выполнено подключение, еще запущен.
+        Заодно делает окно КОМПАС видимым
+        '''
+        try:
+            if self.app.Visible is False:
+                self.app.Visible = True
+            return True
+        except Exception:
+            return False
+
+
+def connect_kompas():
+    '''
+    Подключение к запущенному КОМПАС (или его запуск) через COM
+    '''
+    import pythoncom
+    from win32com.client import Dispatch
+    module, const, const2D = load_type_libraries()
+    app = module.IApplication(Dispatch("Kompas.Application.7")._oleobj_.QueryInterface(module.IApplication.CLSID,
+                                                                                      pythoncom.IID_IDispatch))
+    return KompasSession(module, app, const, const2D)
+
+
+class KompasSessionCache:
+    '''
+    Кэш подключений к КОМПАС. COM-объекты привязаны к потоку, в котором созданы,
+    поэтому подключение хранится отдельно для каждого потока, а модули библиотек
+    типов - одни на процесс. Перед выдачей подключение проверяется,
+    и если КОМПАС был перезапущен, выполняется повторное подключение.
+    Входные параметры:
+    factory - функция, создающая KompasSession (для тестов - подключение
+    к имитации КОМПАС)
+    '''
+    def __init__(self, factory=None):
+        self.factory = factory or connect_kompas
+        self.local = threading.local()
+        self.generation = 0
+        self.connects = 0
+
+    def set_factory(self, factory):
+        '''
+        Замена способа подключения. Подключения, созданные ранее, больше не используются
+        '''
+        self.factory = factory or connect_kompas
+        self.generation += 1
+
+    def get(self):
+        session = getattr(self.local, 'session', None)
+        if session is not None and (self.local.generation != self.generation or not session.is_alive()):
+            session = None
+        if session is None:
+            session = self.factory()
+            session.is_alive()
+            self.local.session = session
+            self.local.generation = self.generation
+            self.connects += 1
+        return session
+
+    def reset(self):
+        '''
+        Сброс подключения текущего потока
+        '''
+        self.local.session = None
+
+
+# Общий для всего приложения кэш подключений
+kompas_sessions = KompasSessionCache()
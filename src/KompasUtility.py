@@ -8,12 +8,12 @@ project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
-import pythoncom
-from win32com.client import Dispatch, gencache
 from tkinter.messagebox import showinfo
 from getpass import getuser
-import shutil, sqlite3
-from datetime import datetime
+import shutil
+from .ConnectionModule import connections, get_main_db_path, get_user_db_path
+from .KompasSession import kompas_sessions
+from .ScanModule import get_record_key
  
 def get_path():
     '''
@@ -22,21 +22,35 @@ def get_path():
     return os.path.dirname(os.path.abspath(__file__))
 
 
+def init_com_thread():
+    '''
+    Инициализация COM в рабочем потоке, который обращается к КОМПАС
+    '''
+    import pythoncom
+    pythoncom.CoInitialize()
+
+
+def release_com_thread():
+    import pythoncom
+    kompas_sessions.reset()
+    pythoncom.CoUninitialize()
+
+
 class KompasAPI:
     '''
     Класс для подключения к КОМПАС-3D.
     При super() наследовании передает основные интефейсы:
     module - API компаса, app - экземпляр Application,
-    const - константы Компаса
+    const - константы Компаса.
+    Подключение берется из кэша kompas_sessions и создается только
+    при первом обращении из потока или после перезапуска КОМПАС
     '''
     def __init__(self):
-        self.module = gencache.EnsureModule("{69AC2981-37C0-4379-84FD-5DD2F3C0A520}", 0, 1, 0)
-        self.app = self.module.IApplication(Dispatch("Kompas.Application.7")._oleobj_.QueryInterface(self.module.IApplication.CLSID, 
-                                                                                                     pythoncom.IID_IDispatch))
-        self.const = gencache.EnsureModule("{2CAF168C-7961-4B90-9DA2-701419BEEFE3}", 0, 1, 0).constants
-        self.const2D = gencache.EnsureModule("{75C9F5D0-B5B8-4526-8681-9903C567D2ED}", 0, 1, 0).constants
-        if self.app.Visible is False:
-            self.app.Visible = True
+        self.session = kompas_sessions.get()
+        self.module = self.session.module
+        self.app = self.session.app
+        self.const = self.session.const
+        self.const2D = self.session.const2D
     
     def get_part_dispatch(self):
         '''
@@ -63,7 +77,7 @@ class KompasAPI:
         if bodies_array is not None:
             if isinstance(bodies_array, tuple):
                 for body_dispatch in bodies_array:
-                    body_object = KompasItem(body_dispatch)
+                    body_object = KompasItem(body_dispatch, self.session)
                     if body_dispatch.CreateSpcObjects is True and body_object.is_patterned() is False:
                         bodies_dispatches.append(body_dispatch)
                 return bodies_dispatches
@@ -77,35 +91,108 @@ class KompasAPI:
                                   'Ошибка', 64)
             return
     
+class PropertyCache:
+    '''
+    Кэш объектов свойств документа КОМПАС.
+    IPropertyMng создается один раз, объект свойства для каждого ID
+    запрашивается у КОМПАС один раз на документ.
+    Входные параметры:
+    session - подключение к КОМПАС (KompasSession)
+    document - документ, по умолчанию активный
+    '''
+    def __init__(self, session, document=None):
+        self.module = session.module
+        self.document = document if document is not None else session.app.ActiveDocument
+        self.property_mng = self.module.IPropertyMng(session.app)
+        self.properties = {}
+
+    def get_property(self, ID):
+        prp = self.properties.get(ID)
+        if prp is None:
+            prp = self.property_mng.GetProperty(self.document, ID)
+            self.properties[ID] = prp
+        return prp
+
+    def get_values(self, dispatches, ids):
+        '''
+        Чтение свойств ids для списка тел или компонентов.
+        Возвращает список словарей {ID: значение} в порядке dispatches
+        '''
+        properties = [(ID, self.get_property(ID)) for ID in ids]
+        result = []
+        for dispatch in dispatches:
+            keeper = self.module.IPropertyKeeper(dispatch)
+            result.append(dict((ID, keeper.GetPropertyValue(prp, '', True, True)[1])
+                               for ID, prp in properties))
+        return result
+
+    def set_values(self, dispatches, values):
+        '''
+        Запись свойств для списка тел или компонентов.
+        values - словарь {ID: значение}, общий для всех объектов,
+        или список таких словарей в порядке dispatches.
+        Возвращает количество успешно записанных значений
+        '''
+        if isinstance(values, dict):
+            values = [values] * len(dispatches)
+        written = 0
+        for dispatch, item_values in zip(dispatches, values):
+            keeper = self.module.IPropertyKeeper(dispatch)
+            for ID, value in item_values.items():
+                if keeper.SetPropertyValue(self.get_property(ID), value, True):
+                    written += 1
+        return written
+
+
 class KompasItem:
     '''
     Класс с удобными методами для обработки тел и компонентов.
-    Для создания объекта этого класса нужно передать Dispatch тела или компонента.
+    Для создания объекта этого класса нужно передать Dispatch тела или компонента
+    и, при наличии, подключение к КОМПАС (KompasSession) и кэш свойств документа.
     '''
-    def __init__(self, dispatch):
+    def __init__(self, dispatch, session=None, property_cache=None):
         self.dispatch = dispatch
         self.pattern_words = ['Массив', 'Зеркальное']
-        self.kAPI = KompasAPI() 
-        self.module = self.kAPI.module
-        self.app = self.kAPI.app
+        self.session = session or kompas_sessions.get()
+        self.module = self.session.module
+        self.app = self.session.app
+        self.property_cache = property_cache
+        self.property_keeper = None
+
+    def get_property_keeper(self):
+        if self.property_cache is None:
+            self.property_cache = PropertyCache(self.session)
+        if self.property_keeper is None:
+            self.property_keeper = self.module.IPropertyKeeper(self.dispatch)
+        return self.property_keeper
 
     def get_prp_value(self,ID): 
         '''
         Возвращает значение свойства по переданному ID. Формат ID - float
         '''
-        iPropertyMng = self.module.IPropertyMng(self.app)
-        iPropertyKeeper = self.module.IPropertyKeeper(self.dispatch)
-        return iPropertyKeeper.GetPropertyValue(iPropertyMng.GetProperty(self.app.ActiveDocument, ID),'',True, True)[1]
+        iPropertyKeeper = self.get_property_keeper()
+        return iPropertyKeeper.GetPropertyValue(self.property_cache.get_property(ID),'',True, True)[1]
 
     def set_prp_value(self,ID, PrpValue):
         '''
         Устанавливает значение свойства по переданному ID. Формат ID - float
         '''
-        iPropertyMng = self.module.IPropertyMng(self.app)
-        iPropertyKeeper = self.module.IPropertyKeeper(self.dispatch)
-        set_prp = iPropertyKeeper.SetPropertyValue(iPropertyMng.GetProperty(self.app.ActiveDocument, ID), PrpValue, True)
+        iPropertyKeeper = self.get_property_keeper()
+        set_prp = iPropertyKeeper.SetPropertyValue(self.property_cache.get_property(ID), PrpValue, True)
         return set_prp
 
+    def get_prp_values(self, ids):
+        '''
+        Возвращает словарь {ID: значение} для списка ID
+        '''
+        return dict((ID, self.get_prp_value(ID)) for ID in ids)
+
+    def set_prp_values(self, values):
+        '''
+        Устанавливает значения из словаря {ID: значение}
+        '''
+        return all([self.set_prp_value(ID, value) for ID, value in values.items()])
+
     def is_patterned(self): 
         '''
         Метод проверки получен объект массивом или нет
@@ -180,9 +267,8 @@ class k3DMaker(KompasAPI):
             iPart7 = iKompasDocument3D.TopPart
 
             #добавление обозначения и наименования
-            doc_item = KompasItem(iPart7)
-            doc_item.set_prp_value(4.0, self.marking)
-            doc_item.set_prp_value(5.0, self.name)
+            property_cache = PropertyCache(self.session, iKompasDocument)
+            property_cache.set_values([iPart7], {4.0: self.marking, 5.0: self.name})
 
             iKompasDocument.SaveAs(self.file_path)
             iKompasDocument.Close(0)
@@ -208,46 +294,35 @@ class k2DMaker(KompasAPI):
 
         self.network_cdw_path = self.network_file_path[:-4]+'.cdw'
 
-        self.db_path = project_root+'\\databases\\CADFolder.db'
+        self.db_path = get_main_db_path()
 
         self.create_doc()
 
-    def get_last_modified_time(self, file_path):
-        '''
-        Возвращает время последнего изменения файла в формате ISO без миллисекунд.
-        '''
-        timestamp = os.path.getmtime(file_path)
-        dt = datetime.fromtimestamp(timestamp)
-        return dt.strftime('%Y-%m-%dT%H:%M:%S')
-
     def create_doc(self):
         iDocuments = self.app.Documents
         iKompasDocument = iDocuments.Add(1, True)
         #сохранение чертежа на локальном диске
-        drawing_path = self.local_file_path[:-4]+'.cdw'
+        drawing_path = os.path.normpath(self.local_file_path[:-4]+'.cdw')
         iKompasDocument.SaveAs(drawing_path)
         
         try:
             shutil.copy2(drawing_path, self.network_dir_path)
-            last_modified = self.get_last_modified_time(drawing_path)
+            last_modified, size, mtime_ns = get_record_key(self.network_cdw_path)
             name = self.source_name[:-4]+'.cdw'
             status = getuser()
-            self.user_db_path = project_root+'\\databases\\CADFolder_{}.db'.format(status)
+            self.user_db_path = get_user_db_path(status)
 
-            with sqlite3.connect(self.db_path) as conn, sqlite3.connect(self.user_db_path) as user_conn:
-                user_cursor = user_conn.cursor()
-                cursor = conn.cursor()
+            with connections.transaction(self.db_path) as cursor, \
+                    connections.transaction(self.user_db_path) as user_cursor:
                 cursor.execute('''INSERT INTO file_structure
-                                (name, network_path, status, type, last_modified)
-                                VALUES (?,?,?,?,?)''',
-                                (name, self.network_cdw_path, status, 'file', last_modified))
+                                (name, network_path, status, type, last_modified, size, mtime_ns)
+                                VALUES (?,?,?,?,?,?,?)''',
+                                (name, self.network_cdw_path, status, 'file', last_modified, size, mtime_ns))
                 user_cursor.execute('''INSERT INTO file_structure
-                            (name, local_path, status, type, last_modified)
-                            VALUES (?,?,?,?,?)''',
-                            (name, drawing_path, status, 'file', last_modified))
-                user_conn.commit()
-                conn.commit()
-                self.main_window.update_treeview()
+                            (name, local_path, status, type, last_modified, size, mtime_ns)
+                            VALUES (?,?,?,?,?,?,?)''',
+                            (name, drawing_path, status, 'file', last_modified, size, mtime_ns))
+            self.main_window.refresh_treeview()
         
         except Exception as e:
             print('Ошибка копирования файла: {}'.format(e))
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import threading
+import time
+
+import sqlite3
+
+from .ConnectionModule import connections, get_main_db_path, get_replica_db_path
+from .DeltaModule import replace_file, TEMP_SUFFIX
+from .GenerationModule import GenerationWatcher, generation
+
+
+# Точность времени изменения файла на сетевом диске, с. Если с момента изменения
+# прошло меньше, совпадение времени не доказывает, что файл не менялся
+MTIME_RESOLUTION = 2.0
+# Небольшие таблицы главной БД, которые не попадают в change_log и копируются целиком
+MIRRORED_TABLES = ('project_meta', 'user_tracking')
+# Ограничение SQLite на количество параметров в одном запросе
+SQL_VARIABLES_LIMIT = 500
+
+
+def get_file_signature(path):
+    '''
+    (время изменения, размер) файла
+    '''
+    st = os.stat(path)
+    return st.st_mtime, st.st_size
+
+
+def table_exists(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (name,)).fetchone() is not None
+
+
+class MainDBReplica:
+    '''
+    Локальная копия главной БД в хранилище пользователя. Из нее читают дерево проекта,
+    проверка изменений, кнопки и план синхронизации, а запись идет в главную БД.
+    refresh() сначала сравнивает время изменения и размер файла главной БД и, если
+    они не изменились, не обращается к сетевому диску. Иначе из главной БД читаются
+    записи change_log после последнего перенесенного номера, строки file_structure
+    для этих путей и небольшие таблицы MIRRORED_TABLES. Если реплики нет, журнал
+    обрезан дальше перенесенного номера или изменилась версия схемы, главная БД
+    копируется целиком: через sqlite3 backup, а в Python 3.2 - копированием файла
+    под разделяемой блокировкой. Номера change_log в реплике совпадают с главной БД,
+    триггеры в реплике удаляются.
+    revision увеличивается при каждом перенесенном изменении.
+    poll() для периодической проверки обращается к главной БД, только если
+    изменился файл поколения (GenerationModule), и тогда читает журнал без сравнения
+    времени изменения: на сетевом диске оно может отставать из-за кэша метаданных.
+    Редкая обязательная проверка сравнивает только время изменения и размер
+    Входные параметры:
+    main_path, replica_path - функции, возвращающие путь к главной БД и к реплике
+    '''
+    def __init__(self, main_path=get_main_db_path, replica_path=get_replica_db_path):
+        self.main_path = main_path
+        self.db_path = replica_path
+        self.lock = threading.Lock()
+        self.signature = None
+        self.checked_at = 0
+        self.revision = 0
+        self.ready = None
+        self.watcher = GenerationWatcher(generation)
+
+    def path(self):
+        '''
+        Путь к БД для чтения: реплика, если она уже создана, иначе главная БД
+        '''
+        replica_path = self.db_path()
+        if self.ready == replica_path:
+            return replica_path
+        return self.main_path()
+
+    def read_path(self):
+        '''
+        Обновляет реплику и возвращает путь к БД для чтения.
+        Если обновить реплику не удалось, чтение идет из главной БД
+        '''
+        self.try_refresh()
+        return self.path()
+
+    def try_refresh(self):
+        try:
+            return self.refresh()
+        except (sqlite3.Error, OSError) as e:
+            print('Ошибка обновления локальной копии БД: {}'.format(e))
+            return False
+
+    def poll(self):
+        '''
+        Периодическая проверка изменений главной БД. Возвращает True, если реплика изменилась.
+        Следующую проверку нужно выполнить через watcher.interval секунд
+        '''
+        changed = False
+        try:
+            if self.watcher.should_check():
+                # журнал читается без сравнения времени изменения, только если изменилось поколение.
+                # Периодическая проверка и проверка без файла поколения идут по времени изменения
+                # файла БД: этого достаточно для клиентов прежних версий и миграций схемы
+                changed = self.refresh(force=self.watcher.moved)
+        except Exception:
+            self.watcher.reset()
+            raise
+        finally:
+            self.watcher.update(changed)
+        return changed
+
+    def refresh(self, force=False):
+        '''
+        Переносит в реплику изменения главной БД. Возвращает True, если реплика изменилась.
+        Без force главная БД не читается, если время изменения и размер ее файла не изменились
+        '''
+        main_path = self.main_path()
+        replica_path = self.db_path()
+        with self.lock:
+            signature = get_file_signature(main_path)
+            if (not force and signature == self.signature and self.ready == replica_path
+                    and self.checked_at - signature[0] > MTIME_RESOLUTION):
+                return False
+            checked_at = time.time()
+
+            changed = None
+            last_seq = self.get_last_seq(replica_path)
+            if last_seq is not None:
+                changed = self.pull_changes(main_path, replica_path, last_seq)
+            if changed is None:
+                self.snapshot(main_path, replica_path)
+                changed = True
+
+            self.signature = signature
+            self.checked_at = checked_at
+            self.ready = replica_path
+            if changed:
+                self.revision += 1
+            return changed
+
+    def get_last_seq(self, replica_path):
+        '''
+        Номер последнего перенесенного изменения change_log. None, если реплики нет
+        '''
+        if not os.path.exists(replica_path):
+            return None
+        with connections.transaction(replica_path) as cursor:
+            if not table_exists(cursor.connection, 'replica_state'):
+                return None
+            cursor.execute("SELECT value FROM replica_state WHERE key = 'last_seq'")
+            row = cursor.fetchone()
+            return int(row[0]) if row else None
+
+    def pull_changes(self, main_path, replica_path, last_seq):
+        '''
+        Перенос изменений после last_seq. Возвращает None, если нужна полная копия
+        '''
+        with connections.transaction(replica_path) as replica_cursor:
+            replica_version = replica_cursor.execute('PRAGMA user_version').fetchone()[0]
+            old_tables = dict((table, replica_cursor.execute('SELECT * FROM {}'.format(table)).fetchall())
+                              for table in MIRRORED_TABLES if table_exists(replica_cursor.connection, table))
+
+        with connections.transaction(main_path) as cursor:
+            conn = cursor.connection
+            # чтение журнала и таблиц в одной транзакции, чтобы номер и данные были согласованы
+            conn.execute('BEGIN')
+            try:
+                if conn.execute('PRAGMA user_version').fetchone()[0] != replica_version \
+                        or not table_exists(conn, 'change_log'):
+                    return None
+                min_seq, max_seq = conn.execute('SELECT MIN(seq), MAX(seq) FROM change_log').fetchone()
+                if (max_seq or 0) < last_seq or (min_seq is not None and min_seq > last_seq + 1):
+                    return None
+                log_rows = conn.execute('''SELECT seq, network_path, action, changed_at FROM change_log
+                                        WHERE seq > ? ORDER BY seq''', (last_seq,)).fetchall()
+                changed_paths = sorted(set(row[1] for row in log_rows))
+                columns = [row[1] for row in conn.execute('PRAGMA table_info(file_structure)')]
+                rows = []
+                for i in range(0, len(changed_paths), SQL_VARIABLES_LIMIT):
+                    chunk = changed_paths[i:i + SQL_VARIABLES_LIMIT]
+                    rows.extend(conn.execute('SELECT {} FROM file_structure WHERE network_path IN ({})'.format(
+                        ', '.join(columns), ', '.join('?' * len(chunk))), chunk))
+                tables = dict((table, conn.execute('SELECT * FROM {}'.format(table)).fetchall())
+                              for table in MIRRORED_TABLES if table_exists(conn, table))
+            finally:
+                conn.rollback()
+
+        if set(tables) != set(old_tables):
+            return None
+        changed_tables = [table for table in tables if tables[table] != old_tables[table]]
+        if not log_rows and not changed_tables:
+            return False
+
+        with connections.transaction(replica_path) as replica_cursor:
+            replica_cursor.executemany('''INSERT OR REPLACE INTO change_log (seq, network_path, action, changed_at)
+                                       VALUES (?, ?, ?, ?)''', log_rows)
+            if min_seq is not None:
+                replica_cursor.execute('DELETE FROM change_log WHERE seq < ?', (min_seq,))
+            for i in range(0, len(changed_paths), SQL_VARIABLES_LIMIT):
+                chunk = changed_paths[i:i + SQL_VARIABLES_LIMIT]
+                replica_cursor.execute('DELETE FROM file_structure WHERE network_path IN ({})'.format(
+                    ', '.join('?' * len(chunk))), chunk)
+            replica_cursor.executemany('INSERT INTO file_structure ({}) VALUES ({})'.format(
+                ', '.join(columns), ', '.join('?' * len(columns))), rows)
+            for table in changed_tables:
+                replica_cursor.execute('DELETE FROM {}'.format(table))
+                if tables[table]:
+                    replica_cursor.executemany('INSERT INTO {} VALUES ({})'.format(
+                        table, ', '.join('?' * len(tables[table][0]))), tables[table])
+            self.set_last_seq(replica_cursor, max_seq or 0)
+        return True
+
+    def snapshot(self, main_path, replica_path):
+        '''
+        Полная копия главной БД в реплику
+        '''
+        os.makedirs(os.path.dirname(replica_path), exist_ok=True)
+        with connections.lock(main_path), connections.lock(replica_path):
+            conn = connections.connection(main_path)
+            if hasattr(conn, 'backup'):
+                # sqlite3 backup появился в Python 3.7
+                conn.backup(connections.connection(replica_path))
+            else:
+                temp_path = replica_path + TEMP_SUFFIX
+                # разделяемая блокировка на время копирования: другие клиенты не могут записать изменения
+                conn.execute('BEGIN')
+                try:
+                    conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+                    shutil.copyfile(main_path, temp_path)
+                finally:
+                    conn.rollback()
+                connections.drop(replica_path)
+                replace_file(temp_path, replica_path)
+
+        with connections.transaction(replica_path) as replica_cursor:
+            replica_conn = replica_cursor.connection
+            # реплика заполняется только из главной БД: триггеры добавили бы в change_log чужие номера
+            for (name,) in replica_conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall():
+                replica_conn.execute('DROP TRIGGER IF EXISTS "{}"'.format(name))
+            replica_conn.execute('''CREATE TABLE IF NOT EXISTS replica_state (
+                                 key TEXT PRIMARY KEY,
+                                 value TEXT
+                                 )''')
+            last_seq = 0
+            if table_exists(replica_conn, 'change_log'):
+                last_seq = replica_conn.execute('SELECT MAX(seq) FROM change_log').fetchone()[0] or 0
+            self.set_last_seq(replica_cursor, last_seq)
+        print('Создана локальная копия БД проекта')
+
+    def set_last_seq(self, replica_cursor, last_seq):
+        replica_cursor.execute("INSERT OR REPLACE INTO replica_state (key, value) VALUES ('last_seq', ?)",
+                               (str(last_seq),))
+
+
+# Общая для всего приложения локальная копия главной БД
+replica = MainDBReplica()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+
+import os, stat
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
+
+from .StatsModule import stats
+
+
+# Запись о найденном объекте проекта. Пара (size, mtime_ns) служит ключом изменения,
+# для папок size всегда 0
+ScanRecord = namedtuple('ScanRecord', ['name', 'network_path', 'type', 'size', 'mtime_ns'])
+
+
+def format_mtime(timestamp):
+    '''
+    Переводит время изменения в формат ISO без миллисекунд
+    '''
+    return datetime.fromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def format_mtime_ns(mtime_ns):
+    return format_mtime(mtime_ns / 1000000000.0)
+
+
+def stat_mtime_ns(entry_stat):
+    '''
+    Время изменения в наносекундах. В Python 3.2 st_mtime_ns отсутствует
+    '''
+    mtime_ns = getattr(entry_stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(round(entry_stat.st_mtime * 1000000000))
+    return mtime_ns
+
+
+def get_change_key(path):
+    '''
+    Возвращает ключ изменения (size, mtime_ns) файла или папки
+    '''
+    path_stat = os.stat(path)
+    size = 0 if stat.S_ISDIR(path_stat.st_mode) else path_stat.st_size
+    return size, stat_mtime_ns(path_stat)
+
+
+def get_record_key(path):
+    '''
+    (last_modified, size, mtime_ns) для записи file_structure о созданном файле или папке
+    '''
+    size, mtime_ns = get_change_key(path)
+    return format_mtime_ns(mtime_ns), size, mtime_ns
+
+
+def is_changed(size, mtime_ns, last_modified, other_size, other_mtime_ns, other_last_modified):
+    '''
+    Сравнение двух записей по ключу (size, mtime_ns).
+    Если у одной из записей ключ еще не заполнен (записи, созданные
+    до появления столбцов size и mtime_ns), сравнивается last_modified
+    '''
+    if mtime_ns is None or other_mtime_ns is None:
+        return last_modified != other_last_modified
+    return size != other_size or mtime_ns != other_mtime_ns
+
+
+# Служебные файлы NerpaSync рядом с файлами проекта:
+# сигнатуры блоков для дельта-передачи, временные файлы при копировании
+# и контрольные точки прерванного копирования
+SIGNATURE_SUFFIX = '.nsig'
+TEMP_SUFFIX = '.nstmp'
+CHECKPOINT_SUFFIX = '.nsckp'
+
+
+def is_project_file(filename):
+    '''
+    Исключение из перебора TEMP файлов(начинаются с ~), BACKUP файлов КОМПАС
+    и служебных файлов NerpaSync
+    '''
+    return (not filename.startswith('~') and filename[-3:] not in ['bak']
+            and not filename.endswith((SIGNATURE_SUFFIX, TEMP_SUFFIX, CHECKPOINT_SUFFIX)))
+
+
+def is_inside(path, roots):
+    '''
+    Путь совпадает с одним из путей roots (множество, пути через '/') или лежит внутри него
+    '''
+    if path in roots:
+        return True
+    index = path.find('/')
+    while index != -1:
+        if path[:index] in roots:
+            return True
+        index = path.find('/', index + 1)
+    return False
+
+
+def _list_directory(dir_path):
+    '''
+    Возвращает (записи, ошибки). Записи - список (имя, путь, это_папка, спускаться_в_папку, stat)
+    для содержимого директории, ошибки - список (путь, исключение) для объектов,
+    которые не удалось прочитать (например, битая ссылка или файл, удаленный во время обхода).
+    Такие объекты пропускаются, остальное содержимое папки возвращается.
+    Использует os.scandir, а при его отсутствии (встроенный в КОМПАС Python 3.2) - os.listdir и os.stat
+    '''
+    entries = []
+    errors = []
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(dir_path):
+            try:
+                is_dir = entry.is_dir()
+                descend = is_dir and not entry.is_symlink()
+                entries.append((entry.name, entry.path, is_dir, descend, entry.stat()))
+            except OSError as e:
+                errors.append((entry.path, e))
+    else:
+        for name in os.listdir(dir_path):
+            path = os.path.join(dir_path, name)
+            try:
+                entry_stat = os.stat(path)
+            except OSError as e:
+                errors.append((path, e))
+                continue
+            is_dir = stat.S_ISDIR(entry_stat.st_mode)
+            descend = is_dir and not os.path.islink(path)
+            entries.append((name, path, is_dir, descend, entry_stat))
+    return entries, errors
+
+
+class ProjectScanner:
+    '''
+    Класс для обхода папки проекта на сетевом диске.
+    Каждая директория читается одним вызовом os.scandir, размер и время изменения
+    берутся из уже полученного stat, а обход поддеревьев распределяется
+    по ограниченному пулу потоков.
+    Входные параметры:
+    project_path - путь к папке проекта
+    max_workers - количество потоков обхода
+    set_read_only - установить "Только для чтения" на найденные объекты
+    '''
+    def __init__(self, project_path, max_workers=8, set_read_only=True):
+        self.project_path = project_path
+        self.max_workers = max_workers
+        self.set_read_only = set_read_only
+        self.errors = []
+        self.failed_paths = []
+        self.run = stats.current()
+
+    def scan(self, cancel_event=None):
+        '''
+        Возвращает отсортированный по network_path список ScanRecord.
+        Ошибки доступа не прерывают обход и собираются в self.errors.
+        failed_paths - пути (через '/'), которые не удалось прочитать: папки целиком
+        или отдельные объекты. Записи БД для них и для их содержимого удалять нельзя
+        После установки cancel_event новые папки не обходятся, результат неполный
+        '''
+        self.errors = []
+        self.failed_paths = []
+        self.run = stats.current()
+        records = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = set([executor.submit(self._scan_directory, self.project_path)])
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_records, subdirs, errors, failed_paths = future.result()
+                    records.extend(dir_records)
+                    self.errors.extend(errors)
+                    self.failed_paths.extend(failed_paths)
+                    if cancel_event is not None and cancel_event.is_set():
+                        continue
+                    for subdir in subdirs:
+                        pending.add(executor.submit(self._scan_directory, subdir))
+
+        records.sort(key=lambda record: record.network_path)
+        return records
+
+    def _scan_directory(self, dir_path):
+        '''
+        Обрабатывает одну директорию: формирует записи для ее содержимого
+        и возвращает список вложенных папок для дальнейшего обхода
+        '''
+        records = []
+        subdirs = []
+        errors = []
+        failed_paths = []
+        try:
+            entries, entry_errors = _list_directory(dir_path)
+        except OSError as e:
+            errors.append("Ошибка чтения папки {}: {}".format(dir_path, e))
+            failed_paths.append(dir_path.replace("\\", "/"))
+            return records, subdirs, errors, failed_paths
+        for path, e in entry_errors:
+            errors.append("Ошибка чтения {}: {}".format(path, e))
+            failed_paths.append(path.replace("\\", "/"))
+
+        for name, path, is_dir, descend, entry_stat in entries:
+            if is_dir:
+                item_type = 'directory'
+                if descend:
+                    subdirs.append(path)
+            elif is_project_file(name):
+                item_type = 'file'
+            else:
+                continue
+
+            full_path = path.replace("\\", "/")
+            size = entry_stat.st_size if item_type == 'file' else 0
+            records.append(ScanRecord(name, full_path, item_type, size, stat_mtime_ns(entry_stat)))
+
+            # chmod только для объектов, у которых еще нет атрибута "только для чтения"
+            if self.set_read_only and entry_stat.st_mode & stat.S_IWRITE:
+                try:
+                    with self.run.span('chmod'):
+                        os.chmod(full_path, stat.S_IREAD)
+                except OSError as e:
+                    errors.append("Ошибка при установке атрибута 'только для чтения' для {}: {}".format(full_path, e))
+
+        return records, subdirs, errors, failed_paths
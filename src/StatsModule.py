@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from getpass import getuser
+
+import sqlite3
+
+from .ConnectionModule import connections, get_vault_dir
+
+
+# Переменная окружения для отключения статистики: NERPASYNC_STATS=0
+STATS_ENV = 'NERPASYNC_STATS'
+
+
+def get_stats_db_path():
+    return os.path.join(get_vault_dir(), 'stats.db')
+
+
+class NullSpan:
+    '''
+    Замер, который ничего не делает (статистика отключена)
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullRun:
+    '''
+    Операция без сбора статистики. Используется, когда статистика
+    отключена или вызов идет вне операции
+    '''
+    span_context = NullSpan()
+
+    def span(self, name):
+        return self.span_context
+
+    def count(self, name, value=1):
+        pass
+
+    def set_status(self, status):
+        pass
+
+
+NULL_RUN = NullRun()
+
+
+class Span:
+    def __init__(self, run, name):
+        self.run = run
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.run.add_time(self.name, time.time() - self.start)
+        return False
+
+
+class RunStats:
+    '''
+    Статистика одной операции (обновление проекта, синхронизация, регистрация).
+    spans - {этап: время, с}, counters - {счетчик: значение}.
+    Этапы, выполняемые в нескольких потоках, суммируются по потокам
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.now()
+        self.start = time.time()
+        self.duration = 0.0
+        self.status = None
+        self.spans = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def span(self, name):
+        return Span(self, name)
+
+    def add_time(self, name, elapsed):
+        with self.lock:
+            self.spans[name] = self.spans.get(name, 0.0) + elapsed
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_status(self, status):
+        '''
+        Итог операции, отличный от 'ok' и 'error' (например, 'cancelled')
+        '''
+        self.status = status
+
+    def finish(self, status='ok'):
+        self.duration = time.time() - self.start
+        if self.status is None or status == 'error':
+            self.status = status
+
+    def summary(self):
+        spans = ', '.join('{} {:.2f} с'.format(name, elapsed) for name, elapsed in
+                          sorted(self.spans.items(), key=lambda item: -item[1]))
+        counters = ', '.join('{}: {}'.format(name, value) for name, value in sorted(self.counters.items()))
+        return 'Статистика "{}" ({}): {:.2f} с | {} | {}'.format(
+            self.name, self.status, self.duration, spans or '-', counters or '-')
+
+
+class StatsRecorder:
+    '''
+    Сбор статистики операций. Операция открывается через run(name),
+    а код внутри нее получает текущую операцию потока через current()
+    и добавляет этапы (span) и счетчики (count). По завершении операции
+    в журнал выводится строка со сводкой, а запись сохраняется в локальную БД статистики.
+    Вложенная операция в том же потоке учитывается как этап внешней.
+    При отключенной статистике run() и current() возвращают NULL_RUN
+    Входные параметры:
+    enabled - собирать статистику
+    db_path - функция, возвращающая путь к БД статистики (None - без записи в БД)
+    '''
+    def __init__(self, enabled=True, db_path=get_stats_db_path):
+        self.enabled = enabled
+        self.db_path = db_path
+        self.local = threading.local()
+        self.table_ready = None
+
+    def current(self):
+        if not self.enabled:
+            return NULL_RUN
+        return getattr(self.local, 'run', None) or NULL_RUN
+
+    @contextmanager
+    def run(self, name):
+        if not self.enabled:
+            yield NULL_RUN
+            return
+        outer = getattr(self.local, 'run', None)
+        if outer is not None:
+            with outer.span(name):
+                yield outer
+            return
+
+        run = RunStats(name)
+        self.local.run = run
+        status = 'error'
+        try:
+            yield run
+            status = 'ok'
+        finally:
+            self.local.run = None
+            run.finish(status)
+            print(run.summary())
+            self.save(run)
+
+    def operation(self, name):
+        '''
+        Декоратор: вызов функции выполняется как операция run(name)
+        '''
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.run(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def on_statement(self, statement):
+        '''
+        Обработчик sqlite3 set_trace_callback: подсчет запросов к БД
+        '''
+        run = getattr(self.local, 'run', None)
+        if run is not None:
+            run.count('запросов БД')
+
+    def save(self, run):
+        if self.db_path is None:
+            return
+        db_path = self.db_path()
+        try:
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            with connections.transaction(db_path) as cursor:
+                if self.table_ready != db_path:
+                    cursor.execute('''CREATE TABLE IF NOT EXISTS runs (
+                                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                   name TEXT NOT NULL,
+                                   started TEXT NOT NULL,
+                                   user TEXT,
+                                   duration REAL,
+                                   status TEXT,
+                                   spans TEXT,
+                                   counters TEXT)''')
+                    self.table_ready = db_path
+                cursor.execute('''INSERT INTO runs (name, started, user, duration, status, spans, counters)
+                               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                               (run.name, run.started.strftime('%Y-%m-%dT%H:%M:%S'), getuser(), run.duration,
+                                run.status, json.dumps(run.spans, ensure_ascii=False),
+                                json.dumps(run.counters, ensure_ascii=False)))
+        except (sqlite3.Error, OSError) as e:
+            print('Ошибка записи статистики: {}'.format(e))
+
+
+# Общий для всего приложения сборщик статистики
+stats = StatsRecorder(enabled=os.getenv(STATS_ENV, '1') != '0')
+if stats.enabled:
+    connections.trace_callback = stats.on_statement
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+import os, stat
+import shutil
+import time
+from collections import namedtuple
+
+from .ScanModule import is_changed
+from .DeltaModule import remove_signature
+from .TransferModule import CopyEngine, CopyJob, DEFAULT_COPY_WORKERS
+from .StatsModule import stats
+
+
+# Элемент плана синхронизации
+SyncItem = namedtuple('SyncItem', ['name', 'network_path', 'local_path', 'type',
+                                   'last_modified', 'size', 'mtime_ns'])
+
+
+# Контрольная точка синхронизации: выполненные изменения записываются в пользовательскую БД
+# через каждые столько изменений или секунд. После обрыва связи или закрытия программы
+# следующая синхронизация не повторяет уже записанные изменения
+CHECKPOINT_ITEMS = 200
+CHECKPOINT_INTERVAL = 5.0
+
+
+def set_read_only(file_path):
+    '''
+    Установка режима "Только для чтения"
+    '''
+    try:
+        os.chmod(file_path, stat.S_IREAD)
+    except Exception as e:
+        print("Ошибка при установке атрибута 'только для чтения' для {}: {}".format(file_path, e))
+
+
+def normalize_sync_rules(paths):
+    '''
+    Правила выборочной синхронизации без повторов и без путей,
+    которые уже входят в другие выбранные папки
+    '''
+    rules = []
+    for path in sorted(set(path.rstrip('/') for path in paths)):
+        if not rules or not (path == rules[-1] or path.startswith(rules[-1] + '/')):
+            rules.append(path)
+    return rules
+
+
+class SyncScope:
+    '''
+    Область выборочной синхронизации. В локальное хранилище попадают выбранные
+    папки и файлы (rules, сетевые пути) со всем содержимым и папки на пути к ним.
+    Файлы keep (разрегистрированные пользователем) всегда входят в область,
+    чтобы их локальные копии не удалялись.
+    Без правил синхронизируется весь проект
+    '''
+    def __init__(self, rules=(), keep=()):
+        self.rules = set(rules)
+        self.keep = set(keep)
+        self.ancestors = set()
+        for path in self.rules | self.keep:
+            parts = path.split('/')
+            for i in range(1, len(parts)):
+                self.ancestors.add('/'.join(parts[:i]))
+
+    def is_full(self):
+        return not self.rules
+
+    def covers(self, network_path):
+        '''
+        Путь входит в одно из правил
+        '''
+        if network_path in self.rules:
+            return True
+        index = network_path.find('/')
+        while index != -1:
+            if network_path[:index] in self.rules:
+                return True
+            index = network_path.find('/', index + 1)
+        return False
+
+    def includes(self, network_path):
+        if not self.rules:
+            return True
+        return network_path in self.ancestors or network_path in self.keep or self.covers(network_path)
+
+
+class SyncPlan:
+    '''
+    План синхронизации сетевого хранилища с локальным.
+    Содержит списки SyncItem для создания и обновления папок и файлов,
+    локальные пути для удаления и количество неизмененных объектов.
+    adopt - неизмененные записи пользовательской БД, которым нужно
+    только дописать ключ (size, mtime_ns) из главной БД.
+    evict - локальные пути вне выборочной синхронизации, skipped - количество
+    объектов сетевого диска вне нее.
+    sequence - номер последней записи change_log, учтенной в плане
+    '''
+    def __init__(self):
+        self.create_dirs = []
+        self.update_dirs = []
+        self.create_files = []
+        self.update_files = []
+        self.delete = []
+        self.adopt = []
+        self.evict = []
+        self.skipped = 0
+        self.unchanged = 0
+        self.sequence = None
+
+    def is_empty(self):
+        return not (self.create_dirs or self.update_dirs or self.create_files
+                    or self.update_files or self.delete or self.evict)
+
+    def keep_files(self, names):
+        '''
+        Убирает из удаляемых файлы с именами names и папки, в которых они лежат.
+        Локальные копии разрегистрированных пользователем файлов могут содержать
+        изменения, которых нет на сетевом диске. Возвращает количество сохраненных файлов
+        '''
+        def key(path):
+            return os.path.normcase(os.path.normpath(path))
+
+        kept = set(key(path) for path in self.delete if os.path.basename(key(path)) in names)
+        if not kept:
+            return 0
+        parents = set()
+        for path in kept:
+            parent = os.path.dirname(path)
+            while parent not in parents and os.path.dirname(parent) != parent:
+                parents.add(parent)
+                parent = os.path.dirname(parent)
+        self.delete = [path for path in self.delete if key(path) not in kept and key(path) not in parents]
+        return len(kept)
+
+    def summary(self):
+        summary = ('папок: +{} ~{}, файлов: +{} ~{}, удалить: {}, без изменений: {}'
+                   .format(len(self.create_dirs), len(self.update_dirs),
+                           len(self.create_files), len(self.update_files),
+                           len(self.delete), self.unchanged))
+        if self.evict or self.skipped:
+            summary += ', исключить: {}, вне выборки: {}'.format(len(self.evict), self.skipped)
+        return summary
+
+
+class SyncPlanner:
+    '''
+    Класс для построения плана синхронизации.
+    Обе стороны загружаются один раз и сопоставляются в памяти
+    по пути относительно корня проекта.
+    Входные параметры:
+    common_root - корень проекта на сетевом диске
+    local_root - корень проекта в локальном хранилище
+    scope - SyncScope выборочной синхронизации (None - весь проект)
+    '''
+    def __init__(self, common_root, local_root, scope=None):
+        self.common_root = common_root
+        self.local_root = local_root
+        self.scope = scope or SyncScope()
+
+    def relative_network_path(self, network_path):
+        if network_path.startswith(self.common_root):
+            return network_path[len(self.common_root):]
+        return network_path
+
+    def relative_local_path(self, local_path):
+        if local_path.startswith(self.local_root):
+            local_path = local_path[len(self.local_root):]
+        return local_path.replace(os.sep, '/')
+
+    def to_local_path(self, network_path):
+        '''
+        Локальный путь, соответствующий пути на сетевом диске
+        '''
+        return (self.local_root + self.relative_network_path(network_path)).replace('/', os.sep)
+
+    def plan(self, network_rows, local_rows):
+        '''
+        Строит SyncPlan. Объекты вне scope не копируются и не проверяются,
+        а их локальные копии попадают в список исключаемых.
+        network_rows - строки (network_path, type, last_modified, size, mtime_ns) главной БД
+        local_rows - строки (local_path, type, last_modified, size, mtime_ns) пользовательской БД
+        '''
+        local_index = {}
+        for local_path, item_type, last_modified, size, mtime_ns in local_rows:
+            local_index[self.relative_local_path(local_path)] = (local_path, last_modified, size, mtime_ns)
+
+        plan = SyncPlan()
+        for network_path, item_type, last_modified, size, mtime_ns in network_rows:
+            relative_path = self.relative_network_path(network_path)
+            exists = local_index.pop(relative_path, None)
+            if not self.scope.includes(network_path):
+                plan.skipped += 1
+                if exists is not None:
+                    plan.evict.append(exists[0])
+                continue
+
+            local_path = self.to_local_path(network_path)
+            item = SyncItem(os.path.basename(local_path), network_path, local_path, item_type,
+                            last_modified, size, mtime_ns)
+            if exists is None:
+                if item_type == 'directory':
+                    plan.create_dirs.append(item)
+                else:
+                    plan.create_files.append(item)
+            elif is_changed(size, mtime_ns, last_modified, exists[2], exists[3], exists[1]):
+                if item_type == 'directory':
+                    plan.update_dirs.append(item)
+                else:
+                    plan.update_files.append(item)
+            else:
+                plan.unchanged += 1
+                if exists[3] is None and mtime_ns is not None:
+                    plan.adopt.append(item)
+
+        # все, что осталось в локальном индексе, отсутствует на сетевом диске
+        plan.delete = sorted((exists[0] for exists in local_index.values()), reverse=True)
+        # вложенные объекты исключаются раньше папок, в которых они лежат
+        plan.evict.sort(reverse=True)
+        plan.create_dirs.sort(key=lambda item: item.local_path)
+        return plan
+
+
+class SyncExecutor:
+    '''
+    Класс для выполнения плана синхронизации на локальном диске.
+    Изменения пользовательской БД накапливаются в переданном BatchWriter,
+    файлы копируются параллельно через CopyEngine.
+    Выполненные изменения периодически записываются в БД (контрольные точки),
+    поэтому прерванная синхронизация продолжается с места остановки.
+    После установки cancel_event оставшиеся копирования и удаления не выполняются,
+    а уже выполненные изменения записываются в БД
+    '''
+    def __init__(self, writer, copy_workers=DEFAULT_COPY_WORKERS, cancel_event=None):
+        self.writer = writer
+        self.failed = 0
+        self.cancel_event = cancel_event
+        self.copy_engine = CopyEngine(max_workers=copy_workers)
+        self.last_checkpoint = time.time()
+
+    def checkpoint(self):
+        '''
+        Запись накопленных изменений в БД, если их достаточно много или прошло достаточно времени
+        '''
+        if len(self.writer) >= CHECKPOINT_ITEMS or time.time() - self.last_checkpoint >= CHECKPOINT_INTERVAL:
+            with stats.current().span('запись БД'):
+                self.writer.flush()
+            self.last_checkpoint = time.time()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def execute(self, plan):
+        run = stats.current()
+        with run.span('папки'):
+            self.sync_directories(plan)
+        with run.span('файлы'):
+            self.sync_files(plan)
+        if not self.cancelled:
+            with run.span('удаление'):
+                self.delete_removed(plan)
+                self.evict_unselected(plan)
+            for item in plan.adopt:
+                self.writer.update(item.local_path, item.last_modified, size=item.size, mtime_ns=item.mtime_ns)
+        with run.span('запись БД'):
+            self.writer.flush()
+
+    def sync_directories(self, plan):
+        '''
+        Создание и обновление папок
+        '''
+        for item in plan.create_dirs:
+            os.makedirs(item.local_path, exist_ok=True)
+            self.writer.insert(item.name, item.local_path, 'Зарегистрирован', 'directory',
+                               item.last_modified, item.size, item.mtime_ns)
+            print('Создана папка по пути {}'.format(item.local_path))
+            self.checkpoint()
+
+        for item in plan.update_dirs:
+            self.writer.update(item.local_path, item.last_modified, status='Обновлено',
+                               size=item.size, mtime_ns=item.mtime_ns)
+            print('Обновлена папка по пути {}'.format(item.local_path))
+
+    def sync_files(self, plan):
+        '''
+        Параллельное копирование новых и обновленных файлов
+        '''
+        jobs = ([CopyJob(item.network_path, item.local_path, False, item) for item in plan.create_files] +
+                [CopyJob(item.network_path, item.local_path, True, item) for item in plan.update_files])
+        self.copy_engine.run(jobs, self.on_file_copied, self.cancel_event)
+
+    def on_file_copied(self, result):
+        item = result.job.payload
+        if result.error is not None:
+            self.failed += 1
+            stats.current().count('ошибок копирования')
+            if result.job.update:
+                print('Неудачная попытка обновить файл по пути {}. Возможно, этот документ открыт в Компас. Код ошибки: {}'.format(item.local_path, result.error))
+            else:
+                print('Ошибка копирования файла {}: {}'.format(item.local_path, result.error))
+            return
+
+        run = stats.current()
+        run.count('файлов скопировано')
+        run.count('байт скопировано', result.size)
+        if result.job.update:
+            self.writer.update(item.local_path, item.last_modified, status='Обновлено',
+                               size=item.size, mtime_ns=item.mtime_ns)
+            print('Обновлен файл {} в {}'.format(item.name, item.local_path))
+        else:
+            self.writer.insert(item.name, item.local_path, 'Зарегистрирован', 'file',
+                               item.last_modified, item.size, item.mtime_ns)
+            print('Копирование файла {} в {}'.format(item.name, item.local_path))
+        if result.read_only_error is not None:
+            print("Ошибка при установке атрибута 'только для чтения' для {}: {}".format(item.local_path, result.read_only_error))
+        self.checkpoint()
+
+    def delete_removed(self, plan):
+        '''
+        Удаление файлов и папок, которых нет на сетевом диске
+        '''
+        for path in plan.delete:
+            try:
+                if os.path.isfile(path):
+                    os.chmod(path, 0o666)
+                    os.remove(path)
+                    remove_signature(path)
+                    print('Удален файл {}'.format(path))
+                elif os.path.isdir(path):
+                    os.chmod(path, 0o666)
+                    shutil.rmtree(path, ignore_errors=True)
+                    print('Удалена папка {}'.format(path))
+                self.writer.delete(path)
+                stats.current().count('удалено')
+            except Exception as e:
+                self.failed += 1
+                print("Ошибка при удалении {}: {}".format(path, e))
+
+    def evict_unselected(self, plan):
+        '''
+        Удаление из локального хранилища файлов и папок вне выборочной синхронизации.
+        Папка удаляется, только если она пустая: файлы, которых нет в БД, остаются на диске
+        '''
+        evicted = 0
+        for path in plan.evict:
+            try:
+                if os.path.isdir(path):
+                    if os.listdir(path):
+                        continue
+                    os.rmdir(path)
+                elif os.path.exists(path):
+                    os.chmod(path, 0o666)
+                    os.remove(path)
+                    remove_signature(path)
+                self.writer.delete(path)
+                evicted += 1
+            except Exception as e:
+                self.failed += 1
+                print("Ошибка при удалении {} из локального хранилища: {}".format(path, e))
+        if evicted:
+            stats.current().count('исключено', evicted)
+            print('Удалено из локального хранилища вне выборки: {}'.format(evicted))
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import os, stat
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .DeltaModule import pull_delta, staged_copy
+from .StatsModule import stats
+
+
+# Количество одновременных копирований по умолчанию.
+# Для мелких файлов на сетевом диске время уходит на задержки SMB, а не на канал
+DEFAULT_COPY_WORKERS = 8
+
+# Задание на копирование: source -> target, update - замена существующего файла,
+# payload - произвольные данные вызывающего кода (например, SyncItem)
+CopyJob = namedtuple('CopyJob', ['source', 'target', 'update', 'payload'])
+
+# Результат копирования. size - фактически переданные байты,
+# error - исключение при копировании,
+# read_only_error - исключение при установке "Только для чтения"
+CopyResult = namedtuple('CopyResult', ['job', 'size', 'error', 'read_only_error'])
+
+
+class CopyEngine:
+    '''
+    Класс для параллельного копирования файлов.
+    Ошибка копирования одного файла не влияет на остальные.
+    Обработчик результата on_result вызывается в потоке, запустившем run(),
+    поэтому может писать в БД и выводить сообщения.
+    Входные параметры:
+    max_workers - количество потоков копирования
+    set_read_only - установить "Только для чтения" на скопированный файл
+    use_delta - обновлять существующие файлы дельта-передачей (DeltaModule)
+    '''
+    def __init__(self, max_workers=DEFAULT_COPY_WORKERS, set_read_only=True, use_delta=True):
+        self.max_workers = max_workers
+        self.set_read_only = set_read_only
+        self.use_delta = use_delta
+
+    def run(self, jobs, on_result, cancel_event=None):
+        '''
+        Копирует файлы из списка jobs и возвращает (количество, байты, ошибки).
+        После установки cancel_event еще не начатые копирования отменяются
+        '''
+        if not jobs:
+            return 0, 0, 0
+
+        start = time.time()
+        copied = 0
+        total_size = 0
+        failed = 0
+        # статистика операции берется в вызывающем потоке: в потоках копирования текущей операции нет
+        run = stats.current()
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            futures = [executor.submit(self._copy, job, run) for job in jobs]
+            for future in as_completed(futures):
+                if cancel_event is not None and cancel_event.is_set():
+                    for pending in futures:
+                        pending.cancel()
+                if future.cancelled():
+                    continue
+                result = future.result()
+                if result.error is None:
+                    copied += 1
+                    total_size += result.size
+                else:
+                    failed += 1
+                on_result(result)
+
+        elapsed = time.time() - start
+        print('Скопировано файлов: {} (передано {:.1f} МБ) за {:.1f} с, {:.2f} МБ/с, ошибок: {}'.format(
+            copied, total_size / 1048576.0, elapsed,
+            total_size / 1048576.0 / max(elapsed, 0.001), failed))
+        return copied, total_size, failed
+
+    def _copy(self, job, run):
+        try:
+            if job.update:
+                # Снятие режима "Только для чтения" перед обновлением
+                os.chmod(job.target, 0o666)
+                if self.use_delta:
+                    size = pull_delta(job.source, job.target)[0]
+                else:
+                    size = staged_copy(job.source, job.target)
+            else:
+                # запись через временный файл: при обрыве связи не остается обрезанного файла,
+                # а копирование большого файла продолжается с контрольной точки
+                os.makedirs(os.path.dirname(job.target), exist_ok=True)
+                size = staged_copy(job.source, job.target)
+        except Exception as e:
+            return CopyResult(job, 0, e, None)
+
+        read_only_error = None
+        if self.set_read_only:
+            try:
+                with run.span('chmod'):
+                    os.chmod(job.target, stat.S_IREAD)
+            except Exception as e:
+                read_only_error = e
+        return CopyResult(job, size, None, read_only_error)
@@ -1,3 +1,3 @@
 from .DBMngModule import CADFolderDB
-from .KompasEventsHandler import KompasFrameHandler
+from .KompasEventsHandler import KompasFrameHandler, DocumentEvent
 from .KompasUtility import OpenDoc, k3DMaker, k2DMaker
\ No newline at end of file
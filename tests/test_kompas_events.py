@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+'''
+Проверка монитора документов KompasFrameHandler на имитации КОМПАС (benchmarks/fake_kompas)
+с источником событий FakeEventSource и с адаптивным опросом PollingSource.
+Запуск: python -m unittest discover tests
+'''
+
+import os, sys
+import queue
+import time
+import unittest
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+for path in (project_root, os.path.join(project_root, 'benchmarks')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from fake_kompas import FakeKompas, FakeEventSource
+from src.KompasSession import kompas_sessions
+from src.KompasEventsHandler import KompasFrameHandler, PollingSource, DocumentEvent
+
+# Ожидание события монитора, с
+EVENT_TIMEOUT = 3.0
+
+
+class MonitorTestMixin:
+    '''
+    Общие проверки для обоих источников изменений. source_factory(kompas)
+    возвращает функцию, создающую источник для монитора
+    '''
+    def setUp(self):
+        self.kompas = FakeKompas()
+        kompas_sessions.set_factory(self.kompas.factory)
+        self.handler = None
+
+    def tearDown(self):
+        if self.handler is not None:
+            self.handler.stop()
+            self.handler.join(EVENT_TIMEOUT)
+        kompas_sessions.set_factory(None)
+
+    def start(self):
+        kompas = self.kompas
+        self.handler = KompasFrameHandler(queue.Queue(), lambda: self.source_factory(kompas),
+                                          min_interval=0.02, max_interval=0.1,
+                                          event_interval=0.1, verify_interval=0.1, com=False)
+        self.handler.start()
+
+    def wait_event(self, kind, name):
+        deadline = time.time() + EVENT_TIMEOUT
+        while time.time() < deadline:
+            try:
+                event = self.handler.event_queue.get(timeout=deadline - time.time())
+            except queue.Empty:
+                break
+            if isinstance(event, DocumentEvent) and event.kind == kind and event.name == name:
+                return event
+        self.fail('Нет события {} для {}'.format(kind, name))
+
+    def test_open_activate_save_close(self):
+        first = self.kompas.app.Documents.Open('C:/Project/first.m3d')
+        self.start()
+        self.wait_event('open', 'first.m3d')
+        self.wait_event('activate', 'first.m3d')
+
+        second = self.kompas.app.Documents.Open('C:/Project/second.a3d')
+        self.assertEqual(self.wait_event('open', 'second.a3d').path, 'C:/Project/second.a3d')
+        self.wait_event('activate', 'second.a3d')
+
+        self.kompas.app.activate(first)
+        self.wait_event('activate', 'first.m3d')
+
+        first.modify()
+        time.sleep(0.2)
+        first.Save()
+        self.wait_event('save', 'first.m3d')
+
+        second.Close()
+        self.wait_event('close', 'second.a3d')
+
+    def test_close_and_open_with_same_active_document(self):
+        active = self.kompas.app.Documents.Open('C:/Project/active.m3d')
+        other = self.kompas.app.Documents.Open('C:/Project/other.m3d')
+        self.kompas.app.activate(active)
+        self.start()
+        self.wait_event('activate', 'active.m3d')
+
+        # количество документов и активный документ не меняются
+        other.Close()
+        self.kompas.app.Documents.Open('C:/Project/new.m3d')
+        self.kompas.app.activate(active)
+        self.wait_event('open', 'new.m3d')
+        self.wait_event('close', 'other.m3d')
+
+    def test_reattach_after_exit(self):
+        self.kompas.app.Documents.Open('C:/Project/before.m3d')
+        self.start()
+        self.wait_event('activate', 'before.m3d')
+
+        self.kompas.restart()
+        self.kompas.app.Documents.Open('C:/Project/after.m3d')
+        self.wait_event('open', 'after.m3d')
+        self.wait_event('activate', 'after.m3d')
+        self.assertGreaterEqual(self.kompas.stats.connects, 2)
+
+
+class EventSourceTest(MonitorTestMixin, unittest.TestCase):
+    @staticmethod
+    def source_factory(kompas):
+        return FakeEventSource(kompas.app)
+
+
+class PollingSourceTest(MonitorTestMixin, unittest.TestCase):
+    @staticmethod
+    def source_factory(kompas):
+        return PollingSource()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+'''
+Проверка кэша подключений KompasSessionCache на имитации КОМПАС (benchmarks/fake_kompas).
+Запуск: python -m unittest discover tests
+'''
+
+import os, sys
+import threading
+import unittest
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+for path in (project_root, os.path.join(project_root, 'benchmarks')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from fake_kompas import FakeKompas
+from src.KompasSession import KompasSessionCache
+
+
+class KompasSessionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.kompas = FakeKompas()
+        self.sessions = KompasSessionCache(self.kompas.factory)
+
+    def test_session_is_reused(self):
+        session = self.sessions.get()
+        self.assertIs(self.sessions.get(), session)
+        self.assertEqual(self.kompas.stats.connects, 1)
+
+    def test_reconnect_after_restart(self):
+        session = self.sessions.get()
+        self.kompas.restart()
+        new_session = self.sessions.get()
+        self.assertIsNot(new_session, session)
+        self.assertIs(new_session.app, self.kompas.app)
+        self.assertEqual(self.kompas.stats.connects, 2)
+        self.assertIs(self.sessions.get(), new_session)
+
+    def test_reset(self):
+        session = self.sessions.get()
+        self.sessions.reset()
+        self.assertIsNot(self.sessions.get(), session)
+        self.assertEqual(self.kompas.stats.connects, 2)
+
+    def test_sessions_per_thread(self):
+        main_session = self.sessions.get()
+        results = []
+
+        def worker():
+            session = self.sessions.get()
+            results.append((session, self.sessions.get()))
+
+        threads = [threading.Thread(target=worker) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 2)
+        thread_sessions = [first for first, second in results]
+        for first, second in results:
+            # в одном потоке подключение переиспользуется
+            self.assertIs(first, second)
+            self.assertIsNot(first, main_session)
+        self.assertIsNot(thread_sessions[0], thread_sessions[1])
+        self.assertIs(self.sessions.get(), main_session)
+        self.assertEqual(self.kompas.stats.connects, 3)
+
+    def test_set_factory_drops_sessions(self):
+        session = self.sessions.get()
+        other = FakeKompas()
+        self.sessions.set_factory(other.factory)
+        self.assertIs(self.sessions.get().app, other.app)
+        self.assertIsNot(self.sessions.get(), session)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+'''
+Проверка пакетного чтения и записи свойств PropertyCache на имитации КОМПАС (benchmarks/fake_kompas).
+Запуск: python -m unittest discover tests
+'''
+
+import os, sys
+import unittest
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+for path in (project_root, os.path.join(project_root, 'benchmarks')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from fake_kompas import FakeKompas, FakeFeature
+from src.KompasUtility import PropertyCache
+
+# ID свойств "Обозначение" и "Наименование"
+MARKING_ID = 4.0
+NAME_ID = 5.0
+
+
+class PropertyCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.kompas = FakeKompas()
+        self.session = self.kompas.factory()
+        self.document = self.kompas.app.Documents.Add(5.0, True)
+        self.parts = [FakeFeature(self.kompas.stats, 'Деталь {}'.format(i)) for i in range(3)]
+        self.cache = PropertyCache(self.session, self.document)
+
+    def test_round_trip(self):
+        values = [{MARKING_ID: 'ОБОЗН.{}'.format(i), NAME_ID: 'Деталь {}'.format(i)}
+                  for i in range(len(self.parts))]
+        self.assertEqual(self.cache.set_values(self.parts, values), 2 * len(self.parts))
+        self.assertEqual(self.cache.get_values(self.parts, (MARKING_ID, NAME_ID)), values)
+
+    def test_common_values(self):
+        self.assertEqual(self.cache.set_values(self.parts, {NAME_ID: 'Общее'}), len(self.parts))
+        self.assertEqual(self.cache.get_values(self.parts, (NAME_ID,)),
+                         [{NAME_ID: 'Общее'}] * len(self.parts))
+        # незаданное свойство читается как пустая строка
+        self.assertEqual(self.cache.get_values(self.parts[:1], (MARKING_ID,)), [{MARKING_ID: ''}])
+
+    def test_property_objects_cached(self):
+        requested = []
+        get_property = self.cache.property_mng.GetProperty
+
+        def counting_get_property(document, ID):
+            requested.append(ID)
+            return get_property(document, ID)
+
+        self.cache.property_mng.GetProperty = counting_get_property
+        self.cache.set_values(self.parts, {MARKING_ID: 'А', NAME_ID: 'Б'})
+        self.cache.get_values(self.parts, (MARKING_ID, NAME_ID))
+        self.assertEqual(sorted(requested), [MARKING_ID, NAME_ID])
+
+    def test_active_document_by_default(self):
+        self.assertIs(PropertyCache(self.session).document, self.document)
+
+
+if __name__ == '__main__':
+    unittest.main()